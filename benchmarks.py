@@ -0,0 +1,408 @@
+"""
+SmileAgent performance benchmarks.
+
+Run one benchmark at a time from the repo root:
+
+    python benchmarks.py triage_under_load [--blocking]
+    python benchmarks.py clinic_search
+    python benchmarks.py rate_limiter
+    python benchmarks.py middleware
+    python benchmarks.py pdf_render
+    python benchmarks.py photo_normalize
+    python benchmarks.py smile_analyzer
+
+Benchmarks talk to the ASGI app in-process (httpx.ASGITransport), so they
+measure our own code — not uvicorn or the network. DATA_DIR is pointed at
+a throwaway temp directory, so the real stores are never touched.
+Needs `pip install httpx` on top of requirements.txt.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+# Keep the benchmark quiet and away from the real data files
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="smileagent-bench-")
+os.environ.setdefault("ENCRYPTION_KEY", "wVsBvbN0Ck4QLE5V1PaHr4xJbBU4Z3jd_DgWrb9cP1I=")
+import logging
+logging.disable(logging.INFO)
+
+import main
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _report(name, samples_ms):
+    print(f"{name:<32} n={len(samples_ms):<6} "
+          f"p50={_percentile(samples_ms, 50):7.2f}ms  "
+          f"p99={_percentile(samples_ms, 99):7.2f}ms  "
+          f"max={max(samples_ms):7.2f}ms")
+
+
+def _disable_rate_limit():
+    # One client IP generates all the traffic
+    main.shared_state = main.SharedState()
+    main.shared_state.limiter = main.TokenBucketLimiter(10 ** 9, main._RATE_LIMIT_WINDOW)
+
+
+BOOKING = {
+    "name": "Bench Patient", "phone": "0871234567", "ppsn": "1234567T",
+    "address": "1 Main Street, Clondalkin, Dublin 22", "clinic_id": 1,
+    "clinic_name": "Clondalkin Dental", "treatment": "invisalign",
+    "selected_slot": "Mon 9:00 AM", "estimated_cost": 3200,
+}
+TRIAGE = {"pain_level": 7, "pain_worsening": True, "sleep_disrupted": True}
+
+
+# --------------------------------------------------------------------------
+# triage_under_load — p99 of /api/triage/assess while bookings are in flight
+# --------------------------------------------------------------------------
+
+async def _triage_under_load(blocking: bool, duration: float = 5.0, booking_concurrency: int = 4):
+    import httpx
+
+    if blocking:
+        # Reproduce the old behaviour: storage and PDF work inline on the loop
+        async def inline(fn, *args, **kwargs):
+            return fn(*args, **kwargs)
+        main.run_io = inline
+        main.run_pdf = inline
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app), httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        bookings_done = 0
+
+        async def book_forever():
+            nonlocal bookings_done
+            while time.perf_counter() < stop_at:
+                r = await client.post("/api/book-appointment", json=BOOKING)
+                assert r.status_code == 200, r.text
+                bookings_done += 1
+
+        async def triage_forever(samples):
+            while time.perf_counter() < stop_at:
+                t0 = time.perf_counter()
+                r = await client.post("/api/triage/assess", json=TRIAGE)
+                samples.append((time.perf_counter() - t0) * 1000)
+                assert r.status_code == 200, r.text
+                await asyncio.sleep(0.005)
+
+        baseline = []
+        stop_at = time.perf_counter() + 1.0
+        await triage_forever(baseline)
+
+        stop_at = time.perf_counter() + duration
+        loaded = []
+        await asyncio.gather(triage_forever(loaded),
+                             *[book_forever() for _ in range(booking_concurrency)])
+
+    mode = "blocking (inline)" if blocking else "executors"
+    print(f"mode: {mode}, {booking_concurrency} concurrent bookers, {bookings_done} bookings in {duration:.0f}s")
+    _report("triage, idle", baseline)
+    _report("triage, bookings in flight", loaded)
+
+
+def triage_under_load(args):
+    _disable_rate_limit()
+    asyncio.run(_triage_under_load(blocking="--blocking" in args))
+
+
+# --------------------------------------------------------------------------
+# clinic_search — emergency matching at national scale (10k synthetic clinics)
+# --------------------------------------------------------------------------
+
+def _synthetic_clinics(n: int, seed: int = 22):
+    """n copies of the real clinics scattered over the island of Ireland."""
+    import copy
+    import random
+    rng = random.Random(seed)
+    templates = main.get_registry().clinics
+    clinics = []
+    for i in range(n):
+        clinic = copy.deepcopy(templates[i % len(templates)])
+        clinic["id"] = i + 1
+        clinic["coordinates"] = {"lat": rng.uniform(51.4, 55.4), "lng": rng.uniform(-10.5, -5.4)}
+        clinics.append(clinic)
+    return clinics
+
+
+class _LinearScan:
+    """Stand-in for the spatial index that returns every clinic (no pruning)."""
+    def __init__(self, clinics):
+        self.clinics = clinics
+
+    def candidates(self, lat, lng, radius_km):
+        return self.clinics
+
+
+def clinic_search(args, n_clinics: int = 10_000, n_queries: int = 2_000):
+    import random
+    clinics = _synthetic_clinics(n_clinics)
+    rng = random.Random(7)
+    queries = [main.EmergencyClinicSearch(latitude=rng.uniform(51.6, 55.2), longitude=rng.uniform(-10.2, -5.8),
+                                          urgency=rng.choice(["orange", "yellow", "green"]),
+                                          medical_card_only=rng.random() < 0.3,
+                                          max_distance_km=rng.choice([5.0, 15.0, 30.0]))
+               for _ in range(n_queries)]
+
+    t0 = time.perf_counter()
+    registry = main.ClinicRegistry(clinics)
+    build_ms = (time.perf_counter() - t0) * 1000
+    print(f"{n_clinics} clinics, {n_queries} queries (radius 5/15/30 km); registry build {build_ms:.1f}ms")
+    main._clinic_registry = registry
+    index, columns = registry.index, registry.columns
+
+    modes = [("linear scan", _LinearScan(clinics), None), ("grid index", index, None)]
+    if columns is not None:
+        modes += [("linear scan + numpy", _LinearScan(clinics), columns), ("grid index + numpy", index, columns)]
+
+    results = {}
+    for name, impl, cols in modes:
+        registry.index, registry.columns = impl, cols
+        samples, ids = [], []
+        for q in queries:
+            t0 = time.perf_counter()
+            ids.append([m["id"] for m in main.match_clinics_for_emergency(q)])
+            samples.append((time.perf_counter() - t0) * 1000)
+        results[name] = ids
+        _report(name, samples)
+    for name in results:
+        assert results[name] == results["linear scan"], f"{name} returned different matches"
+
+
+# --------------------------------------------------------------------------
+# rate_limiter — throughput and memory with a million distinct client IPs
+# --------------------------------------------------------------------------
+
+class _SlidingWindowLists:
+    """The previous limiter: a list of timestamps per IP, never evicted."""
+    def __init__(self, max_requests, window):
+        from collections import defaultdict
+        self.max_requests, self.window = max_requests, window
+        self.hits = defaultdict(list)
+
+    def allow(self, client, now):
+        self.hits[client] = [t for t in self.hits[client] if now - t < self.window]
+        if len(self.hits[client]) >= self.max_requests:
+            return False
+        self.hits[client].append(now)
+        return True
+
+
+def rate_limiter(args, n_ips: int = 1_000_000, requests_per_ip: int = 3):
+    import random
+    import tracemalloc
+    rng = random.Random(1)
+    ips = [f"{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"
+           for _ in range(n_ips)]
+    # Each IP shows up a few times, spread over ~10 simulated minutes
+    traffic = ips * requests_per_ip
+    rng.shuffle(traffic)
+    step = 600.0 / len(traffic)
+    print(f"{n_ips} IPs, {len(traffic)} checks over 600 simulated seconds")
+
+    def replay(limiter):
+        now = 0.0
+        for ip in traffic:
+            limiter.allow(ip, now)
+            now += step
+        return limiter
+
+    limiters = (("sliding-window lists (old)", _SlidingWindowLists),
+                ("token bucket + LRU", main.TokenBucketLimiter))
+    for name, cls in limiters:
+        t0 = time.perf_counter()
+        replay(cls(main._RATE_LIMIT_MAX, main._RATE_LIMIT_WINDOW))
+        elapsed = time.perf_counter() - t0
+        # Second pass under tracemalloc (slow) only to measure what stays resident
+        tracemalloc.start()
+        limiter = replay(cls(main._RATE_LIMIT_MAX, main._RATE_LIMIT_WINDOW))
+        resident, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        tracked = len(limiter.hits) if isinstance(limiter, _SlidingWindowLists) else len(limiter)
+        print(f"{name:<28} {len(traffic) / elapsed / 1e6:5.2f}M checks/s  clients tracked={tracked:>8}  "
+              f"resident={resident / 2**20:6.1f}MiB  peak={peak / 2**20:6.1f}MiB")
+
+# --------------------------------------------------------------------------
+# middleware — requests/s on /api/triage/assess, pure ASGI vs BaseHTTPMiddleware
+# --------------------------------------------------------------------------
+
+async def _legacy_rate_limit_dispatch(request, call_next):
+    """The previous @app.middleware("http") version, for comparison."""
+    if request.url.path in main.RATE_LIMIT_EXEMPT_PATHS:
+        return await call_next(request)
+    client_ip = request.client.host if request.client else "unknown"
+    if not await main.shared_call(main.shared_state.allow, client_ip):
+        return main.JSONResponse(status_code=429, content={"detail": "Too many requests."})
+    response = await call_next(request)
+    for name, value in main.SECURITY_HEADERS.items():
+        response.headers[name] = value
+    return response
+
+
+async def _requests_per_second(app, duration: float) -> float:
+    """Drive the ASGI app directly (no HTTP client), one request at a time."""
+    import json
+    body = json.dumps(TRIAGE).encode()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": "/api/triage/assess", "raw_path": b"/api/triage/assess",
+             "root_path": "", "query_string": b"", "server": ("bench", 80), "client": ("10.0.0.1", 5000),
+             "headers": [(b"host", b"bench"), (b"content-type", b"application/json"),
+                         (b"content-length", str(len(body)).encode())]}
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    status = []
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    done = 0
+    stop_at = time.perf_counter() + duration
+    while time.perf_counter() < stop_at:
+        await app(dict(scope), receive, send)
+        done += 1
+    assert set(status) == {200}, set(status)
+    return done / duration
+
+
+def middleware(args, duration: float = 5.0):
+    from starlette.middleware import Middleware
+    from starlette.middleware.base import BaseHTTPMiddleware
+    _disable_rate_limit()
+    app = main.app
+    current = list(app.user_middleware)
+    legacy = [Middleware(BaseHTTPMiddleware, dispatch=_legacy_rate_limit_dispatch)
+              if m.cls is main.RateLimitMiddleware else m for m in current]
+
+    async def run():
+        results = {}
+        for name, stack in (("BaseHTTPMiddleware (old)", legacy), ("pure ASGI", current)):
+            app.user_middleware = stack
+            app.middleware_stack = None   # rebuilt on the next call
+            await _requests_per_second(app, 0.5)   # warm-up
+            results[name] = await _requests_per_second(app, duration)
+        app.user_middleware = current
+        app.middleware_stack = None
+        return results
+
+    for name, rps in asyncio.run(run()).items():
+        print(f"{name:<28} {rps:8.0f} req/s  ({1e6 / rps:6.1f}µs/request)")
+
+
+# --------------------------------------------------------------------------
+# pdf_render — Med 2 PDFs per second on one core, template vs full redraw
+# --------------------------------------------------------------------------
+
+def pdf_render(args, n: int = 300):
+    from reportlab import rl_config
+    clinic = main.get_clinic_by_id(1)
+    booking = {**BOOKING, "booking_id": "bench-pdf"}
+    modes = (("full redraw, ASCII85 (old)", False, 1),
+             ("full redraw", False, 0),
+             ("cached template", True, 0))
+    for name, template, use_a85 in modes:
+        rl_config.useA85 = use_a85
+        main.generate_med2_pdf(booking, clinic, template)   # warm-up (and builds the template)
+        t0 = time.perf_counter()
+        for _ in range(n):
+            main.generate_med2_pdf(booking, clinic, template)
+        elapsed = time.perf_counter() - t0
+        size = main.med2_path("bench-pdf").stat().st_size
+        print(f"{name:<28} {n / elapsed:7.1f} PDFs/s per core  ({elapsed / n * 1000:5.2f}ms each, {size} bytes)")
+
+
+# --------------------------------------------------------------------------
+# photo_normalize — 12 MP phone photo → analysis copy + thumbnail, one core
+# --------------------------------------------------------------------------
+
+def _phone_photo(width: int = 4000, height: int = 3000, noise: int = 60) -> bytes:
+    """A noisy 12 MP JPEG with an EXIF orientation tag, about the size a phone sends."""
+    import io
+    from PIL import Image
+    grain = Image.effect_noise((width, height), noise)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    photo = Image.merge("RGB", (grain, gradient, Image.blend(grain, gradient, 0.5)))
+    exif = Image.Exif()
+    exif[0x0112] = 6   # rotated 90° — the phone held upright
+    buf = io.BytesIO()
+    photo.save(buf, "JPEG", quality=92, exif=exif)
+    return buf.getvalue()
+
+
+def photo_normalize(args, n: int = 10):
+    photo = _phone_photo()
+    original = main.UPLOAD_DIR / "bench.jpg"
+    timings = []
+    for i in range(n + 1):
+        original.write_bytes(photo)
+        t0 = time.perf_counter()
+        info = main.normalize_photo(f"bench{i}", str(original))
+        if i:   # first run is warm-up
+            timings.append((time.perf_counter() - t0) * 1000)
+    _report("normalize 12 MP JPEG", timings)
+    print(f"stored {info['stored_bytes']:,} bytes ({main.PHOTO_FORMAT}, {info['width']}x{info['height']} + thumbnail) "
+          f"vs {info['original_bytes']:,} uploaded — {info['original_bytes'] / info['stored_bytes']:.0f}x smaller, "
+          f"{4000 * 3000 / (info['width'] * info['height']):.1f}x fewer pixels to analyse")
+
+
+# --------------------------------------------------------------------------
+# smile_analyzer — reference analyzer behind the micro-batching queue
+# --------------------------------------------------------------------------
+
+def smile_analyzer(args, n_photos: int = 32, requests: int = 4096, clients: int = 64):
+    """Photos/s and per-request latency with `clients` concurrent uploads, per batch size."""
+    photos = []
+    for i in range(n_photos):
+        original = main.UPLOAD_DIR / f"bench{i}.jpg"
+        original.write_bytes(_phone_photo(1600, 1200, noise=10 + i))
+        main.normalize_photo(f"bench{i}", str(original))
+        photos.append(main.photo_paths(f"bench{i}")["thumbnail"])   # what the reference analyzer reads
+
+    async def run(batch_size):
+        batcher = main.AnalysisBatcher(main.ReferenceSmileAnalyzer(), batch_size=batch_size)
+        latencies = []
+
+        async def client(k):
+            for i in range(k, requests, clients):
+                t0 = time.perf_counter()
+                await batcher.analyze(photos[i % n_photos])
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+        await batcher.analyze(photos[0])   # warm up the process pool
+        latencies.clear()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(k) for k in range(clients)))
+        elapsed = time.perf_counter() - t0
+        await batcher.stop()
+        return elapsed, latencies, batcher.batches_run - 1
+
+    print(f"{main.PDF_WORKERS} worker process(es), {clients} concurrent clients, {requests} photos")
+    for batch_size in (1, 4, 8, 16, 32):
+        elapsed, latencies, batches = asyncio.run(run(batch_size))
+        print(f"batch_size={batch_size:<3} {requests / elapsed:7.1f} photos/s  "
+              f"avg batch {requests / batches:5.1f}  "
+              f"p50={_percentile(latencies, 50):7.1f}ms  p99={_percentile(latencies, 99):7.1f}ms")
+
+
+BENCHMARKS = {
+    "triage_under_load": triage_under_load,
+    "clinic_search": clinic_search,
+    "rate_limiter": rate_limiter,
+    "middleware": middleware,
+    "pdf_render": pdf_render,
+    "photo_normalize": photo_normalize,
+    "smile_analyzer": smile_analyzer,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"usage: python benchmarks.py {{{','.join(BENCHMARKS)}}} [options]")
+        sys.exit(2)
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
@@ -46,21 +46,44 @@ import uuid
 import re
 import html as html_lib          # For XSS-safe HTML escaping in signature page
 import base64
+import io
 import hashlib
+import hmac
 import logging
+import asyncio
+import threading
+import sqlite3
+import socket
+import functools
+import zipfile
+import zlib
+import smtplib
+import ssl
+import heapq
+import time as _time
+from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import Optional, List, Dict
 from enum import Enum
+from collections import defaultdict, OrderedDict
 from math import radians, sin, cos, sqrt, atan2
+from bisect import bisect_right
+from zoneinfo import ZoneInfo
+from urllib.parse import urlparse
+from email.message import EmailMessage
+from email.utils import make_msgid
 
 from dotenv import load_dotenv
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Form, BackgroundTasks, Query
+from fastapi import FastAPI, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.datastructures import MutableHeaders
+from multipart.multipart import MultipartParser, parse_options_header
 from pydantic import BaseModel, Field, validator
 
 # ==========================================================================
@@ -83,16 +106,71 @@ logger = logging.getLogger("smileagent")
 # In production: set ENCRYPTION_KEY in .env (output of Fernet.generate_key()).
 # If missing, a throwaway key is generated so the app still boots — but data
 # encrypted with it won't survive a restart.
-ENCRYPTION_KEY = os.getenv("ENCRYPTION_KEY")
+#
+# Key rotation: set ENCRYPTION_KEYS to a comma-separated list, NEWEST FIRST.
+# New data is encrypted with the first key; any listed key can decrypt. Run
+# the re-encryption job (POST /api/admin/keys/rotate) before dropping an old key.
+ENCRYPTION_KEYS = [k.strip() for k in os.getenv("ENCRYPTION_KEYS", "").split(",") if k.strip()]
+ENCRYPTION_KEY = ENCRYPTION_KEYS[0] if ENCRYPTION_KEYS else os.getenv("ENCRYPTION_KEY")
 if not ENCRYPTION_KEY:
     ENCRYPTION_KEY = Fernet.generate_key().decode()
     # SECURITY: Never log the actual key value — only warn that it's ephemeral
     logger.warning("ENCRYPTION_KEY not set — using auto-generated ephemeral key. "
                    "Set ENCRYPTION_KEY in .env for production!")
+if not ENCRYPTION_KEYS:
+    ENCRYPTION_KEYS = [ENCRYPTION_KEY]
 
-cipher_suite = Fernet(
-    ENCRYPTION_KEY.encode() if isinstance(ENCRYPTION_KEY, str) else ENCRYPTION_KEY
-)
+primary_fernet = Fernet(ENCRYPTION_KEYS[0].encode())
+cipher_suite = MultiFernet([primary_fernet] + [Fernet(k.encode()) for k in ENCRYPTION_KEYS[1:]])
+
+# ---- Storage backend: "sqlite" (WAL database, default) or "json" (legacy files) ----
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+
+# ---- Clinic registry: data file path and mtime poll interval (0 = admin reload only) ----
+CLINICS_FILE_SETTING = os.getenv("CLINICS_FILE", "").strip()
+CLINICS_RELOAD_INTERVAL = float(os.getenv("CLINICS_RELOAD_INTERVAL", "30"))
+
+# ---- Admin token for /api/admin/* endpoints (unset = admin endpoints disabled) ----
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# ---- Data directory for stores, uploads and generated PDFs (default: app dir) ----
+DATA_DIR_SETTING = os.getenv("DATA_DIR", "").strip()
+
+# ---- Worker pools: blocking storage/crypto threads and PDF render processes ----
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+# ---- Shared state (rate limits + live slot status): "memory" (one worker),
+#      "sqlite" (all workers on one host) or "redis" (several hosts) ----
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory").strip().lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))   # uvicorn --workers default
+
+# ---- Smile photo uploads: largest accepted photo in bytes, stored sizes ----
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# Longest side of the stored analysis copy and of the thumbnail, in pixels
+PHOTO_MAX_DIMENSION = int(os.getenv("PHOTO_MAX_DIMENSION", "1600"))
+PHOTO_THUMB_DIMENSION = int(os.getenv("PHOTO_THUMB_DIMENSION", "256"))
+
+# ---- Smile analyzer: registered name or "module:Class", and request batching ----
+SMILE_ANALYZER = os.getenv("SMILE_ANALYZER", "reference").strip()
+ANALYZER_BATCH_SIZE = int(os.getenv("ANALYZER_BATCH_SIZE", "8"))
+ANALYZER_BATCH_WAIT_MS = float(os.getenv("ANALYZER_BATCH_WAIT_MS", "10"))
+
+# ---- Disk retention for uploads/ and outputs/ (0 = keep forever / no quota) ----
+PHOTO_RETENTION_DAYS = float(os.getenv("PHOTO_RETENTION_DAYS", "90"))
+PDF_RETENTION_DAYS = float(os.getenv("PDF_RETENTION_DAYS", "30"))      # unsigned Med 2s, since last download
+STORAGE_QUOTA_BYTES = int(float(os.getenv("STORAGE_QUOTA_MB", "2048")) * 1024 * 1024)
+STORAGE_SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", "600"))
+
+# ---- Clinic notification email (SMTP_HOST unset = log messages instead of sending) ----
+SMTP_HOST = os.getenv("SMTP_HOST", "").strip()
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME", "")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "")
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+SMTP_FROM = os.getenv("SMTP_FROM", "SmileAgent <bookings@smileagent.ie>")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
 
 # ==========================================================================
 # LIFESPAN — replaces deprecated @app.on_event("startup")
@@ -106,14 +184,53 @@ async def lifespan(app: FastAPI):
     logger.info("🚀 SmileAgent API v7.0 Started")
     logger.info("=" * 60)
     logger.info(f"📁 Base directory: {BASE_DIR}")
-    logger.info(f"🏥 Clinics loaded: {len(CLINICS)}")
+    logger.info(f"💾 Data directory: {DATA_DIR}")
+    logger.info(f"🏥 Clinics loaded: {len(get_registry())} from {CLINICS_FILE.name}")
     logger.info(f"💊 Treatments: {', '.join(TREATMENTS.keys())}")
     logger.info(f"📄 PDF generation: {'✅' if REPORTLAB_AVAILABLE else '❌'}")
     logger.info("🚨 Emergency Triage: ✅")
     logger.info("💳 Medical Card Filter: ✅")
     logger.info("📋 Dentist Brief: ✅")
+    logger.info(f"🗄️ Storage backend: {repo.name} ({repo.count_bookings()} bookings)")
+    logger.info(f"🔗 Shared state: {shared_state.name}")
+    if WEB_CONCURRENCY > 1 and shared_state.name == "memory":
+        logger.warning(f"WEB_CONCURRENCY={WEB_CONCURRENCY} with in-memory shared state: rate limits "
+                       "apply per worker and slot updates are not seen by other workers. "
+                       "Set SHARED_STATE_BACKEND=sqlite or redis.")
     logger.info("=" * 60)
+    watcher = asyncio.create_task(clinic_registry_watcher()) if CLINICS_RELOAD_INTERVAL > 0 else None
+    moved = await run_io(storage_sweeper.migrate)
+    if moved:
+        logger.info(f"Moved {moved} upload/output files into hashed subdirectories")
+    sweeper = asyncio.create_task(storage_sweeper_loop()) if STORAGE_SWEEP_INTERVAL > 0 else None
+    compactor = None
+    if isinstance(repo, JsonFileRepository):
+        compactor = asyncio.create_task(booking_compactor(repo.booking_log))
+    consent_writer.start()
+    outbox.start()
+    slot_broadcaster.start()
+    smile_batcher.start()
+    logger.info(f"🦷 Smile analyzer: {smile_batcher.analyzer.name if smile_batcher.analyzer else 'unavailable'}")
+    if key_rotation.state.get("status") == "running":
+        key_rotation.start()   # interrupted by a restart — pick up from the checkpoint
     yield  # App runs here
+    await key_rotation.stop()
+    await consent_writer.stop()
+    await outbox.stop()
+    await slot_broadcaster.stop()
+    await smile_batcher.stop()
+    await pdf_jobs.stop()
+    await photo_jobs.stop()
+    if watcher:
+        watcher.cancel()
+    if compactor:
+        compactor.cancel()
+    if sweeper:
+        sweeper.cancel()
+    shutdown_executors()
+    shared_state.close()
+    outbox.store.close()
+    repo.close()
     logger.info("SmileAgent API shutting down")
 
 # ---- App init (must come before route decorators) ----
@@ -137,6 +254,70 @@ def decrypt_field(encrypted_data: str) -> Optional[str]:
         return None
     return cipher_suite.decrypt(encrypted_data.encode()).decode()
 
+def encrypt_fields(values: Dict[str, Optional[str]]) -> Dict[str, Optional[str]]:
+    """Encrypt all PII fields of one record in a single call (one timestamp
+    for the whole record). Falsy values map to None, like encrypt_field().
+    Blocking — call through run_io() from async code."""
+    now = int(_time.time())
+    return {field: cipher_suite.encrypt_at_time(value.encode(), now).decode() if value else None
+            for field, value in values.items()}
+
+def decrypt_fields(record: dict, fields: tuple) -> Dict[str, Optional[str]]:
+    """Decrypt the named fields of a stored record in one call."""
+    return {field: decrypt_field(record.get(field)) for field in fields}
+
+# ---- Plaintext cache ----
+# Memory-only, short-TTL, size-bounded cache of decrypted PII keyed by record
+# id (e.g. brief_id), so a follow-up step such as the clinic email can reuse
+# the plaintext we just encrypted instead of decrypting it again. Never
+# persisted or logged; consumers evict entries explicitly once done.
+_PLAINTEXT_CACHE_TTL = 120      # seconds
+_PLAINTEXT_CACHE_MAX = 1000     # entries
+
+class PlaintextCache:
+    def __init__(self, ttl: float = _PLAINTEXT_CACHE_TTL, max_entries: int = _PLAINTEXT_CACHE_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (expires_at, fields)
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        # Insertion order == expiry order (fixed TTL), so stop at the first live entry
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+
+    def put(self, key: str, fields: Dict[str, Optional[str]]):
+        now = _time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, dict(fields))
+            self._expire(now)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: str) -> Optional[Dict[str, Optional[str]]]:
+        """Return and evict the entry (None if missing or expired)."""
+        with self._lock:
+            self._expire(_time.monotonic())
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry else None
+
+    def evict(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+brief_plaintext_cache = PlaintextCache()
+
 # ==========================================================================
 # GLOBAL ERROR HANDLER
 # Catches any unhandled exception. In debug mode the real error is returned;
@@ -149,12 +330,47 @@ try:
     from reportlab.pdfgen import canvas
     from reportlab.lib.pagesizes import A4
     from reportlab.lib.colors import black, HexColor
+    from reportlab import rl_config
+    # Write zlib streams as binary: ASCII85-wrapping them only makes the file
+    # bigger, and without ReportLab's C accelerator it is ~30% of render time
+    rl_config.useA85 = 0
     REPORTLAB_AVAILABLE = True
     logger.info("reportlab available — PDF generation enabled")
 except ImportError:
     REPORTLAB_AVAILABLE = False
     logger.warning("reportlab not installed — run: pip install reportlab")
 
+# ---- Optional: Pillow for the signature image stamped into signed Med 2s ----
+# Not a hard dependency — without it the signature box says "Digitally signed"
+# and smile photos are kept exactly as uploaded (no downscale / EXIF strip).
+try:
+    from PIL import Image, ImageOps, features as pil_features
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+    logger.error("Pillow not installed — smile photos are kept at full resolution WITH their EXIF/GPS "
+                 "metadata, smile analysis is disabled and signed Med 2s get a text stamp. "
+                 "Run: pip install -r requirements.txt")
+
+# ---- Optional: pillow-heif so iPhone HEIC photos can be normalized too ----
+# Not a hard dependency — without it HEIC uploads are stored as uploaded.
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_AVAILABLE = True
+except ImportError:
+    HEIF_AVAILABLE = False
+    logger.warning("pillow-heif not installed — HEIC photos are stored as uploaded, EXIF/GPS included")
+
+# ---- Optional: NumPy for vectorised clinic search ----
+# Not a hard dependency — without it emergency search uses a pure-Python loop.
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    logger.warning("numpy not installed — clinic search uses the pure-Python path")
+
 # ==========================================================================
 # APP CONFIGURATION — CORS, file paths, directory setup
 # ==========================================================================
@@ -176,45 +392,114 @@ app.add_middleware(
     allow_headers=["Content-Type", "Authorization"],
 )
 
-# ---------- Rate Limiter (in-memory, per-IP) ----------
+# ---------- Rate Limiter (per-IP) ----------
 # Prevents brute-force, scraping, and abuse of triage/booking endpoints.
-# In production with multiple workers, swap for Redis-backed limiter.
-from collections import defaultdict
-import time as _time
+# Checks go through `shared_state` (SHARED STATE section) so that with
+# several workers the limit is enforced once, not once per worker.
+_RATE_LIMIT_WINDOW = 60            # seconds
+_RATE_LIMIT_MAX = 30               # requests per window per IP (also the burst size)
+_RATE_LIMIT_MAX_CLIENTS = 100_000  # LRU bound on tracked IPs
+_RATE_LIMIT_SWEEP_INTERVAL = 30    # seconds between idle-entry sweeps
 
-_rate_limits: Dict[str, list] = defaultdict(list)
-_RATE_LIMIT_WINDOW = 60   # seconds
-_RATE_LIMIT_MAX = 30       # requests per window per IP
+class TokenBucketLimiter:
+    """Per-client token bucket, stored in its GCRA form: one float per client
+    (the time the bucket will next be full), so a check is O(1) with no
+    per-request list rebuilding.
 
-@app.middleware("http")
-async def rate_limit_middleware(request: Request, call_next):
-    """Simple sliding-window rate limiter per client IP."""
-    # Skip rate limiting for health checks (used by uptime monitors)
-    if request.url.path in ("/health", "/", "/docs", "/openapi.json"):
-        return await call_next(request)
-    
-    client_ip = request.client.host if request.client else "unknown"
-    now = _time.time()
-    
-    # Prune old entries outside the window
-    _rate_limits[client_ip] = [t for t in _rate_limits[client_ip] if now - t < _RATE_LIMIT_WINDOW]
-    
-    if len(_rate_limits[client_ip]) >= _RATE_LIMIT_MAX:
-        return JSONResponse(
-            status_code=429,
-            content={"detail": "Too many requests. Please wait a moment and try again."}
-        )
-    
-    _rate_limits[client_ip].append(now)
-    response = await call_next(request)
-    
-    # Add security headers to every response
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
-    response.headers["Permissions-Policy"] = "camera=(), microphone=(), geolocation=(self)"
-    
-    return response
+    Clients live in an LRU-ordered table capped at max_clients. Entries whose
+    bucket has refilled completely are indistinguishable from new clients, so
+    the periodic sweep drops them without changing any decision.
+    """
+
+    def __init__(self, max_requests: int, window: float, max_clients: int = _RATE_LIMIT_MAX_CLIENTS):
+        self.interval = window / max_requests          # seconds per token
+        self.burst = window - self.interval            # how far ahead of `now` a full burst may run
+        self.max_clients = max_clients
+        self._full_at: "OrderedDict[str, float]" = OrderedDict()
+        self._last_sweep = 0.0
+
+    def allow(self, client: str, now: float) -> bool:
+        full_at = self._full_at.get(client)
+        if full_at is None or full_at < now:
+            full_at = now
+        elif full_at - now > self.burst:
+            self._full_at.move_to_end(client)
+            return False
+        self._full_at[client] = full_at + self.interval
+        self._full_at.move_to_end(client)
+        if len(self._full_at) > self.max_clients:
+            self._full_at.popitem(last=False)
+        if now - self._last_sweep >= _RATE_LIMIT_SWEEP_INTERVAL:
+            self.sweep(now)
+        return True
+
+    def sweep(self, now: float) -> int:
+        """Drop idle clients from the LRU end; returns how many were evicted."""
+        self._last_sweep = now
+        evicted = 0
+        while self._full_at:
+            client, full_at = next(iter(self._full_at.items()))
+            if full_at > now:
+                break
+            del self._full_at[client]
+            evicted += 1
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._full_at)
+
+# Skip rate limiting for health checks (used by uptime monitors)
+RATE_LIMIT_EXEMPT_PATHS = frozenset(("/health", "/", "/docs", "/openapi.json"))
+
+SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "Referrer-Policy": "strict-origin-when-cross-origin",
+    "Permissions-Policy": "camera=(), microphone=(), geolocation=(self)",
+}
+
+class RateLimitMiddleware:
+    """Token-bucket rate limiter per client IP, plus security headers.
+
+    Plain ASGI rather than @app.middleware("http"): headers are added to the
+    http.response.start message as it goes out, so response bodies (PDF
+    downloads, streams) are passed through untouched instead of being
+    re-wrapped by BaseHTTPMiddleware."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in RATE_LIMIT_EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        client_ip = client[0] if client else "unknown"
+        try:
+            allowed = await shared_call(shared_state.allow, client_ip)
+        except (SharedStateError, sqlite3.Error) as e:
+            # Fail open: an unreachable store must not take the whole API down
+            logger.error(f"Rate limit check failed, request allowed: {e}")
+            allowed = True
+        if not allowed:
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": "Too many requests. Please wait a moment and try again."}
+            )
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                for name, value in SECURITY_HEADERS.items():
+                    headers[name] = value
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+app.add_middleware(RateLimitMiddleware)
 
 # ---------- Global exception handler ----------
 # Never leak stack traces or internal details to the client.
@@ -226,16 +511,29 @@ async def global_exception_handler(request: Request, exc: Exception):
         content={"detail": "An internal error occurred. Please try again."}
     )
 
-# Directories
-BOOKINGS_FILE = BASE_DIR / "bookings.json"
-SIGNATURES_FILE = BASE_DIR / "signatures.json"
-BRIEFS_FILE = BASE_DIR / "briefs.json"
-UPLOAD_DIR = BASE_DIR / "uploads"
-OUTPUTS_DIR = BASE_DIR / "outputs"
-CONSENTS_FILE = BASE_DIR / "consents.json"
+# Directories — runtime data lives under DATA_DIR (defaults to the app directory;
+# point it at a persistent disk mount in production)
+DATA_DIR = Path(DATA_DIR_SETTING).resolve() if DATA_DIR_SETTING else BASE_DIR
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+BOOKINGS_FILE = DATA_DIR / "bookings.json"
+SIGNATURES_FILE = DATA_DIR / "signatures.json"
+BRIEFS_FILE = DATA_DIR / "briefs.json"
+UPLOAD_DIR = DATA_DIR / "uploads"
+OUTPUTS_DIR = DATA_DIR / "outputs"
+CONSENTS_FILE = DATA_DIR / "consents.json"          # legacy array, read-only (imported into sqlite)
+CONSENTS_LOG_FILE = DATA_DIR / "consents.jsonl"     # json backend: append-only
+DATABASE_FILE = DATA_DIR / "smileagent.db"
+SHARED_STATE_FILE = DATA_DIR / "shared_state.db"   # SHARED_STATE_BACKEND=sqlite
+OUTBOX_FILE = DATA_DIR / "outbox.db"               # queued clinic notifications
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUTS_DIR.mkdir(exist_ok=True)
 
+def shard_dir(root: Path, key: str) -> Path:
+    """Hashed subdirectory of UPLOAD_DIR / OUTPUTS_DIR for a photo_id or
+    booking_id, so no single directory listing grows without bound.
+    Created by whoever writes the first file into it."""
+    return root / hashlib.sha256(key.encode()).hexdigest()[:2]
+
 # ============================================================
 # ENUMS FOR TRIAGE
 # ============================================================
@@ -264,624 +562,13 @@ class RedFlag(str, Enum):
 #
 # "cosmetic_partner" flag controls whether a clinic appears in the cosmetic
 # booking flow. Emergency search (/api/clinics/emergency) sees ALL clinics.
+#
+# The clinic list itself lives in clinics.json and is loaded by the CLINIC
+# REGISTRY section below — edit the file to add a clinic or change a price,
+# no redeploy needed.
 # ==========================================================================
 
-CLINICS = [
-    # ------------------------------------------------------------------
-    # ID 1 — Clondalkin Dental (COSMETIC + EMERGENCY)
-    # ------------------------------------------------------------------
-    {
-        "id": 1,
-        "clinic_name": "Clondalkin Dental",
-        "location": "Main Street, Clondalkin Village, Dublin 22",
-        "eircode": "D22 Y2K8",
-        "coordinates": {"lat": 53.3205, "lng": -6.3947},
-        "phone": "+353 1 457 2000",
-        "email": "info@clondalkin-dental.ie",
-        "verified": True,
-        "cosmetic_partner": True,
-        "practitioner": {
-            "name": "DR. SARAH MURPHY",
-            "qualifications": "BDS NUI, MFDS RCSI",
-            "registration_number": "12345"
-        },
-        "pricing": {
-            "invisalign": 3200,
-            "composite_bonding": 300,
-            "veneers": 650,
-            "whitening": 350,
-            "emergency_exam": 95
-        },
-        "rating": 4.8,
-        "review_count": 89,
-        "top_review": "Excellent service. Dr. Murphy explained everything clearly and made me feel at ease.",
-        "available_slots": ["Mon 9:00 AM", "Wed 2:00 PM", "Fri 11:00 AM"],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-15",
-            "treatments_covered": ["exam", "extraction", "xray", "scale_polish"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 3
-        },
-        "hours": {
-            "mon": "09:00-18:00", "tue": "09:00-18:00", "wed": "09:00-20:00",
-            "thu": "09:00-18:00", "fri": "09:00-17:00", "sat": "10:00-14:00", "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 2 — Garvey's Tower Dental (COSMETIC + EMERGENCY)
-    # ------------------------------------------------------------------
-    {
-        "id": 2,
-        "clinic_name": "Garvey's Tower Dental",
-        "location": "Tower Road, Clondalkin, Dublin 22",
-        "eircode": "D22 XF82",
-        "coordinates": {"lat": 53.3187, "lng": -6.3892},
-        "phone": "+353 1 459 3000",
-        "email": "info@garveys-dental.ie",
-        "verified": True,
-        "cosmetic_partner": True,
-        "practitioner": {
-            "name": "DR. JAMES KELLY",
-            "qualifications": "BDentSc TCD, MSc Ortho",
-            "registration_number": "23456"
-        },
-        "pricing": {
-            "invisalign": 3450,
-            "composite_bonding": 280,
-            "veneers": 600,
-            "whitening": 400,
-            "emergency_exam": 85
-        },
-        "rating": 4.7,
-        "review_count": 67,
-        "top_review": "Very professional clinic. The team is friendly and results exceeded expectations.",
-        "available_slots": ["Tue 10:30 AM", "Thu 3:00 PM", "Sat 9:30 AM"],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": False,
-            "last_verified": "2026-01-10",
-            "treatments_covered": ["exam", "extraction", "xray"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "08:00-17:00", "tue": "08:00-17:00", "wed": "08:00-17:00",
-            "thu": "08:00-19:00", "fri": "08:00-16:00", "sat": None, "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 3 — Newland's Dental (COSMETIC + EMERGENCY)
-    # ------------------------------------------------------------------
-    {
-        "id": 3,
-        "clinic_name": "Newland's Dental",
-        "location": "Newlands Cross, Clondalkin, Dublin 22",
-        "eircode": "D22 P3W9",
-        "coordinates": {"lat": 53.3098, "lng": -6.3756},
-        "phone": "+353 1 464 1000",
-        "email": "info@newlands-dental.ie",
-        "verified": True,
-        "cosmetic_partner": True,
-        "practitioner": {
-            "name": "DR. AOIFE BRENNAN",
-            "qualifications": "BDS UCC, MOrth RCS Edin",
-            "registration_number": "34567"
-        },
-        "pricing": {
-            "invisalign": 2950,
-            "composite_bonding": 320,
-            "veneers": 700,
-            "whitening": 299,
-            "emergency_exam": 90
-        },
-        "rating": 4.9,
-        "review_count": 112,
-        "top_review": "Amazing experience from start to finish. Dr. Brennan is incredibly skilled.",
-        "available_slots": ["Mon 2:00 PM", "Wed 11:30 AM", "Fri 4:00 PM"],
-        "medical_card": {
-            "accepts": False,
-            "accepting_new_patients": False,
-            "last_verified": "2026-01-12",
-            "treatments_covered": []
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 4
-        },
-        "hours": {
-            "mon": "09:00-18:00", "tue": "09:00-18:00", "wed": "09:00-18:00",
-            "thu": "09:00-18:00", "fri": "09:00-17:00", "sat": "09:00-13:00", "sun": None
-        }
-    },
-
-    # ==================================================================
-    # EMERGENCY-ONLY CLINICS (IDs 4–13)
-    # These appear in the emergency triage flow but NOT in cosmetic booking.
-    # Addresses, eircodes, and phone numbers verified from public sources.
-    # ==================================================================
-
-    # ------------------------------------------------------------------
-    # ID 4 — 3Dental Dublin (Red Cow) — Dublin 22
-    # Source: 3dental.ie, Yelp, HIQA registration
-    # Large 16-surgery clinic, Mon-Fri 8am-8pm, Sat 9am-5pm
-    # ------------------------------------------------------------------
-    {
-        "id": 4,
-        "clinic_name": "3Dental Dublin (Red Cow)",
-        "location": "The Red Cow Complex, Naas Road, Dublin 22",
-        "eircode": "D22 KV24",
-        "coordinates": {"lat": 53.3191, "lng": -6.3656},
-        "phone": "+353 1 485 1033",
-        "email": "info@3dental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. PETER DOHERTY",
-            "qualifications": "BDentSc TCD, MFDS RCSI, PG Cert Implant Dent Newcastle",
-            "registration_number": "45678"
-        },
-        "pricing": {
-            "emergency_exam": 75
-        },
-        "rating": 4.6,
-        "review_count": 312,
-        "top_review": "Seen within 2 hours for an emergency. Very modern clinic with great staff.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": False,
-            "accepting_new_patients": False,
-            "last_verified": "2026-02-01",
-            "treatments_covered": []
-        },
-        "prsi_dtbs": False,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "08:00-20:00", "tue": "08:00-20:00", "wed": "08:00-20:00",
-            "thu": "08:00-20:00", "fri": "08:00-20:00", "sat": "09:00-17:00", "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 5 — 3Dental Dublin (Aungier Street) — Dublin 2
-    # Source: 3dental.ie
-    # City centre location, same hours as Red Cow
-    # ------------------------------------------------------------------
-    {
-        "id": 5,
-        "clinic_name": "3Dental Dublin (Aungier Street)",
-        "location": "13-16 Redmond's Hill, Aungier Street, Dublin 2",
-        "eircode": "D02 RP46",
-        "coordinates": {"lat": 53.3395, "lng": -6.2656},
-        "phone": "+353 1 270 9323",
-        "email": "info@3dental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. PAUL O'CONNELL",
-            "qualifications": "BDentSc TCD",
-            "registration_number": "56789"
-        },
-        "pricing": {
-            "emergency_exam": 75
-        },
-        "rating": 4.5,
-        "review_count": 198,
-        "top_review": "Got an emergency appointment within a few hours. Very professional service.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": False,
-            "accepting_new_patients": False,
-            "last_verified": "2026-02-01",
-            "treatments_covered": []
-        },
-        "prsi_dtbs": False,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "08:00-20:00", "tue": "08:00-20:00", "wed": "08:00-20:00",
-            "thu": "08:00-20:00", "fri": "08:00-20:00", "sat": "09:00-17:00", "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 6 — Smile Hub Dental Clinic — Sutton, Dublin 13
-    # Source: smilehub.ie, emergencydentalclinic.ie, whatclinic.com
-    # Open 7 days 7:30am–10pm, 365 days/year, accepts Medical Card + PRSI
-    # ------------------------------------------------------------------
-    {
-        "id": 6,
-        "clinic_name": "Smile Hub Dental Clinic",
-        "location": "Bayside Medical Centre, Bayside Shopping Centre, Sutton, Dublin 13",
-        "eircode": "D13 WK80",
-        "coordinates": {"lat": 53.3893, "lng": -6.1281},
-        "phone": "+353 1 525 3888",
-        "email": "info@smilehub.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. LAURA FEE",
-            "qualifications": "BDentSc TCD, Colgate Caring Dentist Nominee 2022-2024",
-            "registration_number": "67890"
-        },
-        "pricing": {
-            "emergency_exam": 80
-        },
-        "rating": 4.9,
-        "review_count": 425,
-        "top_review": "Open 7 days a week. Dr. Fee saw me on a Sunday for a dental emergency. Life savers.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-20",
-            "treatments_covered": ["exam", "extraction", "xray", "scale_polish"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 1
-        },
-        "hours": {
-            "mon": "07:30-22:00", "tue": "07:30-22:00", "wed": "07:30-22:00",
-            "thu": "07:30-22:00", "fri": "07:30-22:00", "sat": "07:30-22:00", "sun": "07:30-22:00"
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 7 — Merrion Square Dental (7DayDentist) — Dublin 2
-    # Source: merrionsquaredental.ie, 7daydentist.ie
-    # City centre, 100+ year practice, 7-day emergency, CEREC same-day crowns
-    # ------------------------------------------------------------------
-    {
-        "id": 7,
-        "clinic_name": "Merrion Square Dental",
-        "location": "78 Merrion Square South, Dublin 2",
-        "eircode": "D02 R251",
-        "coordinates": {"lat": 53.3389, "lng": -6.2489},
-        "phone": "+353 1 661 8145",
-        "email": "info@merrionsquaredental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. PADDY STEED",
-            "qualifications": "BDS Dundee, MFDS RCS Eng, MSc Implantology Bristol",
-            "registration_number": "78901"
-        },
-        "pricing": {
-            "emergency_exam": 90
-        },
-        "rating": 4.8,
-        "review_count": 210,
-        "top_review": "Excellent dental practice. Professional, efficient and friendly. 7 day emergency cover.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": False,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-25",
-            "treatments_covered": []
-        },
-        "prsi_dtbs": False,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "08:00-17:00", "tue": "08:00-17:00", "wed": "08:00-17:00",
-            "thu": "08:00-17:00", "fri": "08:00-17:00", "sat": "09:00-14:00", "sun": "10:00-14:00"
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 8 — Empire Dental Clinic — Dublin 1
-    # Source: empireclinic.ie
-    # City centre, emergency exam from €50, accepts Medical Card
-    # ------------------------------------------------------------------
-    {
-        "id": 8,
-        "clinic_name": "Empire Dental Clinic",
-        "location": "51 Parnell Square W, Rotunda, Dublin 1",
-        "eircode": "D01 N5P6",
-        "coordinates": {"lat": 53.3537, "lng": -6.2637},
-        "phone": "+353 1 539 0470",
-        "email": "empire.clinic20@gmail.com",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. EMPIRE DENTAL TEAM",
-            "qualifications": "Multiple Qualified Practitioners",
-            "registration_number": "89012"
-        },
-        "pricing": {
-            "emergency_exam": 50
-        },
-        "rating": 4.5,
-        "review_count": 156,
-        "top_review": "Quick diagnosis and emergency dentistry. Efficient and caring. Was in tears with pain before.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-18",
-            "treatments_covered": ["exam", "extraction", "xray"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "09:00-18:00", "tue": "09:00-18:00", "wed": "09:00-18:00",
-            "thu": "09:00-18:00", "fri": "09:00-18:00", "sat": "09:00-18:00", "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 9 — SCR Dental Clinic — Dublin 8
-    # Source: scrdental.ie
-    # 4 dentists on site, 100 year history, Luas accessible, D08 E7NN
-    # ------------------------------------------------------------------
-    {
-        "id": 9,
-        "clinic_name": "SCR Dental Clinic",
-        "location": "189 South Circular Road, Portobello, Dublin 8",
-        "eircode": "D08 E7NN",
-        "coordinates": {"lat": 53.3331, "lng": -6.2719},
-        "phone": "+353 1 454 9688",
-        "email": "info@scrdental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. MARIA KINCH",
-            "qualifications": "BDS, Multiple Practitioners on Site",
-            "registration_number": "90123"
-        },
-        "pricing": {
-            "emergency_exam": 70
-        },
-        "rating": 4.7,
-        "review_count": 94,
-        "top_review": "Given an emergency appointment very quickly. All staff from reception to dentist were brilliant.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-22",
-            "treatments_covered": ["exam", "extraction", "xray", "filling"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 3
-        },
-        "hours": {
-            "mon": "09:00-17:30", "tue": "09:00-17:30", "wed": "09:00-17:30",
-            "thu": "09:00-17:30", "fri": "09:00-17:30", "sat": None, "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 10- Truly Dental Baggot St
-    # ------------------------------------------------------------------
-    {
-        "id": 10,
-        "clinic_name": "Truly Dental Baggot Street",
-        "location": "Lincoln Place, Dublin 2",
-        "eircode": "D02 E780",
-        "coordinates": {"lat": 53.3416, "lng": -6.2508},
-        "phone": "+353 1 676 1536",
-        "email": "info@trulydental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR KEVIN.DUNNE",
-            "qualifications": "BDentSc TCD",
-            "registration_number": "45678"
-        },
-        "pricing": {
-            "emergency_exam": 90
-        },
-        "rating": 4.5,
-        "review_count": 26,
-        "top_review": "Great central location and extended hours. Very professional team.",
-        "available_slots": ["Mon 10:00 AM", "Wed 4:00 PM", "Sat 1:00 PM"],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-02-15",
-            "treatments_covered": ["exam", "extraction", "xray", "scale_polish", "filling"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "08:00-20:00", "tue": "08:00-20:00", "wed": "08:00-20:00",
-            "thu": "08:00-20:00", "fri": "08:00-20:00", "sat": "12:00-18:00", "sun": "12:00-18:00"
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 11 — Slievemore Dental — Swords, Co. Dublin
-    # Source: slievemoredental.ie
-    # North Dublin / Swords area, same-day emergency care
-    # ------------------------------------------------------------------
-    {
-        "id": 11,
-        "clinic_name": "Slievemore Dental",
-        "location": "Main Street, Swords, Co. Dublin",
-        "eircode": "K67 P2C0",
-        "coordinates": {"lat": 53.4597, "lng": -6.2181},
-        "phone": "+353 1 840 7600",
-        "email": "info@slievemoredental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. SLIEVEMORE TEAM",
-            "qualifications": "Multiple Qualified Practitioners",
-            "registration_number": "01234"
-        },
-        "pricing": {
-            "emergency_exam": 75
-        },
-        "rating": 4.6,
-        "review_count": 130,
-        "top_review": "Reliable and trustworthy for dental emergencies. Prompt response and great care.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-28",
-            "treatments_covered": ["exam", "extraction", "xray"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 3
-        },
-        "hours": {
-            "mon": "08:30-17:30", "tue": "08:30-17:30", "wed": "08:30-17:30",
-            "thu": "08:30-19:00", "fri": "08:30-17:00", "sat": "09:00-13:00", "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 12 — Castlemill Dental Clinic — Balbriggan, Co. Dublin
-    # Source: castlemilldental.ie
-    # North County Dublin, accepts Medical Card + PRSI
-    # ------------------------------------------------------------------
-    {
-        "id": 12,
-        "clinic_name": "Castlemill Dental Clinic",
-        "location": "Castlemill Shopping Centre, Hamlet Lane, Balbriggan, Co. Dublin",
-        "eircode": "K32 PY61",
-        "coordinates": {"lat": 53.6111, "lng": -6.1833},
-        "phone": "+353 1 841 0306",
-        "email": "info@castlemilldental.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. CASTLEMILL TEAM",
-            "qualifications": "Multiple Qualified Practitioners",
-            "registration_number": "11234"
-        },
-        "pricing": {
-            "emergency_exam": 65
-        },
-        "rating": 4.7,
-        "review_count": 85,
-        "top_review": "Medical card accepted. Emergency appointment arranged same day for severe toothache.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-01-30",
-            "treatments_covered": ["exam", "extraction", "xray", "filling"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 3
-        },
-        "hours": {
-            "mon": "09:00-17:30", "tue": "09:00-17:30", "wed": "09:00-17:30",
-            "thu": "09:00-17:30", "fri": "09:00-17:00", "sat": None, "sun": None
-        }
-    },
-    # ------------------------------------------------------------------
-    # ID 13 — HSE Dental Clinic Crumlin — Dublin 12
-    # Source: HSE.ie (Dublin South West dental services)
-    # Public dental clinic, medical card only, emergency by appointment
-    # ------------------------------------------------------------------
-    {
-        "id": 13,
-        "clinic_name": "HSE Dental Clinic Crumlin",
-        "location": "HSE Clinic, Old County Road, Crumlin, Dublin 12",
-        "eircode": "D12 KT66",
-        "coordinates": {"lat": 53.3192, "lng": -6.3183},
-        "phone": "+353 1 795 7390",
-        "email": "dental.dsw@hse.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "HSE DENTAL TEAM",
-            "qualifications": "HSE Public Dental Service",
-            "registration_number": "HSE-CRUM"
-        },
-        "pricing": {
-            "emergency_exam": 0
-        },
-        "rating": 4.0,
-        "review_count": 42,
-        "top_review": "Free emergency treatment with medical card. Call by 9:15am for same-day appointment.",
-        "available_slots": [],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-02-01",
-            "treatments_covered": ["exam", "extraction", "xray", "filling", "emergency_treatment"]
-        },
-        "prsi_dtbs": False,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 4
-        },
-        "hours": {
-            "mon": "09:00-17:00", "tue": "09:00-17:00", "wed": "09:00-17:00",
-            "thu": "09:00-17:00", "fri": "09:00-17:00", "sat": None, "sun": None
-        }
-    },
-    {
-        "id": 14,
-        "clinic_name": "Smiles Dental Bath Avenue",
-        "location": "11 Bath Avenue, Ballsbridge, Dublin 4",
-        "eircode": "D04 F5K0",
-        "coordinates": {"lat": 53.3371, "lng": -6.2334},
-        "phone": "+353 1 667 3556",
-        "email": "bathavenue@smiles.ie",
-        "verified": True,
-        "cosmetic_partner": False,
-        "practitioner": {
-            "name": "DR. SELENA MULVEY",
-            "qualifications": "BDS QUB, Bupa Dentist of the Year",
-            "registration_number": "56789"
-        },
-        "pricing": {
-            "invisalign": 3400,
-            "composite_bonding": 280,
-            "veneers": 600,
-            "whitening": 350,
-            "emergency_exam": 85
-        },
-        "rating": 4.7,
-        "review_count": 94,
-        "top_review": "Dr Bogdan is so friendly and accommodating. The whole process was easy and pain free!",
-        "available_slots": ["Tue 9:00 AM", "Thu 5:00 PM", "Sat 11:00 AM"],
-        "medical_card": {
-            "accepts": True,
-            "accepting_new_patients": True,
-            "last_verified": "2026-02-15",
-            "treatments_covered": ["exam", "extraction", "xray", "scale_polish"]
-        },
-        "prsi_dtbs": True,
-        "emergency_slots": {
-            "offers_same_day": True,
-            "typical_wait_hours": 2
-        },
-        "hours": {
-            "mon": "08:00-20:00", "tue": "08:00-20:00", "wed": "08:00-20:00",
-            "thu": "08:00-20:00", "fri": "08:00-17:00", "sat": "10:00-17:00", "sun": None
-        }
-    }
-]
-
-SLOT_STATUS = {}  # Emergency slot live availability (clinic_id -> {available, last_updated, notes})
+CLINICS_FILE = Path(CLINICS_FILE_SETTING) if CLINICS_FILE_SETTING else BASE_DIR / "clinics.json"
 
 TREATMENTS = {
     "invisalign": {
@@ -1067,195 +754,1111 @@ class SignatureSubmission(BaseModel):
     signed_date: str
 
 # ============================================================
-# HELPER FUNCTIONS
+# BOOKING STORE — append-only JSONL log with in-memory index
+# Every booking is one "put" line; every later change (e.g. signature status)
+# is a small "patch" line. The index maps booking_id -> byte offsets so a
+# lookup reads only that booking's lines instead of parsing the whole store.
+# A background compactor folds patches back into single records.
 # ============================================================
 
-def get_clinic_by_id(clinic_id: int):
-    for clinic in CLINICS:
-        if clinic["id"] == clinic_id:
-            return clinic
-    return None
+BOOKINGS_LOG_FILE = DATA_DIR / "bookings.jsonl"
+_BOOKING_COMPACT_INTERVAL = 300      # seconds between compaction checks
+_BOOKING_COMPACT_MIN_PATCHES = 1000  # don't bother compacting below this
+_BOOKING_COMPACT_RATIO = 0.5         # compact when patches >= 50% of bookings
 
-def calculate_med2_relief(gross_cost: float) -> dict:
-    relief_amount = gross_cost * 0.20
-    net_cost = gross_cost - relief_amount
-    return {
-        "gross_cost": round(gross_cost, 2),
-        "relief_rate": 0.20,
-        "relief_amount": round(relief_amount, 2),
-        "net_cost": round(net_cost, 2)
-    }
+class BookingLog:
+    """Log-structured booking store backed by a single JSONL segment file.
 
-def number_to_words(amount: int) -> str:
-    ones = ['', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine',
-            'ten', 'eleven', 'twelve', 'thirteen', 'fourteen', 'fifteen', 'sixteen',
-            'seventeen', 'eighteen', 'nineteen']
-    tens = ['', '', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy', 'eighty', 'ninety']
-    
-    if amount < 20:
-        return ones[amount]
-    elif amount < 100:
-        return tens[amount // 10] + ('' if amount % 10 == 0 else '-' + ones[amount % 10])
-    elif amount < 1000:
-        return ones[amount // 100] + ' hundred' + ('' if amount % 100 == 0 else ' and ' + number_to_words(amount % 100))
-    elif amount < 10000:
-        return number_to_words(amount // 1000) + ' thousand' + ('' if amount % 1000 == 0 else ' ' + number_to_words(amount % 1000))
-    else:
-        return str(amount)
+    Writes are O(1) appends; reads are O(1) index lookups plus one pread()
+    per record line. Safe to share between threads.
+    """
 
-def save_booking(booking_data: dict) -> dict:
-    """Persist a new booking to the JSON file store and assign a unique ID."""
-    bookings = []
-    if BOOKINGS_FILE.exists():
+    def __init__(self, path: Path, legacy_file: Optional[Path] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index: Dict[str, List[tuple]] = {}   # booking_id -> [(offset, length), ...]
+        self._patches = 0
+        if not self.path.exists() and legacy_file is not None and legacy_file.exists():
+            self._import_legacy(legacy_file)
+        self._open()
+
+    # ---- file handling ----
+
+    def _open(self):
+        self._fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self._size = self._rebuild_index()
+
+    def close(self):
+        with self._lock:
+            os.close(self._fd)
+
+    def _import_legacy(self, legacy_file: Path):
+        """One-off migration from the old bookings.json array format."""
         try:
-            bookings = json.loads(BOOKINGS_FILE.read_text())
+            bookings = json.loads(legacy_file.read_text())
         except (json.JSONDecodeError, OSError) as e:
-            logger.warning(f"Could not read bookings file, starting fresh: {e}")
-            bookings = []
-    
-    booking_data['booking_id'] = datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4())[:4]
-    booking_data['created_at'] = datetime.now().isoformat()
-    booking_data['status'] = 'confirmed'
-    booking_data['signature_status'] = 'pending'
-    
-    bookings.append(booking_data)
-    BOOKINGS_FILE.write_text(json.dumps(bookings, indent=2))
-    
-    logger.info(f"NEW BOOKING: {booking_data['name']} | "
-                f"Clinic: {booking_data['clinic_name']} | "
-                f"Time: {booking_data['selected_slot']} | "
-                f"Treatment: {booking_data['treatment']}"
-                f"{' | EMERGENCY' if booking_data.get('is_emergency') else ''}")
-    
-    return booking_data
+            logger.warning(f"Could not read legacy bookings file, starting fresh: {e}")
+            return
+        tmp = self.path.with_suffix(".jsonl.tmp")
+        with open(tmp, "wb") as f:
+            for booking in bookings:
+                if booking.get("booking_id"):
+                    f.write(self._encode({"op": "put", "booking": booking}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        logger.info(f"Migrated {len(bookings)} bookings from {legacy_file.name} to {self.path.name}")
 
-def get_booking_by_id(booking_id: str) -> Optional[dict]:
-    """Look up a single booking by its unique booking_id."""
-    if not BOOKINGS_FILE.exists():
-        return None
-    try:
-        bookings = json.loads(BOOKINGS_FILE.read_text())
-        for booking in bookings:
-            if booking.get('booking_id') == booking_id:
-                return booking
-    except (json.JSONDecodeError, OSError) as e:
-        logger.warning(f"Error reading bookings file: {e}")
-    return None
+    def _rebuild_index(self) -> int:
+        """Scan the segment once at startup. A torn final line (crash mid-write)
+        is truncated away so the next append starts on a clean boundary."""
+        self._index = {}
+        self._patches = 0
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logger.warning(f"Truncating torn record at offset {offset} in {self.path.name}")
+                    os.ftruncate(self._fd, offset)
+                    break
+                try:
+                    self._index_record(json.loads(line), offset, len(line))
+                except (json.JSONDecodeError, KeyError) as e:
+                    logger.warning(f"Skipping corrupt booking record at offset {offset}: {e}")
+                offset += len(line)
+        return offset
 
-def update_booking(booking_id: str, updates: dict) -> bool:
-    """Apply partial updates to an existing booking record."""
-    if not BOOKINGS_FILE.exists():
-        return False
-    try:
-        bookings = json.loads(BOOKINGS_FILE.read_text())
-        for i, booking in enumerate(bookings):
-            if booking.get('booking_id') == booking_id:
-                bookings[i].update(updates)
-                BOOKINGS_FILE.write_text(json.dumps(bookings, indent=2))
-                return True
-    except (json.JSONDecodeError, OSError) as e:
-        logger.warning(f"Error updating booking {booking_id}: {e}")
-    return False
+    def _index_record(self, record: dict, offset: int, length: int):
+        if record["op"] == "put":
+            self._index[record["booking"]["booking_id"]] = [(offset, length)]
+        elif record["op"] == "patch" and record["booking_id"] in self._index:
+            self._index[record["booking_id"]].append((offset, length))
+            self._patches += 1
 
-# ============================================================
-# TRIAGE ENGINE
-# ============================================================
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        return (json.dumps(record, separators=(",", ":")) + "\n").encode()
 
-def get_urgent_self_care() -> List[str]:
-    return [
-        "Take over-the-counter pain relief (ibuprofen or paracetamol) as directed",
-        "Avoid very hot or cold foods and drinks",
-        "If swelling, apply a cold compress to the outside of your cheek",
-        "Do not place aspirin directly on gums",
-    ]
+    def _append(self, record: dict) -> tuple:
+        data = self._encode(record)
+        offset = self._size
+        os.write(self._fd, data)
+        self._size += len(data)
+        return offset, len(data)
 
-def get_moderate_self_care() -> List[str]:
-    return [
-        "Rinse with warm salt water (1/2 teaspoon salt in 8oz water)",
-        "Take over-the-counter pain relief if needed",
-        "Avoid chewing on the affected side",
-    ]
+    def _read(self, fd: int, locations: List[tuple]) -> dict:
+        booking = None
+        for offset, length in locations:
+            record = json.loads(os.pread(fd, length, offset))
+            if record["op"] == "put":
+                booking = record["booking"]
+            else:
+                booking.update(record["updates"])
+        return booking
+
+    # ---- public API ----
+
+    def put(self, booking: dict):
+        with self._lock:
+            location = self._append({"op": "put", "booking": booking})
+            self._index[booking["booking_id"]] = [location]
+
+    def get(self, booking_id: str) -> Optional[dict]:
+        with self._lock:
+            locations = self._index.get(booking_id)
+            if not locations:
+                return None
+            return self._read(self._fd, locations)
+
+    def patch(self, booking_id: str, updates: dict) -> bool:
+        with self._lock:
+            locations = self._index.get(booking_id)
+            if locations is None:
+                return False
+            locations.append(self._append({"op": "patch", "booking_id": booking_id, "updates": updates}))
+            self._patches += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def keys_after(self, after: Optional[str], limit: int) -> List[str]:
+        """The `limit` smallest booking_ids greater than `after`."""
+        with self._lock:
+            keys = [k for k in self._index if after is None or k > after]
+        return heapq.nsmallest(limit, keys)
+
+    def __iter__(self):
+        """Yield every booking in its merged (latest) state."""
+        with self._lock:
+            booking_ids = list(self._index)
+        for booking_id in booking_ids:
+            booking = self.get(booking_id)
+            if booking is not None:
+                yield booking
+
+    def needs_compaction(self) -> bool:
+        return (self._patches >= _BOOKING_COMPACT_MIN_PATCHES
+                and self._patches >= _BOOKING_COMPACT_RATIO * len(self._index))
+
+    def compact(self):
+        """Rewrite the segment with one merged "put" per booking.
+
+        The bulk copy runs without the lock against a snapshot of the index;
+        only the tail written meanwhile is copied under the lock before the
+        atomic rename, so writers are blocked for milliseconds, not seconds.
+        """
+        with self._lock:
+            snapshot = {bid: list(locs) for bid, locs in self._index.items()}
+            snapshot_end = self._size
+            read_fd = os.dup(self._fd)
+
+        tmp = self.path.with_suffix(".jsonl.compact")
+        new_index: Dict[str, List[tuple]] = {}
+        try:
+            with open(tmp, "wb") as out:
+                offset = 0
+                for booking_id, locations in snapshot.items():
+                    data = self._encode({"op": "put", "booking": self._read(read_fd, locations)})
+                    out.write(data)
+                    new_index[booking_id] = [(offset, len(data))]
+                    offset += len(data)
+
+                with self._lock:
+                    tail = os.pread(read_fd, self._size - snapshot_end, snapshot_end)
+                    out.write(tail)
+                    out.flush()
+                    os.fsync(out.fileno())
+                    self._index = new_index
+                    self._patches = 0
+                    for line in tail.splitlines(keepends=True):
+                        self._index_record(json.loads(line), offset, len(line))
+                        offset += len(line)
+                    os.replace(tmp, self.path)
+                    os.close(self._fd)
+                    self._fd = os.open(str(self.path), os.O_RDWR | os.O_APPEND, 0o600)
+                    self._size = offset
+        finally:
+            os.close(read_fd)
+            if tmp.exists():
+                tmp.unlink()
+        logger.info(f"Compacted booking log: {len(new_index)} bookings, {snapshot_end} -> {offset} bytes")
+
+async def booking_compactor(log: BookingLog):
+    """Background task (started from lifespan) that compacts the booking log
+    once enough patch records have piled up."""
+    while True:
+        await asyncio.sleep(_BOOKING_COMPACT_INTERVAL)
+        if log.needs_compaction():
+            try:
+                await run_io(log.compact)
+            except OSError as e:
+                logger.warning(f"Booking log compaction failed: {e}")
 
-def get_routine_self_care() -> List[str]:
-    return [
-        "Maintain normal brushing and flossing",
-        "Note any changes in symptoms",
-    ]
-  
 # ============================================================
-# PRSI TREATMENT BENEFIT PRE-SCREEN
-# Rules-based pre-check based on gov.ie published criteria.
-# Does not verify PRSI contribution counts — only the welfare.ie
-# eligibility checker or a Welfare Partners-registered provider can do that.
-# Returns a status that tells the patient whether their category typically
-# qualifies, so they know whether to ask the clinic to verify.
+# STORAGE REPOSITORY
+# Handlers talk to `repo`, never to files directly. Two backends:
+#   sqlite — WAL-mode database with per-column indexes (default)
+#   json   — legacy JSON files (bookings via the JSONL log above)
+# Select with STORAGE_BACKEND in .env.
 # ============================================================
 
-def assess_prsi_eligibility(check: "PRSIEligibilityCheck") -> dict:
-    """Run the rules tree from gov.ie Treatment Benefit Scheme criteria.
+class Repository(ABC):
+    """Persistence interface for bookings, briefs, consents and signatures.
+    A backend missing any abstract method fails when it is constructed."""
 
-    Returns one of:
-      - likely_eligible: category typically qualifies, confirm with clinic
-      - borderline:      category may qualify depending on contributions
-      - unlikely:        category typically doesn't qualify, may qualify under spouse
-    """
-    age = check.age_bracket
-    emp = check.employment_status
-    welfare_url = "https://services.mywelfare.ie/en/topics/health-disability-illness/eligibility-checker/"
+    name = "base"
 
-    # Under 21: low bar (39 contributions any time)
-    if age == "under_21":
-        if emp in ("paye", "self_employed"):
-            return {
-                "status": "likely_eligible",
-                "headline": "Likely eligible",
-                "message": "Most under-21s with any PAYE or self-employment history qualify with just 39 PRSI contributions.",
-                "next_steps": "Bring your PPS number and date of birth to the clinic. They'll verify with welfare.ie before your appointment.",
-                "verify_url": welfare_url
-            }
-        if emp == "dependent_spouse":
-            return {
-                "status": "borderline",
-                "headline": "May qualify under spouse / partner",
-                "message": "You may still qualify on your spouse, civil partner or cohabitant's PRSI record.",
-                "next_steps": "A dependant spouse application form is needed. Ask your clinic to issue one, or contact the Treatment Benefit Section directly.",
-                "verify_url": welfare_url
-            }
-        return {
-            "status": "borderline",
-            "headline": "Eligibility depends on contributions",
-            "message": "If you have any prior PAYE history, you may still qualify. 39 contributions any time is the bar.",
-            "next_steps": "Worth asking your clinic to verify — they can check via welfare.ie with your PPS and DOB.",
-            "verify_url": welfare_url
-        }
+    @abstractmethod
+    def save_booking(self, booking: dict):
+        ...
 
-    # 21-28: 39 contributions + governing contribution year requirement
-    if age == "21_28":
-        if emp in ("paye", "self_employed"):
-            return {
-                "status": "likely_eligible",
-                "headline": "Likely eligible",
-                "message": "Most 21–28-year-olds in current PAYE or self-employment qualify. 39 contributions plus contribution-year conditions are the bar.",
-                "next_steps": "Bring your PPS number and date of birth to the clinic. They'll verify with welfare.ie before your appointment.",
-                "verify_url": welfare_url
-            }
-        if emp == "dependent_spouse":
-            return {
-                "status": "borderline",
-                "headline": "May qualify under spouse / partner",
-                "message": "You may still qualify on your spouse, civil partner or cohabitant's PRSI record if they're a qualified contributor.",
-                "next_steps": "Ask your clinic for a dependant spouse application form, or contact the Treatment Benefit Section.",
-                "verify_url": welfare_url
-            }
-        return {
-            "status": "borderline",
-            "headline": "Eligibility depends on contributions",
-            "message": "If you've worked PAYE in the last few years, you may still qualify based on your governing contribution year.",
-            "next_steps": "Worth asking your clinic to verify — they can check via welfare.ie with your PPS and DOB.",
-            "verify_url": welfare_url
-        }
+    @abstractmethod
+    def get_booking(self, booking_id: str) -> Optional[dict]:
+        ...
 
-    # 29-65: 260 lifetime contributions + governing contribution year
+    @abstractmethod
+    def update_booking(self, booking_id: str, updates: dict) -> bool:
+        ...
+
+    @abstractmethod
+    def count_bookings(self) -> int:
+        ...
+
+    @abstractmethod
+    def save_brief(self, brief: dict):
+        ...
+
+    @abstractmethod
+    def get_brief(self, brief_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def append_consents(self, records: List[dict]):
+        ...
+
+    @abstractmethod
+    def save_signature(self, signature: dict):
+        ...
+
+    @abstractmethod
+    def find_bookings(self, clinic_id: int, since: str, until: str,
+                      after: Optional[str], limit: int) -> List[dict]:
+        """Up to `limit` of a clinic's bookings with since <= created_at < until
+        and booking_id > after, in booking_id order (cursor paging)."""
+
+    # ---- Bulk maintenance (key rotation) over "bookings" / "briefs" ----
+
+    @abstractmethod
+    def count_records(self, kind: str) -> int:
+        ...
+
+    @abstractmethod
+    def iter_records(self, kind: str, after: Optional[str], limit: int) -> List[tuple]:
+        """Up to `limit` (key, record) pairs with key > after, in key order.
+        Callers page through a store with a cursor; nothing is held open."""
+
+    @abstractmethod
+    def replace_fields(self, kind: str, changes: List[tuple]) -> int:
+        """Apply (key, expected, updates) changes: `updates` is set on a record
+        only if its fields still equal `expected` (compare-and-set, so a
+        concurrent edit is never overwritten). Returns how many applied."""
+
+    def close(self):
+        pass
+
+
+def _read_json_list(path: Path) -> List[dict]:
+    if not path.exists():
+        return []
+    try:
+        return json.loads(path.read_text())
+    except (json.JSONDecodeError, OSError) as e:
+        logger.warning(f"Could not read {path.name}, starting fresh: {e}")
+        return []
+
+
+class JsonFileRepository(Repository):
+    """Legacy backend: bookings in the JSONL log, consents in an append-only
+    JSONL file, briefs and signatures in JSON arrays that are rewritten on
+    each write. Kept for rollback and local dev."""
+
+    name = "json"
+
+    def __init__(self):
+        self.booking_log = BookingLog(BOOKINGS_LOG_FILE, legacy_file=BOOKINGS_FILE)
+        self._lock = threading.Lock()   # serialises read-modify-write of the JSON arrays
+
+    def _append_json(self, path: Path, records: List[dict]):
+        with self._lock:
+            items = _read_json_list(path)
+            items.extend(records)
+            path.write_text(json.dumps(items, indent=2))
+
+    def save_booking(self, booking: dict):
+        self.booking_log.put(booking)
+
+    def get_booking(self, booking_id: str) -> Optional[dict]:
+        return self.booking_log.get(booking_id)
+
+    def update_booking(self, booking_id: str, updates: dict) -> bool:
+        return self.booking_log.patch(booking_id, updates)
+
+    def count_bookings(self) -> int:
+        return len(self.booking_log)
+
+    def save_brief(self, brief: dict):
+        self._append_json(BRIEFS_FILE, [brief])
+
+    def get_brief(self, brief_id: str) -> Optional[dict]:
+        for brief in _read_json_list(BRIEFS_FILE):
+            if brief.get("brief_id") == brief_id:
+                return brief
+        return None
+
+    def append_consents(self, records: List[dict]):
+        # Append-only: cost is O(batch), never O(history)
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records).encode()
+        with self._lock:
+            with open(CONSENTS_LOG_FILE, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def save_signature(self, signature: dict):
+        self._append_json(SIGNATURES_FILE, [signature])
+
+    def find_bookings(self, clinic_id: int, since: str, until: str,
+                      after: Optional[str], limit: int) -> List[dict]:
+        # No secondary index here: scan the log in key order until the page fills
+        found = []
+        while len(found) < limit:
+            keys = self.booking_log.keys_after(after, 500)
+            if not keys:
+                break
+            for key in keys:
+                after = key
+                booking = self.booking_log.get(key)
+                if (booking and booking.get("clinic_id") == clinic_id
+                        and since <= booking.get("created_at", "") < until):
+                    found.append(booking)
+                    if len(found) == limit:
+                        break
+        return found
+
+    # Legacy backend: bookings page through the log index; briefs.json has
+    # to be loaded whole, so only the sqlite backend rotates in constant memory.
+
+    def count_records(self, kind: str) -> int:
+        if kind == "bookings":
+            return len(self.booking_log)
+        return len(_read_json_list(BRIEFS_FILE))
+
+    def iter_records(self, kind: str, after: Optional[str], limit: int) -> List[tuple]:
+        if kind == "bookings":
+            keys = self.booking_log.keys_after(after, limit)
+            return [(k, b) for k in keys if (b := self.booking_log.get(k)) is not None]
+        briefs = [b for b in _read_json_list(BRIEFS_FILE) if after is None or b["brief_id"] > after]
+        return [(b["brief_id"], b) for b in heapq.nsmallest(limit, briefs, key=lambda b: b["brief_id"])]
+
+    def replace_fields(self, kind: str, changes: List[tuple]) -> int:
+        applied = 0
+        if kind == "bookings":
+            for key, expected, updates in changes:
+                current = self.booking_log.get(key)
+                if current is not None and all(current.get(f) == v for f, v in expected.items()):
+                    applied += self.booking_log.patch(key, updates)
+            return applied
+        with self._lock:
+            briefs = _read_json_list(BRIEFS_FILE)
+            by_id = {b.get("brief_id"): b for b in briefs}
+            for key, expected, updates in changes:
+                brief = by_id.get(key)
+                if brief is not None and all(brief.get(f) == v for f, v in expected.items()):
+                    brief.update(updates)
+                    applied += 1
+            if applied:
+                BRIEFS_FILE.write_text(json.dumps(briefs, indent=2))
+        return applied
+
+    def close(self):
+        self.booking_log.close()
+
+
+def _sqlite_connect(path: Path) -> sqlite3.Connection:
+    """Autocommit connection in WAL mode (readers never block the writer)."""
+    conn = sqlite3.connect(str(path), timeout=5.0, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class SqliteRepository(Repository):
+    """SQLite backend in WAL mode: readers never block the writer, and each
+    write touches one row. The full record is stored as JSON in `data`;
+    columns that are searched on are duplicated and indexed."""
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bookings (
+            booking_id TEXT PRIMARY KEY,
+            clinic_id  INTEGER,
+            created_at TEXT,
+            data       TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_bookings_clinic_id ON bookings (clinic_id);
+        CREATE INDEX IF NOT EXISTS idx_bookings_created_at ON bookings (created_at);
+        CREATE INDEX IF NOT EXISTS idx_bookings_clinic_booking ON bookings (clinic_id, booking_id);
+
+        CREATE TABLE IF NOT EXISTS briefs (
+            brief_id   TEXT PRIMARY KEY,
+            clinic_id  INTEGER,
+            created_at TEXT,
+            data       TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_briefs_clinic_id ON briefs (clinic_id);
+        CREATE INDEX IF NOT EXISTS idx_briefs_created_at ON briefs (created_at);
+
+        CREATE TABLE IF NOT EXISTS consents (
+            consent_id TEXT,
+            user_hash  TEXT,
+            created_at TEXT,
+            data       TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_consents_user_hash ON consents (user_hash);
+        CREATE INDEX IF NOT EXISTS idx_consents_created_at ON consents (created_at);
+
+        CREATE TABLE IF NOT EXISTS signatures (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id TEXT,
+            created_at TEXT,
+            data       TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_signatures_booking_id ON signatures (booking_id);
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()   # sqlite3 connections are per-thread
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        is_new = not path.exists()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        if is_new:
+            self._import_legacy()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _sqlite_connect(self.path)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _import_legacy(self):
+        """First start on SQLite: pull in whatever the JSON backend left behind."""
+        bookings = []
+        if BOOKINGS_LOG_FILE.exists():
+            log = BookingLog(BOOKINGS_LOG_FILE)
+            bookings = list(log)
+            log.close()
+        elif BOOKINGS_FILE.exists():
+            bookings = _read_json_list(BOOKINGS_FILE)
+        briefs = _read_json_list(BRIEFS_FILE)
+        consents = _read_json_list(CONSENTS_FILE)
+        if CONSENTS_LOG_FILE.exists():
+            with open(CONSENTS_LOG_FILE, "rb") as f:
+                consents.extend(json.loads(line) for line in f if line.endswith(b"\n"))
+        signatures = _read_json_list(SIGNATURES_FILE)
+        if not (bookings or briefs or consents or signatures):
+            return
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            for b in bookings:
+                self._insert_booking(conn, b)
+            for b in briefs:
+                self._insert_brief(conn, b)
+            self._insert_consents(conn, consents)
+            for s in signatures:
+                self._insert_signature(conn, s)
+        logger.info(f"Imported legacy JSON data into {self.path.name}: {len(bookings)} bookings, "
+                    f"{len(briefs)} briefs, {len(consents)} consents, {len(signatures)} signatures")
+
+    # ---- row helpers ----
+
+    @staticmethod
+    def _insert_booking(conn, booking: dict):
+        conn.execute(
+            "INSERT OR REPLACE INTO bookings (booking_id, clinic_id, created_at, data) VALUES (?, ?, ?, ?)",
+            (booking["booking_id"], booking.get("clinic_id"), booking.get("created_at"), json.dumps(booking)))
+
+    @staticmethod
+    def _insert_brief(conn, brief: dict):
+        conn.execute(
+            "INSERT OR REPLACE INTO briefs (brief_id, clinic_id, created_at, data) VALUES (?, ?, ?, ?)",
+            (brief["brief_id"], brief.get("clinic_id"), brief.get("generated_at"), json.dumps(brief)))
+
+    @staticmethod
+    def _insert_consents(conn, records: List[dict]):
+        conn.executemany(
+            "INSERT INTO consents (consent_id, user_hash, created_at, data) VALUES (?, ?, ?, ?)",
+            [(r.get("consent_id"), r.get("user_hash"), r.get("timestamp"), json.dumps(r)) for r in records])
+
+    @staticmethod
+    def _insert_signature(conn, signature: dict):
+        conn.execute(
+            "INSERT INTO signatures (booking_id, created_at, data) VALUES (?, ?, ?)",
+            (signature.get("booking_id"), signature.get("created_at"), json.dumps(signature)))
+
+    # ---- Repository API ----
+
+    def save_booking(self, booking: dict):
+        self._insert_booking(self._conn(), booking)
+
+    def get_booking(self, booking_id: str) -> Optional[dict]:
+        row = self._conn().execute(
+            "SELECT data FROM bookings WHERE booking_id = ?", (booking_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update_booking(self, booking_id: str, updates: dict) -> bool:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM bookings WHERE booking_id = ?", (booking_id,)).fetchone()
+            if not row:
+                return False
+            booking = json.loads(row[0])
+            booking.update(updates)
+            conn.execute("UPDATE bookings SET data = ? WHERE booking_id = ?", (json.dumps(booking), booking_id))
+        return True
+
+    def count_bookings(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM bookings").fetchone()[0]
+
+    def save_brief(self, brief: dict):
+        self._insert_brief(self._conn(), brief)
+
+    def get_brief(self, brief_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT data FROM briefs WHERE brief_id = ?", (brief_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def append_consents(self, records: List[dict]):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            self._insert_consents(conn, records)
+
+    def save_signature(self, signature: dict):
+        self._insert_signature(self._conn(), signature)
+
+    def find_bookings(self, clinic_id: int, since: str, until: str,
+                      after: Optional[str], limit: int) -> List[dict]:
+        rows = self._conn().execute(
+            "SELECT data FROM bookings WHERE clinic_id = ? AND booking_id > ? "
+            "AND created_at >= ? AND created_at < ? ORDER BY booking_id LIMIT ?",
+            (clinic_id, after or "", since, until, limit)).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    _KEY_COLUMNS = {"bookings": "booking_id", "briefs": "brief_id"}
+
+    def count_records(self, kind: str) -> int:
+        return self._conn().execute(f"SELECT COUNT(*) FROM {kind}").fetchone()[0]
+
+    def iter_records(self, kind: str, after: Optional[str], limit: int) -> List[tuple]:
+        key = self._KEY_COLUMNS[kind]
+        rows = self._conn().execute(
+            f"SELECT {key}, data FROM {kind} WHERE {key} > ? ORDER BY {key} LIMIT ?",
+            (after or "", limit)).fetchall()
+        return [(k, json.loads(data)) for k, data in rows]
+
+    def replace_fields(self, kind: str, changes: List[tuple]) -> int:
+        key_column = self._KEY_COLUMNS[kind]
+        applied = 0
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for key, expected, updates in changes:
+                row = conn.execute(f"SELECT data FROM {kind} WHERE {key_column} = ?", (key,)).fetchone()
+                if not row:
+                    continue
+                record = json.loads(row[0])
+                if any(record.get(f) != v for f, v in expected.items()):
+                    continue
+                record.update(updates)
+                conn.execute(f"UPDATE {kind} SET data = ? WHERE {key_column} = ?", (json.dumps(record), key))
+                applied += 1
+        return applied
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def create_repository(backend: str) -> Repository:
+    if backend == "json":
+        return JsonFileRepository()
+    if backend != "sqlite":
+        logger.warning(f"Unknown STORAGE_BACKEND {backend!r} — falling back to sqlite")
+    return SqliteRepository(DATABASE_FILE)
+
+repo = create_repository(STORAGE_BACKEND)
+
+# ============================================================
+# SHARED STATE — rate limits and live slot status
+# Anything that must agree across uvicorn workers lives behind
+# `shared_state`. Three backends, picked with SHARED_STATE_BACKEND:
+#   memory  per-process (fine for a single worker; the default)
+#   sqlite  SHARED_STATE_FILE, shared by every worker on the host
+#   redis   any Redis-protocol server (Redis, Valkey, KeyDB) at REDIS_URL
+# Rate limiting keeps the same token-bucket (GCRA) policy everywhere;
+# only where the per-client "full at" timestamp lives changes.
+# ============================================================
+
+class SharedStateError(Exception):
+    """The shared state store could not be reached or rejected a command."""
+
+
+class SharedState:
+    name = "memory"
+    blocking = False   # True: calls do I/O and must run via run_io
+
+    def __init__(self):
+        self.limiter = TokenBucketLimiter(_RATE_LIMIT_MAX, _RATE_LIMIT_WINDOW)
+        self._slots: Dict[int, dict] = {}
+
+    def allow(self, client: str) -> bool:
+        return self.limiter.allow(client, _time.monotonic())
+
+    def set_slot(self, clinic_id: int, status: dict):
+        self._slots[clinic_id] = status
+
+    def slots(self) -> Dict[int, dict]:
+        return dict(self._slots)
+
+    def close(self):
+        pass
+
+
+class SqliteSharedState(SharedState):
+    """Shared by every worker process on one host through a WAL database.
+    The whole GCRA check is a single UPSERT, so it is atomic without an
+    explicit transaction: no row comes back when the bucket is empty."""
+    name = "sqlite"
+    blocking = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            client  TEXT PRIMARY KEY,
+            full_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_rate_limits_full_at ON rate_limits (full_at);
+        CREATE TABLE IF NOT EXISTS slot_status (
+            clinic_id INTEGER PRIMARY KEY,
+            data      TEXT NOT NULL
+        );
+    """
+    ALLOW_SQL = """
+        INSERT INTO rate_limits (client, full_at) VALUES (:client, :now + :interval)
+        ON CONFLICT (client) DO UPDATE SET full_at = max(full_at, :now) + :interval
+            WHERE full_at - :now <= :burst
+        RETURNING full_at
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.interval = _RATE_LIMIT_WINDOW / _RATE_LIMIT_MAX
+        self.burst = _RATE_LIMIT_WINDOW - self.interval
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _sqlite_connect(self.path)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def allow(self, client: str) -> bool:
+        now = _time.time()   # wall clock: monotonic clocks differ between processes
+        conn = self._conn()
+        row = conn.execute(self.ALLOW_SQL, {"client": client, "now": now, "interval": self.interval,
+                                            "burst": self.burst}).fetchone()
+        if now - self._last_sweep >= _RATE_LIMIT_SWEEP_INTERVAL:
+            self._last_sweep = now
+            conn.execute("DELETE FROM rate_limits WHERE full_at <= ?", (now,))
+        return row is not None
+
+    def set_slot(self, clinic_id: int, status: dict):
+        self._conn().execute("INSERT OR REPLACE INTO slot_status (clinic_id, data) VALUES (?, ?)",
+                             (clinic_id, json.dumps(status)))
+
+    def slots(self) -> Dict[int, dict]:
+        rows = self._conn().execute("SELECT clinic_id, data FROM slot_status").fetchall()
+        return {clinic_id: json.loads(data) for clinic_id, data in rows}
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class RespClient:
+    """Minimal Redis-protocol (RESP2) client with a small connection pool.
+    Covers what SharedState needs, so no redis package is required."""
+
+    def __init__(self, url: str, timeout: float = 2.0, max_idle: int = IO_WORKERS):
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise SharedStateError(f"REDIS_URL must start with redis:// (got {parsed.scheme!r})")
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> tuple:
+        try:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+        except OSError as e:
+            raise SharedStateError(f"cannot connect to {self.address[0]}:{self.address[1]}: {e}")
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile("rb"))
+        if self.password:
+            self._roundtrip(conn, ("AUTH", self.password))
+        if self.db:
+            self._roundtrip(conn, ("SELECT", self.db))
+        return conn
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    def _read_reply(self, f):
+        line = f.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed mid-reply")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            return SharedStateError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = f.read(size + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            size = int(payload)
+            return None if size < 0 else [self._read_reply(f) for _ in range(size)]
+        raise ConnectionError(f"unexpected RESP type byte {kind!r}")
+
+    def _roundtrip(self, conn: tuple, args):
+        sock, f = conn
+        sock.sendall(self._encode(args))
+        reply = self._read_reply(f)
+        if isinstance(reply, SharedStateError):
+            raise reply
+        return reply
+
+    def execute(self, *args):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            reply = self._roundtrip(conn, args)
+        except SharedStateError:
+            self._release(conn)   # error reply: the connection itself is fine
+            raise
+        except (OSError, ConnectionError, ValueError) as e:
+            conn[0].close()
+            raise SharedStateError(f"{args[0]} failed: {e}")
+        self._release(conn)
+        return reply
+
+    def _release(self, conn: tuple):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn[0].close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock, _ in idle:
+            sock.close()
+
+
+class RedisSharedState(SharedState):
+    """Shared across hosts. The GCRA check runs server-side as a Lua script,
+    and each key expires once its bucket is full again, so idle clients
+    clean themselves up."""
+    name = "redis"
+    blocking = True
+
+    KEY_PREFIX = "smileagent:"
+    GCRA_SCRIPT = """
+        local now, interval, burst = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local full_at = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+        if full_at < now then full_at = now end
+        if full_at - now > burst then return 0 end
+        full_at = full_at + interval
+        redis.call('SET', KEYS[1], tostring(full_at), 'PX', math.ceil((full_at - now) * 1000))
+        return 1
+    """
+
+    def __init__(self, url: str):
+        self.client = RespClient(url)
+        self.interval = _RATE_LIMIT_WINDOW / _RATE_LIMIT_MAX
+        self.burst = _RATE_LIMIT_WINDOW - self.interval
+        self._script_sha = hashlib.sha1(self.GCRA_SCRIPT.encode()).hexdigest()
+        self.client.execute("PING")   # fail at startup, not on the first request
+
+    def allow(self, client: str) -> bool:
+        args = (1, f"{self.KEY_PREFIX}rl:{client}", repr(_time.time()), repr(self.interval), repr(self.burst))
+        try:
+            return self.client.execute("EVALSHA", self._script_sha, *args) == 1
+        except SharedStateError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            return self.client.execute("EVAL", self.GCRA_SCRIPT, *args) == 1
+
+    def set_slot(self, clinic_id: int, status: dict):
+        self.client.execute("HSET", f"{self.KEY_PREFIX}slots", clinic_id, json.dumps(status))
+
+    def slots(self) -> Dict[int, dict]:
+        flat = self.client.execute("HGETALL", f"{self.KEY_PREFIX}slots") or []
+        return {int(flat[i]): json.loads(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+    def close(self):
+        self.client.close()
+
+
+def create_shared_state(backend: str) -> SharedState:
+    if backend == "sqlite":
+        return SqliteSharedState(SHARED_STATE_FILE)
+    if backend == "redis":
+        return RedisSharedState(REDIS_URL)
+    if backend != "memory":
+        logger.warning(f"Unknown SHARED_STATE_BACKEND {backend!r} — falling back to memory")
+    return SharedState()
+
+shared_state = create_shared_state(SHARED_STATE_BACKEND)
+
+async def shared_call(fn, *args):
+    """Call a shared_state method, off the event loop when it does I/O."""
+    if shared_state.blocking:
+        return await run_io(fn, *args)
+    return fn(*args)
+
+# ============================================================
+# ASYNC EXECUTION LAYER
+# async handlers must never block the event loop. Storage and Fernet work
+# go to a bounded thread pool; ReportLab rendering and photo decoding
+# (CPU-bound, hold the GIL) go to a process pool so they can't stall
+# triage requests. Both pools are created on first use and shut down with
+# the app, so a later lifespan in the same process (test clients, reloads)
+# gets fresh ones.
+# ============================================================
+
+_io_executor: Optional[ThreadPoolExecutor] = None
+_pdf_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def get_io_executor() -> ThreadPoolExecutor:
+    """Thread pool for blocking storage / crypto work, created on first use."""
+    global _io_executor
+    if _io_executor is None:
+        with _executor_lock:
+            if _io_executor is None:
+                _io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="smileagent-io")
+    return _io_executor
+
+async def run_io(fn, *args, **kwargs):
+    """Run blocking storage / crypto work on the I/O thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_io_executor(), functools.partial(fn, *args, **kwargs))
+
+def get_pdf_executor() -> Executor:
+    """Process pool for PDF rendering, created on first use.
+    PDF_WORKERS=0 renders on the I/O thread pool instead (e.g. on hosts
+    where forking workers is not allowed)."""
+    global _pdf_executor
+    if PDF_WORKERS <= 0:
+        return get_io_executor()
+    if _pdf_executor is None:
+        _pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    return _pdf_executor
+
+async def run_pdf(fn, *args):
+    """Run a module-level PDF function (it must be picklable) on the PDF pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_pdf_executor(), fn, *args)
+
+async def run_image(fn, *args):
+    """Run a module-level image function on the same process pool as PDFs."""
+    return await run_pdf(fn, *args)
+
+def shutdown_executors():
+    global _io_executor, _pdf_executor
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=True, cancel_futures=True)
+        _pdf_executor = None
+    with _executor_lock:
+        io_executor, _io_executor = _io_executor, None
+    if io_executor is not None:
+        io_executor.shutdown(wait=True)
+
+# ============================================================
+# HELPER FUNCTIONS
+# ============================================================
+
+def get_clinic_by_id(clinic_id: int):
+    return get_registry().by_id.get(clinic_id)
+
+def calculate_med2_relief(gross_cost: float) -> dict:
+    relief_amount = gross_cost * 0.20
+    net_cost = gross_cost - relief_amount
+    return {
+        "gross_cost": round(gross_cost, 2),
+        "relief_rate": 0.20,
+        "relief_amount": round(relief_amount, 2),
+        "net_cost": round(net_cost, 2)
+    }
+
+def number_to_words(amount: int) -> str:
+    ones = ['', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine',
+            'ten', 'eleven', 'twelve', 'thirteen', 'fourteen', 'fifteen', 'sixteen',
+            'seventeen', 'eighteen', 'nineteen']
+    tens = ['', '', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy', 'eighty', 'ninety']
+    
+    if amount < 20:
+        return ones[amount]
+    elif amount < 100:
+        return tens[amount // 10] + ('' if amount % 10 == 0 else '-' + ones[amount % 10])
+    elif amount < 1000:
+        return ones[amount // 100] + ' hundred' + ('' if amount % 100 == 0 else ' and ' + number_to_words(amount % 100))
+    elif amount < 10000:
+        return number_to_words(amount // 1000) + ' thousand' + ('' if amount % 1000 == 0 else ' ' + number_to_words(amount % 1000))
+    else:
+        return str(amount)
+
+def save_booking(booking_data: dict) -> dict:
+    """Persist a new booking via the storage repository and assign a unique ID."""
+    booking_data['booking_id'] = datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4())[:4]
+    booking_data['created_at'] = datetime.now().isoformat()
+    booking_data['status'] = 'confirmed'
+    booking_data['signature_status'] = 'pending'
+    
+    repo.save_booking(booking_data)
+    
+    logger.info(f"NEW BOOKING: {booking_data['name']} | "
+                f"Clinic: {booking_data['clinic_name']} | "
+                f"Time: {booking_data['selected_slot']} | "
+                f"Treatment: {booking_data['treatment']}"
+                f"{' | EMERGENCY' if booking_data.get('is_emergency') else ''}")
+    
+    return booking_data
+
+def get_booking_by_id(booking_id: str) -> Optional[dict]:
+    """Look up a single booking by its unique booking_id."""
+    try:
+        return repo.get_booking(booking_id)
+    except (json.JSONDecodeError, OSError, sqlite3.Error) as e:
+        logger.warning(f"Error reading booking {booking_id}: {e}")
+    return None
+
+def update_booking(booking_id: str, updates: dict) -> bool:
+    """Apply partial updates to an existing booking record (appended as a delta)."""
+    try:
+        return repo.update_booking(booking_id, updates)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Error updating booking {booking_id}: {e}")
+    return False
+
+# ============================================================
+# TRIAGE ENGINE
+# ============================================================
+
+def get_urgent_self_care() -> List[str]:
+    return [
+        "Take over-the-counter pain relief (ibuprofen or paracetamol) as directed",
+        "Avoid very hot or cold foods and drinks",
+        "If swelling, apply a cold compress to the outside of your cheek",
+        "Do not place aspirin directly on gums",
+    ]
+
+def get_moderate_self_care() -> List[str]:
+    return [
+        "Rinse with warm salt water (1/2 teaspoon salt in 8oz water)",
+        "Take over-the-counter pain relief if needed",
+        "Avoid chewing on the affected side",
+    ]
+
+def get_routine_self_care() -> List[str]:
+    return [
+        "Maintain normal brushing and flossing",
+        "Note any changes in symptoms",
+    ]
+  
+# ============================================================
+# PRSI TREATMENT BENEFIT PRE-SCREEN
+# Rules-based pre-check based on gov.ie published criteria.
+# Does not verify PRSI contribution counts — only the welfare.ie
+# eligibility checker or a Welfare Partners-registered provider can do that.
+# Returns a status that tells the patient whether their category typically
+# qualifies, so they know whether to ask the clinic to verify.
+# ============================================================
+
+def assess_prsi_eligibility(check: "PRSIEligibilityCheck") -> dict:
+    """Run the rules tree from gov.ie Treatment Benefit Scheme criteria.
+
+    Returns one of:
+      - likely_eligible: category typically qualifies, confirm with clinic
+      - borderline:      category may qualify depending on contributions
+      - unlikely:        category typically doesn't qualify, may qualify under spouse
+    """
+    age = check.age_bracket
+    emp = check.employment_status
+    welfare_url = "https://services.mywelfare.ie/en/topics/health-disability-illness/eligibility-checker/"
+
+    # Under 21: low bar (39 contributions any time)
+    if age == "under_21":
+        if emp in ("paye", "self_employed"):
+            return {
+                "status": "likely_eligible",
+                "headline": "Likely eligible",
+                "message": "Most under-21s with any PAYE or self-employment history qualify with just 39 PRSI contributions.",
+                "next_steps": "Bring your PPS number and date of birth to the clinic. They'll verify with welfare.ie before your appointment.",
+                "verify_url": welfare_url
+            }
+        if emp == "dependent_spouse":
+            return {
+                "status": "borderline",
+                "headline": "May qualify under spouse / partner",
+                "message": "You may still qualify on your spouse, civil partner or cohabitant's PRSI record.",
+                "next_steps": "A dependant spouse application form is needed. Ask your clinic to issue one, or contact the Treatment Benefit Section directly.",
+                "verify_url": welfare_url
+            }
+        return {
+            "status": "borderline",
+            "headline": "Eligibility depends on contributions",
+            "message": "If you have any prior PAYE history, you may still qualify. 39 contributions any time is the bar.",
+            "next_steps": "Worth asking your clinic to verify — they can check via welfare.ie with your PPS and DOB.",
+            "verify_url": welfare_url
+        }
+
+    # 21-28: 39 contributions + governing contribution year requirement
+    if age == "21_28":
+        if emp in ("paye", "self_employed"):
+            return {
+                "status": "likely_eligible",
+                "headline": "Likely eligible",
+                "message": "Most 21–28-year-olds in current PAYE or self-employment qualify. 39 contributions plus contribution-year conditions are the bar.",
+                "next_steps": "Bring your PPS number and date of birth to the clinic. They'll verify with welfare.ie before your appointment.",
+                "verify_url": welfare_url
+            }
+        if emp == "dependent_spouse":
+            return {
+                "status": "borderline",
+                "headline": "May qualify under spouse / partner",
+                "message": "You may still qualify on your spouse, civil partner or cohabitant's PRSI record if they're a qualified contributor.",
+                "next_steps": "Ask your clinic for a dependant spouse application form, or contact the Treatment Benefit Section.",
+                "verify_url": welfare_url
+            }
+        return {
+            "status": "borderline",
+            "headline": "Eligibility depends on contributions",
+            "message": "If you've worked PAYE in the last few years, you may still qualify based on your governing contribution year.",
+            "next_steps": "Worth asking your clinic to verify — they can check via welfare.ie with your PPS and DOB.",
+            "verify_url": welfare_url
+        }
+
+    # 29-65: 260 lifetime contributions + governing contribution year
     if age == "29_65":
         if emp in ("paye", "self_employed"):
             return {
@@ -1383,26 +1986,237 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     c = 2 * atan2(sqrt(a), sqrt(1-a))
     return R * c
 
-def check_if_open(hours: dict) -> bool:
-    """Check if a clinic is currently open based on its hours dict.
-    Returns False if the clinic is closed today or hours can't be parsed."""
-    now = datetime.now()
-    day_map = {0: 'mon', 1: 'tue', 2: 'wed', 3: 'thu', 4: 'fri', 5: 'sat', 6: 'sun'}
-    day = day_map.get(now.weekday(), 'mon')
-    day_hours = hours.get(day)
-    if day_hours is None:
-        return False
-    try:
-        open_time, close_time = day_hours.split("-")
-        current_time = now.strftime("%H:%M")
-        return open_time <= current_time <= close_time
-    except (ValueError, AttributeError):
-        return False
+# ---- Spatial index ----
+# Clinics are bucketed into a lat/lng grid when the registry loads. A search
+# only visits the cells overlapping its max_distance_km bounding box, so the
+# exact haversine runs on a handful of nearby clinics instead of the whole
+# national list.
+_GRID_CELL_DEG = 0.1           # ~11 km north-south, ~6.7 km east-west at Irish latitudes
+_KM_PER_DEG_LAT = 111.32
 
-def match_clinics_for_emergency(search: EmergencyClinicSearch) -> List[dict]:
-    matches = []
-    
-    for clinic in CLINICS:
+class ClinicSpatialIndex:
+    """Grid-bucket index over clinic coordinates with incremental updates."""
+
+    def __init__(self, clinics: List[dict], cell_deg: float = _GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._cells: Dict[tuple, Dict[int, dict]] = defaultdict(dict)
+        self._cell_of: Dict[int, tuple] = {}
+        for clinic in clinics:
+            self.add(clinic)
+
+    def _cell(self, lat: float, lng: float) -> tuple:
+        return (int(lat // self.cell_deg), int(lng // self.cell_deg))
+
+    def __len__(self) -> int:
+        return len(self._cell_of)
+
+    def add(self, clinic: dict):
+        """Insert or move a clinic (an existing id is replaced)."""
+        self.remove(clinic["id"])
+        cell = self._cell(clinic["coordinates"]["lat"], clinic["coordinates"]["lng"])
+        self._cells[cell][clinic["id"]] = clinic
+        self._cell_of[clinic["id"]] = cell
+
+    def remove(self, clinic_id: int):
+        cell = self._cell_of.pop(clinic_id, None)
+        if cell is not None:
+            bucket = self._cells[cell]
+            bucket.pop(clinic_id, None)
+            if not bucket:
+                del self._cells[cell]
+
+    def copy(self) -> "ClinicSpatialIndex":
+        clone = ClinicSpatialIndex([], self.cell_deg)
+        clone._cells.update((cell, dict(bucket)) for cell, bucket in self._cells.items())
+        clone._cell_of = dict(self._cell_of)
+        return clone
+
+    def sync(self, clinics: List[dict]):
+        """Apply a changed clinic list incrementally: removed clinics are
+        dropped, moved or new ones re-bucketed, the rest refreshed in place."""
+        current = {c["id"]: c for c in clinics}
+        for clinic_id in list(self._cell_of):
+            if clinic_id not in current:
+                self.remove(clinic_id)
+        for clinic_id, clinic in current.items():
+            cell = self._cell(clinic["coordinates"]["lat"], clinic["coordinates"]["lng"])
+            if self._cell_of.get(clinic_id) == cell:
+                self._cells[cell][clinic_id] = clinic
+            else:
+                self.add(clinic)
+
+    def candidates(self, lat: float, lng: float, radius_km: float) -> List[dict]:
+        """Clinics in the grid cells covering the radius' bounding box.
+        A superset of the true matches — callers still check exact distance."""
+        dlat = radius_km / _KM_PER_DEG_LAT
+        # Longitude degrees shrink with latitude; use the edge nearest a pole
+        max_lat = min(abs(lat) + dlat, 89.9)
+        dlng = radius_km / (_KM_PER_DEG_LAT * cos(radians(max_lat)))
+        lat_lo, lng_lo = self._cell(lat - dlat, lng - dlng)
+        lat_hi, lng_hi = self._cell(lat + dlat, lng + dlng)
+
+        # Huge radius: scanning every occupied cell is cheaper than the box
+        if (lat_hi - lat_lo + 1) * (lng_hi - lng_lo + 1) > len(self._cells):
+            return [c for bucket in self._cells.values() for c in bucket.values()]
+
+        found = []
+        for i in range(lat_lo, lat_hi + 1):
+            for j in range(lng_lo, lng_hi + 1):
+                bucket = self._cells.get((i, j))
+                if bucket:
+                    found.extend(bucket.values())
+        return found
+
+# ---- Opening hours ----
+# Each clinic's "hours" dict is compiled once (at registry load) into sorted
+# minute-of-week intervals in Europe/Dublin local time, Monday 00:00 = 0.
+# "Open now" is then a bisect, and the same arrays give closes_at /
+# next_open_at. A search reads the clock once and reuses it for every clinic.
+DUBLIN_TZ = ZoneInfo("Europe/Dublin")
+_DAY_KEYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+_MINUTES_PER_DAY = 24 * 60
+_MINUTES_PER_WEEK = 7 * _MINUTES_PER_DAY
+
+def dublin_now() -> datetime:
+    return datetime.now(DUBLIN_TZ)
+
+def minute_of_week(moment: datetime) -> int:
+    return moment.weekday() * _MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+class SearchClock:
+    """One clock read shared by every clinic in a search. Converting a
+    minute-of-week back to a timestamp is memoised, since most clinics
+    share the same opening/closing times."""
+
+    __slots__ = ("now", "mow", "_base", "_iso")
+
+    def __init__(self, now: Optional[datetime] = None):
+        self.now = now or dublin_now()
+        self.mow = minute_of_week(self.now)
+        self._base = self.now.replace(second=0, microsecond=0, fold=0)
+        self._iso: Dict[int, str] = {}
+
+    def iso_at(self, target_mow: int) -> str:
+        iso = self._iso.get(target_mow)
+        if iso is None:
+            # Wall-clock arithmetic on an aware datetime keeps "09:00" meaning
+            # 09:00 local across a DST change; the offset is recomputed.
+            iso = (self._base + timedelta(minutes=target_mow - self.mow)).isoformat()
+            self._iso[target_mow] = iso
+        return iso
+
+def _parse_hhmm(value: str) -> int:
+    hours, minutes = value.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60):
+        raise ValueError(f"bad time {value!r}")
+    return hours * 60 + minutes
+
+class OpeningSchedule:
+    """Weekly opening intervals [start, end) as parallel sorted lists."""
+
+    __slots__ = ("starts", "ends")
+
+    def __init__(self, intervals: List[tuple]):
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [s for s, _ in merged]
+        self.ends = [e for _, e in merged]
+
+    @classmethod
+    def from_hours(cls, hours: dict, clinic_id=None) -> "OpeningSchedule":
+        """Compile {"mon": "09:00-18:00", ..., "sun": None}. Overnight ranges
+        ("20:00-02:00") roll into the next day, Sunday night into Monday."""
+        intervals = []
+        for day, key in enumerate(_DAY_KEYS):
+            day_hours = (hours or {}).get(key)
+            if not day_hours:
+                continue
+            try:
+                open_str, close_str = day_hours.split("-")
+                start, end = _parse_hhmm(open_str), _parse_hhmm(close_str)
+            except (ValueError, AttributeError) as e:
+                logger.warning(f"Clinic {clinic_id}: ignoring unparseable hours {key}={day_hours!r}: {e}")
+                continue
+            if end <= start:
+                end += _MINUTES_PER_DAY
+            start += day * _MINUTES_PER_DAY
+            end += day * _MINUTES_PER_DAY
+            if end > _MINUTES_PER_WEEK:
+                intervals.append((0, end - _MINUTES_PER_WEEK))
+                end = _MINUTES_PER_WEEK
+            intervals.append((start, end))
+        return cls(intervals)
+
+    def status(self, clock: SearchClock) -> tuple:
+        """(is_open, closes_at, next_open_at) at the clock's time.
+        Times are ISO strings (Europe/Dublin offset) or None."""
+        if not self.starts:
+            return False, None, None
+        mow = clock.mow
+        i = bisect_right(self.starts, mow) - 1
+        if i >= 0 and mow < self.ends[i]:
+            end = self.ends[i]
+            # Open until the end of Sunday and again from Monday 00:00: carry on
+            if end == _MINUTES_PER_WEEK and self.starts[0] == 0:
+                end += self.ends[0]
+            return True, clock.iso_at(end), None
+        j = i + 1
+        start = self.starts[j] if j < len(self.starts) else self.starts[0] + _MINUTES_PER_WEEK
+        return False, None, clock.iso_at(start)
+
+# ---- Columnar snapshot (NumPy) ----
+# One row per clinic: coordinates in radians plus the boolean filter columns.
+# Distance, radius cut, Medical Card / PRSI filters and the
+# (not emergency_suitable, distance) ordering are computed in one vectorised
+# pass over the candidate rows. Without NumPy the pure-Python loop is used.
+_EARTH_RADIUS_KM = 6371
+
+class ClinicColumns:
+    """Read-only NumPy column snapshot of the clinic list."""
+
+    def __init__(self, clinics: List[dict]):
+        self.clinics = list(clinics)
+        self.row_of = {c["id"]: i for i, c in enumerate(self.clinics)}
+        self.lat = np.radians(np.array([c["coordinates"]["lat"] for c in self.clinics], dtype=np.float64))
+        self.lng = np.radians(np.array([c["coordinates"]["lng"] for c in self.clinics], dtype=np.float64))
+        self.cos_lat = np.cos(self.lat)
+        self.accepts_mc = np.array([bool(c.get("medical_card", {}).get("accepts", False)) for c in self.clinics], dtype=bool)
+        self.prsi = np.array([bool(c.get("prsi_dtbs", False)) for c in self.clinics], dtype=bool)
+        self.same_day = np.array([bool(c.get("emergency_slots", {}).get("offers_same_day", False)) for c in self.clinics], dtype=bool)
+
+    def rank(self, search: EmergencyClinicSearch, candidates: List[dict]) -> List[tuple]:
+        """Return (clinic, distance_km, emergency_suitable) for matching
+        candidates, already in result order."""
+        rows = np.fromiter((self.row_of[c["id"]] for c in candidates), dtype=np.intp, count=len(candidates))
+        lat0, lng0 = radians(search.latitude), radians(search.longitude)
+
+        a = (np.sin((self.lat[rows] - lat0) / 2) ** 2
+             + cos(lat0) * self.cos_lat[rows] * np.sin((self.lng[rows] - lng0) / 2) ** 2)
+        distance = 2 * _EARTH_RADIUS_KM * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+        keep = distance <= search.max_distance_km
+        if search.medical_card_only:
+            keep &= self.accepts_mc[rows]
+        if search.prsi_only:
+            keep &= self.prsi[rows]
+        if search.urgency in (UrgencyLevel.RED_AE.value, UrgencyLevel.ORANGE_URGENT.value):
+            suitable = self.same_day[rows]
+        else:
+            suitable = np.ones(len(rows), dtype=bool)
+
+        hits = np.flatnonzero(keep)
+        order = hits[np.lexsort((distance[hits], ~suitable[hits]))]   # stable, last key primary
+        return [(self.clinics[rows[i]], float(distance[i]), bool(suitable[i])) for i in order]
+
+def _rank_clinics_python(search: EmergencyClinicSearch, candidates: List[dict]) -> List[tuple]:
+    """Pure-Python equivalent of ClinicColumns.rank() (used without NumPy)."""
+    ranked = []
+    for clinic in candidates:
         distance = haversine_distance(
             search.latitude, search.longitude,
             clinic["coordinates"]["lat"], clinic["coordinates"]["lng"]
@@ -1411,51 +2225,189 @@ def match_clinics_for_emergency(search: EmergencyClinicSearch) -> List[dict]:
         if distance > search.max_distance_km:
             continue
         
-        mc_info = clinic.get("medical_card", {})
-        if search.medical_card_only and not mc_info.get("accepts", False):
+        if search.medical_card_only and not clinic.get("medical_card", {}).get("accepts", False):
             continue
         
         if search.prsi_only and not clinic.get("prsi_dtbs", False):
             continue
         
-        emergency_info = clinic.get("emergency_slots", {})
         emergency_suitable = True
         if search.urgency in [UrgencyLevel.RED_AE.value, UrgencyLevel.ORANGE_URGENT.value]:
-            emergency_suitable = emergency_info.get("offers_same_day", False)
-          
-        slot_status = SLOT_STATUS.get(clinic["id"], {})
-      
-        match = {
-            "id": clinic["id"],
-            "clinic_name": clinic["clinic_name"],
-            "location": clinic["location"],
-            "eircode": clinic["eircode"],
-            "phone": clinic["phone"],
-            "email": clinic.get("email"),
+            emergency_suitable = clinic.get("emergency_slots", {}).get("offers_same_day", False)
+        
+        ranked.append((clinic, distance, emergency_suitable))
+    
+    ranked.sort(key=lambda x: (not x[2], x[1]))
+    return ranked
+
+# ============================================================
+# CLINIC REGISTRY
+# Clinic data is loaded from CLINICS_FILE into an immutable snapshot: the
+# clinic tuple, an id -> clinic dict, the spatial index, the NumPy columns
+# and precomputed per-clinic response fields. A reload builds a complete
+# new snapshot and then swaps one global reference, so a request that
+# already holds the old snapshot finishes against it and never sees a
+# half-updated list. Reloads are triggered by the file's mtime (polled from
+# lifespan) or by POST /api/admin/clinics/reload.
+# ============================================================
+
+class ClinicRegistryError(ValueError):
+    """Raised when the clinic data file is missing or invalid."""
+
+def _validate_clinics(data) -> List[dict]:
+    if not isinstance(data, list) or not data:
+        raise ClinicRegistryError("clinic file must contain a non-empty JSON array")
+    seen = set()
+    for clinic in data:
+        if not isinstance(clinic, dict) or not isinstance(clinic.get("id"), int):
+            raise ClinicRegistryError(f"clinic without an integer id: {str(clinic)[:80]}")
+        if clinic["id"] in seen:
+            raise ClinicRegistryError(f"duplicate clinic id {clinic['id']}")
+        seen.add(clinic["id"])
+        for field in ("clinic_name", "location", "eircode", "phone"):
+            if not clinic.get(field):
+                raise ClinicRegistryError(f"clinic {clinic['id']} is missing {field!r}")
+        coords = clinic.get("coordinates") or {}
+        if not all(isinstance(coords.get(k), (int, float)) for k in ("lat", "lng")):
+            raise ClinicRegistryError(f"clinic {clinic['id']} has invalid coordinates")
+        digest = clinic.get("brief_digest_minutes", 0)
+        if isinstance(digest, bool) or not isinstance(digest, (int, float)) or digest < 0:
+            raise ClinicRegistryError(f"clinic {clinic['id']} has invalid brief_digest_minutes")
+    return data
+
+def _emergency_static_fields(clinic: dict) -> dict:
+    """The parts of an emergency search result that only change on reload."""
+    mc_info = clinic.get("medical_card", {})
+    emergency_info = clinic.get("emergency_slots", {})
+    return {
+        "id": clinic["id"],
+        "clinic_name": clinic["clinic_name"],
+        "location": clinic["location"],
+        "eircode": clinic["eircode"],
+        "phone": clinic["phone"],
+        "email": clinic.get("email"),
+        "rating": clinic.get("rating"),
+        "review_count": clinic.get("review_count"),
+        "verified": clinic.get("verified", False),
+        "practitioner": clinic.get("practitioner", {}),
+        "accepts_medical_card": mc_info.get("accepts", False),
+        "mc_accepting_new": mc_info.get("accepting_new_patients", False),
+        "mc_last_verified": mc_info.get("last_verified"),
+        "accepts_prsi": clinic.get("prsi_dtbs", False),
+        "has_emergency_slots": emergency_info.get("offers_same_day", False),
+        "typical_wait_hours": emergency_info.get("typical_wait_hours"),
+        "pricing": clinic.get("pricing", {}),
+        "available_slots": clinic.get("available_slots", []),
+    }
+
+class ClinicRegistry:
+    """Immutable snapshot of the clinic list. Treat every attribute
+    (including the clinic dicts) as read-only — build a new registry instead."""
+
+    def __init__(self, clinics: List[dict], previous: Optional["ClinicRegistry"] = None, mtime: float = 0.0):
+        self.clinics = tuple(clinics)
+        self.by_id: Dict[int, dict] = {c["id"]: c for c in self.clinics}
+        self.cosmetic_partners = tuple(c for c in self.clinics if c.get("cosmetic_partner", False))
+        self.cosmetic_pricing_keys = frozenset(k for c in self.cosmetic_partners for k in c.get("pricing", {}))
+        self.emergency_fields: Dict[int, dict] = {c["id"]: _emergency_static_fields(c) for c in self.clinics}
+        self.schedules: Dict[int, OpeningSchedule] = {
+            c["id"]: OpeningSchedule.from_hours(c.get("hours", {}), c["id"]) for c in self.clinics}
+        self.mtime = mtime
+        self.version = previous.version + 1 if previous else 1
+        self.loaded_at = datetime.now().isoformat()
+        if previous is not None:
+            # Incremental: only clinics that moved change grid buckets
+            self.index = previous.index.copy()
+            self.index.sync(self.clinics)
+        else:
+            self.index = ClinicSpatialIndex(self.clinics)
+        self.columns = ClinicColumns(self.clinics) if NUMPY_AVAILABLE else None
+
+        self._bodies: Dict[tuple, tuple] = {}
+
+    def __len__(self) -> int:
+        return len(self.clinics)
+
+    def cached_body(self, key: tuple, build) -> tuple:
+        """(body, etag) for a response derived only from this snapshot,
+        serialised on first use. A reload brings a fresh, empty cache."""
+        cached = self._bodies.get(key)
+        if cached is None:
+            cached = self._bodies[key] = _serialize_json(build())
+        return cached
+
+def load_clinic_registry(path: Path, previous: Optional[ClinicRegistry] = None) -> ClinicRegistry:
+    try:
+        mtime = path.stat().st_mtime
+        clinics = _validate_clinics(json.loads(path.read_text(encoding="utf-8")))
+    except (OSError, json.JSONDecodeError) as e:
+        raise ClinicRegistryError(f"could not read {path.name}: {e}")
+    return ClinicRegistry(clinics, previous=previous, mtime=mtime)
+
+_clinic_registry = load_clinic_registry(CLINICS_FILE)
+_clinic_reload_lock = threading.Lock()
+
+def get_registry() -> ClinicRegistry:
+    """Current clinic snapshot. Grab it once per request and use that object."""
+    return _clinic_registry
+
+def reload_clinic_registry(force: bool = False) -> bool:
+    """Reload CLINICS_FILE if its mtime changed (or when forced).
+    Returns True if a new snapshot was swapped in. On invalid data the
+    current snapshot stays live and ClinicRegistryError is raised."""
+    global _clinic_registry
+    with _clinic_reload_lock:
+        current = _clinic_registry
+        try:
+            mtime = CLINICS_FILE.stat().st_mtime
+        except OSError as e:
+            raise ClinicRegistryError(f"could not stat {CLINICS_FILE.name}: {e}")
+        if not force and mtime == current.mtime:
+            return False
+        registry = load_clinic_registry(CLINICS_FILE, previous=current)
+        _clinic_registry = registry   # atomic swap
+    logger.info(f"Clinic registry reloaded: v{registry.version}, {len(registry)} clinics")
+    return True
+
+async def clinic_registry_watcher():
+    """Background task (started from lifespan) that picks up edits to CLINICS_FILE."""
+    while True:
+        await asyncio.sleep(CLINICS_RELOAD_INTERVAL)
+        try:
+            await run_io(reload_clinic_registry)
+        except ClinicRegistryError as e:
+            logger.error(f"Clinic registry not reloaded, keeping v{get_registry().version}: {e}")
+
+def match_clinics_for_emergency(search: EmergencyClinicSearch, slots: Optional[Dict[int, dict]] = None) -> List[dict]:
+    """slots: live slot status read once for the whole search (default: shared_state)."""
+    registry = get_registry()
+    if slots is None:
+        slots = shared_state.slots()
+    candidates = registry.index.candidates(search.latitude, search.longitude, search.max_distance_km)
+    if registry.columns is not None:
+        ranked = registry.columns.rank(search, candidates)
+    else:
+        ranked = _rank_clinics_python(search, candidates)
+    
+    clock = SearchClock()   # one clock read for the whole search
+    
+    matches = []
+    for clinic, distance, emergency_suitable in ranked:
+        slot_status = slots.get(clinic["id"], {})
+        is_open, closes_at, next_open_at = registry.schedules[clinic["id"]].status(clock)
+        matches.append({
+            **registry.emergency_fields[clinic["id"]],
             "distance_km": round(distance, 1),
-            "rating": clinic.get("rating"),
-            "review_count": clinic.get("review_count"),
-            "verified": clinic.get("verified", False),
-            "practitioner": clinic.get("practitioner", {}),
-            "accepts_medical_card": mc_info.get("accepts", False),
-            "mc_accepting_new": mc_info.get("accepting_new_patients", False),
-            "mc_last_verified": mc_info.get("last_verified"),
-            "accepts_prsi": clinic.get("prsi_dtbs", False),
-            "has_emergency_slots": emergency_info.get("offers_same_day", False),
-            "typical_wait_hours": emergency_info.get("typical_wait_hours"),
-            "is_open_now": check_if_open(clinic.get("hours", {})),
+            "is_open_now": is_open,
+            "closes_at": closes_at,
+            "next_open_at": next_open_at,
             "emergency_suitable": emergency_suitable,
-            "pricing": clinic.get("pricing", {}),
-            "available_slots": clinic.get("available_slots", []),
             "live_slot_available": slot_status.get("available"),
             "live_slot_updated": slot_status.get("last_updated"),
             "live_slot_notes": slot_status.get("notes")
-        }
-        
-        matches.append((match, distance, emergency_suitable))
+        })
     
-    matches.sort(key=lambda x: (not x[2], x[1]))
-    return [m[0] for m in matches]
+    return matches
 
 # ============================================================
 # BRIEF GENERATOR
@@ -1467,23 +2419,27 @@ def yes_no(val):
     return "Yes" if val else "No"
 
 
+BRIEF_PII_FIELDS = ("patient_name", "patient_phone", "chief_complaint", "previous_treatment")
+
 def generate_brief(brief_input: BriefInput) -> dict:
     """Generate a patient brief for the clinic."""
     brief_id = datetime.now().strftime("%Y%m%d%H%M%S") + str(uuid.uuid4())[:4]
+    plaintext = {field: getattr(brief_input, field) for field in BRIEF_PII_FIELDS}
+    encrypted = encrypt_fields(plaintext)
     
     brief = {
         "brief_id": brief_id,
-        "patient_name": encrypt_field(brief_input.patient_name) if brief_input.patient_name else None,
-        "patient_phone": encrypt_field(brief_input.patient_phone),
+        "patient_name": encrypted["patient_name"],
+        "patient_phone": encrypted["patient_phone"],
         "contact_preference": brief_input.contact_preference,
-        "chief_complaint": encrypt_field(brief_input.chief_complaint),
+        "chief_complaint": encrypted["chief_complaint"],
         "pain_level": brief_input.pain_level,
         "pain_worsening": brief_input.pain_worsening,
         "urgency": brief_input.urgency,
         "urgency_display": brief_input.urgency_display,
         "symptom_duration_hours": brief_input.symptom_duration_hours,
         "sensitive_to_temp": brief_input.sensitive_to_temp,
-        "previous_treatment": encrypt_field(brief_input.previous_treatment) if brief_input.previous_treatment else None,
+        "previous_treatment": encrypted["previous_treatment"],
         "payment_type": brief_input.payment_type,
         "medical_card_last4": brief_input.medical_card_last4,
         "requested_date": brief_input.requested_date,
@@ -1494,16 +2450,8 @@ def generate_brief(brief_input: BriefInput) -> dict:
         "status": "pending"
     }
     
-    briefs = []
-    if BRIEFS_FILE.exists():
-        try:
-            briefs = json.loads(BRIEFS_FILE.read_text())
-        except (json.JSONDecodeError, OSError) as e:
-            logger.warning(f'Could not read briefs file: {e}')
-            briefs = []
-    
-    briefs.append(brief)
-    BRIEFS_FILE.write_text(json.dumps(briefs, indent=2))
+    repo.save_brief(brief)
+    brief_plaintext_cache.put(brief_id, plaintext)
     
     logger.info('=' * 50)
     logger.info(f"EMERGENCY BRIEF: {brief_id}")
@@ -1515,11 +2463,14 @@ def generate_brief(brief_input: BriefInput) -> dict:
 
 
 def format_brief_for_email(brief: dict) -> str:
-    """Format a brief into a readable string for email."""
-    patient_name = decrypt_field(brief.get('patient_name')) if brief.get('patient_name') else 'Not provided'
-    patient_phone = decrypt_field(brief.get('patient_phone'))
-    chief_complaint = decrypt_field(brief.get('chief_complaint'))
-    previous_treatment = decrypt_field(brief.get('previous_treatment')) if brief.get('previous_treatment') else 'None mentioned'
+    """Format a brief into a readable string for email.
+    Uses the plaintext cached by generate_brief() when still fresh, so the
+    fields are only decrypted if the cache entry has expired or been evicted."""
+    pii = brief_plaintext_cache.pop(brief['brief_id']) or decrypt_fields(brief, BRIEF_PII_FIELDS)
+    patient_name = pii['patient_name'] or 'Not provided'
+    patient_phone = pii['patient_phone']
+    chief_complaint = pii['chief_complaint']
+    previous_treatment = pii['previous_treatment'] or 'None mentioned'
 
     urgency_map = {"orange": "[URGENT]", "yellow": "[SOON]", "green": "[ROUTINE]", "red_ae": "[EMERGENCY]"}
     urgency_label = urgency_map.get(brief["urgency"], "[UNKNOWN]")
@@ -1554,11 +2505,8 @@ Generated by SmileAgent Emergency Triage
 """
 
 
-def send_clinic_email(booking: dict, clinic: dict, signature_link: str, brief: dict = None):
-    """Send email notification to clinic (simulated for MVP)."""
-    clinic_email = clinic.get('email', 'unknown@clinic.ie')
-    clinic_name = clinic.get('clinic_name', 'Unknown Clinic')
-    
+def build_clinic_email(booking: dict, clinic: dict, signature_link: str, brief: dict = None) -> tuple:
+    """(subject, body) of the clinic notification for a booking or brief."""
     if brief:
         email_body = format_brief_for_email(brief)
         subject = f"SmileAgent Emergency: {brief.get('urgency_display', 'Urgent')} - New Patient"
@@ -1579,48 +2527,688 @@ Digital Signature Link: {signature_link}
 ---
 SmileAgent Booking System
 """
-    
-    logger.info('=' * 50)
-    logger.info("EMAIL TO CLINIC (Simulated)")
-    logger.info("=" * 50)
-    logger.info(f"To: {clinic_email}")
-    logger.info(f"Subject: {subject}")
-    logger.info("=" * 50)
-    logger.info(email_body)
-    logger.info("=" * 50)
+    return subject, email_body
+
+# Clinics with "brief_digest_minutes" in clinics.json get briefs of these
+# urgencies grouped into one email per window. Anything else, including an
+# urgency that is missing or not recognised, goes out on its own, now.
+DIGEST_URGENCIES = frozenset({UrgencyLevel.YELLOW_SOON.value, UrgencyLevel.GREEN_ROUTINE.value})
+
+async def send_clinic_email(booking: dict, clinic: dict, signature_link: str, brief: dict = None) -> dict:
+    """Queue the clinic notification for a booking or brief; the outbox worker delivers it."""
+    subject, body = await run_io(build_clinic_email, booking, clinic, signature_link, brief)
+    kind, ref_id = ("brief", brief["brief_id"]) if brief else ("booking", booking["booking_id"])
+    digest_window = 0.0
+    if brief and brief.get("urgency") in DIGEST_URGENCIES:
+        digest_window = float(clinic.get("brief_digest_minutes") or 0) * 60
+    return await outbox.enqueue(clinic, kind, ref_id, subject, body, digest_window)
+
+
+# ============================================================
+# CLINIC NOTIFICATIONS — persistent outbox
+# Notifications are written to an SQLite outbox (subject and body Fernet-
+# encrypted, like every other PII at rest) and the request moves on. One
+# worker per process claims due messages, groups them by clinic and sends
+# each group over a pooled SMTP session, so a burst of bookings costs a
+# handful of connections rather than one each. Transient failures retry
+# with exponential backoff; 5xx rejections and exhausted retries end in
+# "failed". Digest briefs (see DIGEST_URGENCIES) wait until their
+# clinic's window closes and are then sent as one email. SMTP work runs on
+# the outbox's own SMTP_POOL_SIZE threads, so a slow or unreachable relay
+# never ties up the I/O pool that bookings and briefs need. Claims are a
+# single UPDATE ... RETURNING, so several workers can share the outbox, and
+# a claim left by a crashed worker is released after _OUTBOX_CLAIM_TIMEOUT
+# (delivery is at-least-once).
+#
+# With SMTP_HOST unset messages are logged instead of sent (the MVP
+# behaviour). To watch real SMTP traffic locally, run a debugging server —
+#   python -m aiosmtpd -n -l localhost:1025            (pip install aiosmtpd)
+#   python -m smtpd -n -c DebuggingServer localhost:1025   (Python <= 3.11)
+# — and set SMTP_HOST=localhost SMTP_PORT=1025 SMTP_STARTTLS=false.
+# ============================================================
+
+_OUTBOX_BATCH_MAX = 100        # messages claimed per worker pass
+_OUTBOX_POLL = 5.0             # seconds between checks for retries that fell due
+_OUTBOX_CLAIM_TIMEOUT = 300    # seconds before a "sending" claim is considered abandoned
+_NOTIFY_MAX_ATTEMPTS = 8
+_NOTIFY_BACKOFF_BASE = 30.0    # seconds; doubles per attempt
+_NOTIFY_BACKOFF_MAX = 3600.0
+_SMTP_TIMEOUT = 30.0           # socket timeout per SMTP command
+_SMTP_IDLE_TIMEOUT = 60.0      # pooled sessions idle longer than this are closed, not reused
+_DIGEST_MAX = 50               # briefs per digest email
+
+class OutboxStore:
+    """SQLite table of outbound clinic messages. Blocking — use through run_io()."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            clinic_id       INTEGER NOT NULL,
+            kind            TEXT NOT NULL,
+            ref_id          TEXT NOT NULL,
+            to_addr         TEXT,
+            subject         TEXT NOT NULL,
+            body            TEXT NOT NULL,
+            digest          INTEGER NOT NULL DEFAULT 0,
+            status          TEXT NOT NULL,
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at      REAL,
+            last_error      TEXT,
+            created_at      TEXT NOT NULL,
+            sent_at         TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+        CREATE INDEX IF NOT EXISTS idx_outbox_ref ON outbox (ref_id);
+    """
+    PUBLIC_COLUMNS = "id, kind, ref_id, digest, status, attempts, next_attempt_at, last_error, created_at, sent_at"
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}
+        if "digest" not in columns:   # outbox created before digest mode
+            self._conn.execute("ALTER TABLE outbox ADD COLUMN digest INTEGER NOT NULL DEFAULT 0")
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """The connection, reopened on first use after close() (e.g. a second lifespan)."""
+        if self._db is None:
+            self._db = _sqlite_connect(self.path)
+        return self._db
+
+    def add(self, message: dict, digest_window: float = 0.0) -> int:
+        """Insert a message. A digest message is due with the clinic's open
+        digest, or digest_window from now if there isn't one."""
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO outbox (clinic_id, kind, ref_id, to_addr, subject, body, digest, status, "
+                "next_attempt_at, last_error, created_at) VALUES (:clinic_id, :kind, :ref_id, :to_addr, "
+                ":subject, :body, :digest, :status, CASE WHEN :digest THEN coalesce("
+                "  (SELECT min(next_attempt_at) FROM outbox WHERE clinic_id = :clinic_id AND digest = 1"
+                "   AND status = 'queued' AND attempts = 0), :next_attempt_at + :window) "
+                "ELSE :next_attempt_at END, :last_error, :created_at)",
+                {**message, "digest": int(digest_window > 0), "window": digest_window})
+            return cur.lastrowid
+
+    def claim(self, now: float, limit: int) -> List[dict]:
+        """Mark up to `limit` due messages as sending and return them."""
+        with self._lock:
+            rows = self._conn.execute(
+                "UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id IN ("
+                "  SELECT id FROM outbox WHERE status = 'queued' AND next_attempt_at <= ?"
+                "  ORDER BY next_attempt_at LIMIT ?) "
+                "RETURNING id, clinic_id, kind, ref_id, to_addr, subject, body, digest, attempts",
+                (now, now, limit)).fetchall()
+        keys = ("id", "clinic_id", "kind", "ref_id", "to_addr", "subject", "body", "digest", "attempts")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def release_stale(self, before: float) -> int:
+        with self._lock:
+            return self._conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending' "
+                                      "AND claimed_at < ?", (before,)).rowcount
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute("SELECT min(next_attempt_at) FROM outbox WHERE status = 'queued'").fetchone()
+        return row[0]
+
+    def record(self, outcomes: List[tuple]):
+        """Apply (id, status, attempts, next_attempt_at, error) results in one transaction."""
+        sent_at = datetime.now().isoformat()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+                "claimed_at = NULL, sent_at = CASE WHEN ? = 'sent' THEN ? END WHERE id = ?",
+                [(status, attempts, next_at, error, status, sent_at, msg_id)
+                 for msg_id, status, attempts, next_at, error in outcomes])
+
+    def for_ref(self, ref_id: str) -> List[dict]:
+        with self._lock:
+            cur = self._conn.execute(f"SELECT {self.PUBLIC_COLUMNS} FROM outbox WHERE ref_id = ? ORDER BY id",
+                                     (ref_id,))
+            keys = [column[0] for column in cur.description]
+            return [dict(zip(keys, row)) for row in cur.fetchall()]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, count(*) FROM outbox GROUP BY status").fetchall())
+
+    # ---- Key rotation: same contract as Repository, kind is always "outbox" ----
+
+    ENCRYPTED_COLUMNS = ("subject", "body")
+
+    def count_records(self, kind: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM outbox").fetchone()[0]
+
+    def iter_records(self, kind: str, after: Optional[int], limit: int) -> List[tuple]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, subject, body FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+                                      (after or 0, limit)).fetchall()
+        return [(msg_id, {"subject": subject, "body": body}) for msg_id, subject, body in rows]
+
+    def replace_fields(self, kind: str, changes: List[tuple]) -> int:
+        applied = 0
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            for msg_id, expected, updates in changes:
+                columns = [c for c in self.ENCRYPTED_COLUMNS if c in updates]
+                sets = ", ".join(f"{c} = ?" for c in columns)
+                checks = "".join(f" AND {c} = ?" for c in columns)
+                applied += self._conn.execute(
+                    f"UPDATE outbox SET {sets} WHERE id = ?{checks}",
+                    [updates[c] for c in columns] + [msg_id] + [expected[c] for c in columns]).rowcount
+        return applied
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class SmtpPool:
+    """At most SMTP_POOL_SIZE SMTP sessions, kept open between batches.
+    Blocking — used from I/O pool threads."""
+
+    def __init__(self, size: int):
+        self._slots = threading.BoundedSemaphore(max(1, size))
+        self._idle: List[tuple] = []    # (smtp, last_used)
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def _open(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=_SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            smtp.starttls(context=ssl.create_default_context())
+        if SMTP_USERNAME:
+            smtp.login(SMTP_USERNAME, SMTP_PASSWORD)
+        self.opened += 1
+        return smtp
+
+    def acquire(self) -> tuple:
+        """(session, reused) — blocks while every session is in use."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    smtp, last_used = self._idle.pop() if self._idle else (None, 0.0)
+                if smtp is None:
+                    return self._open(), False
+                if _time.monotonic() - last_used < _SMTP_IDLE_TIMEOUT:
+                    self.reused += 1
+                    return smtp, True
+                self._quit(smtp)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, smtp: smtplib.SMTP, broken: bool = False):
+        if broken:
+            self._quit(smtp)
+        else:
+            with self._lock:
+                self._idle.append((smtp, _time.monotonic()))
+        self._slots.release()
+
+    @staticmethod
+    def _quit(smtp: smtplib.SMTP):
+        try:
+            smtp.quit()
+        except OSError:
+            smtp.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            self._quit(smtp)
+
+def _retry_outcome(message: dict, error: str) -> tuple:
+    attempts = message["attempts"] + 1
+    if attempts >= _NOTIFY_MAX_ATTEMPTS:
+        logger.error(f"Notification {message['id']} ({message['kind']} {message['ref_id']}) "
+                     f"failed after {attempts} attempts: {error}")
+        return message["id"], "failed", attempts, 0.0, error
+    delay = min(_NOTIFY_BACKOFF_BASE * 2 ** (attempts - 1), _NOTIFY_BACKOFF_MAX)
+    return message["id"], "queued", attempts, _time.time() + delay, error
+
+class ClinicOutbox:
+    """Queue + delivery worker for clinic notifications."""
+
+    def __init__(self, store: OutboxStore):
+        self.store = store
+        self.pool = SmtpPool(SMTP_POOL_SIZE) if SMTP_HOST else None
+        self._executor: Optional[ThreadPoolExecutor] = None   # delivery threads, one per SMTP session
+        self._wake: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.sent = 0
 
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._wake = asyncio.Event()
+            self._stopping = False
+            self._worker = asyncio.create_task(self._run())
+
+    async def enqueue(self, clinic: dict, kind: str, ref_id: str, subject: str, body: str,
+                      digest_window: float = 0.0) -> dict:
+        """Persist one message for the clinic and wake the worker. With a
+        digest_window it joins the clinic's next digest email instead."""
+        to_addr = clinic.get("email")
+        message = {
+            "clinic_id": clinic["id"], "kind": kind, "ref_id": ref_id, "to_addr": to_addr,
+            "status": "queued" if to_addr else "failed",
+            "last_error": None if to_addr else "Clinic has no email address",
+            "next_attempt_at": _time.time(), "created_at": datetime.now().isoformat(),
+        }
+        message["id"] = await run_io(self._persist, message, {"subject": subject, "body": body},
+                                     digest_window if to_addr else 0.0)
+        if self._wake is not None:
+            self._wake.set()
+        return {"id": message["id"], "status": message["status"]}
+
+    def _persist(self, message: dict, plaintext: Dict[str, str], digest_window: float) -> int:
+        """Encrypt subject and body, then insert. Blocking."""
+        message.update(encrypt_fields(plaintext))
+        return self.store.add(message, digest_window)
+
+    @staticmethod
+    def _envelopes(messages: List[dict]) -> List[List[dict]]:
+        """Split one clinic's messages into emails: each immediate message on
+        its own, digest messages together (up to _DIGEST_MAX per email)."""
+        singles = [[message] for message in messages if not message["digest"]]
+        digest = sorted((message for message in messages if message["digest"]), key=lambda m: m["id"])
+        return singles + [digest[i:i + _DIGEST_MAX] for i in range(0, len(digest), _DIGEST_MAX)]
+
+    @staticmethod
+    def _decrypt(messages: List[dict]) -> tuple:
+        """(readable, outcomes): decrypt each message up front so one that no
+        longer decrypts fails on its own instead of taking its batch with it."""
+        readable, outcomes = [], []
+        for message in messages:
+            try:
+                message["subject_text"] = decrypt_field(message["subject"])
+                message["body_text"] = decrypt_field(message["body"])
+            except (InvalidToken, UnicodeDecodeError) as e:   # e.g. encrypted under a key that was dropped
+                logger.error(f"Notification {message['id']} ({message['kind']} {message['ref_id']}) "
+                             f"cannot be decrypted: {e!r}")
+                outcomes.append((message["id"], "failed", message["attempts"] + 1, 0.0, "cannot be decrypted"))
+            else:
+                readable.append(message)
+        return readable, outcomes
+
+    def _deliver(self, messages: List[dict]) -> List[tuple]:
+        """Send one clinic's messages over a single session. Blocking."""
+        messages, outcomes = self._decrypt(messages)
+        envelopes = self._envelopes(messages)
+        if self.pool is None:
+            return outcomes + [outcome for envelope in envelopes for outcome in self._log(envelope)]
+        if not envelopes:
+            return outcomes
+
+        def retry_rest(error: str):
+            outcomes.extend(_retry_outcome(m, error) for envelope in envelopes for m in envelope)
+
+        try:
+            smtp, reused = self.pool.acquire()
+        except OSError as e:   # includes SMTPException (e.g. a failed login)
+            retry_rest(f"connect: {e}")
+            return outcomes
+        try:
+            while envelopes:
+                envelope = envelopes[0]
+                try:
+                    smtp.send_message(self._mime(envelope))
+                except smtplib.SMTPRecipientsRefused as e:
+                    code = min(code for code, _ in e.recipients.values())
+                    outcomes += [self._rejected(m, code, str(e)) for m in envelope]
+                except smtplib.SMTPResponseException as e:
+                    outcomes += [self._rejected(m, e.smtp_code, str(e)) for m in envelope]
+                except OSError as e:
+                    # SMTPException subclasses OSError; only a dropped session is a connection problem
+                    if isinstance(e, smtplib.SMTPException) and not isinstance(e, smtplib.SMTPServerDisconnected):
+                        outcomes += [_retry_outcome(m, str(e)) for m in envelope]
+                        envelopes.pop(0)
+                        continue
+                    session, smtp = smtp, None
+                    self.pool.release(session, broken=True)
+                    if not reused:   # a fresh session failed: give the rest another go later
+                        retry_rest(f"connection: {e}")
+                        return outcomes
+                    try:             # the pooled session had gone stale; retry once on a new one
+                        smtp, _ = self.pool.acquire()
+                        reused = False
+                    except OSError as e:
+                        retry_rest(f"connect: {e}")
+                        return outcomes
+                    continue
+                else:
+                    outcomes += [(m["id"], "sent", m["attempts"] + 1, 0.0, None) for m in envelope]
+                envelopes.pop(0)
+        except Exception as e:
+            # Unexpected: the session's state is unknown, so drop it. What was
+            # already sent stays sent; the rest is retried later.
+            logger.error(f"Notification delivery for clinic {envelopes[0][0]['clinic_id']} failed: {e!r}")
+            if smtp is not None:
+                session, smtp = smtp, None
+                self.pool.release(session, broken=True)
+            retry_rest(f"unexpected: {e}")
+        finally:
+            if smtp is not None:
+                self.pool.release(smtp)
+        return outcomes
+
+    @staticmethod
+    def _rejected(message: dict, code: int, error: str) -> tuple:
+        """A 5xx reply is permanent; anything else is retried."""
+        if 500 <= code < 600:
+            return message["id"], "failed", message["attempts"] + 1, 0.0, error
+        return _retry_outcome(message, error)
+
+    @staticmethod
+    def _render(envelope: List[dict]) -> tuple:
+        """(to, subject, body) of one email (messages already through _decrypt).
+        A digest gets a generated subject."""
+        first = envelope[0]
+        if len(envelope) == 1:
+            return first["to_addr"], first["subject_text"], first["body_text"]
+        subject = f"SmileAgent: {len(envelope)} new patient briefs"
+        header = f"SMILEAGENT BRIEF DIGEST\n{len(envelope)} briefs, oldest first.\n"
+        body = ("\n" + "=" * 50 + "\n").join([header] + [m["body_text"] for m in envelope])
+        return first["to_addr"], subject, body
+
+    @classmethod
+    def _mime(cls, envelope: List[dict]) -> EmailMessage:
+        to_addr, subject, body = cls._render(envelope)
+        mime = EmailMessage()
+        mime["From"] = SMTP_FROM
+        mime["To"] = to_addr
+        mime["Subject"] = subject
+        mime["Message-ID"] = make_msgid(f"{envelope[0]['kind']}.{envelope[0]['id']}")
+        mime.set_content(body)
+        return mime
+
+    @classmethod
+    def _log(cls, envelope: List[dict]) -> List[tuple]:
+        to_addr, subject, body = cls._render(envelope)
+        logger.info('=' * 50)
+        logger.info("EMAIL TO CLINIC (Simulated)")
+        logger.info("=" * 50)
+        logger.info(f"To: {to_addr}")
+        logger.info(f"Subject: {subject}")
+        logger.info("=" * 50)
+        logger.info(body)
+        logger.info("=" * 50)
+        return [(m["id"], "sent", m["attempts"] + 1, 0.0, None) for m in envelope]
+
+    async def _send_group(self, messages: List[dict]):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, SMTP_POOL_SIZE),
+                                                thread_name_prefix="smileagent-smtp")
+        try:
+            outcomes = await asyncio.get_running_loop().run_in_executor(self._executor, self._deliver, messages)
+        except Exception as e:
+            logger.error(f"Notification batch for clinic {messages[0]['clinic_id']} failed: {e}")
+            outcomes = [_retry_outcome(message, str(e)) for message in messages]
+        await run_io(self.store.record, outcomes)
+        self.sent += sum(1 for outcome in outcomes if outcome[1] == "sent")
+
+    async def _run(self):
+        while True:
+            try:
+                now = _time.time()
+                await run_io(self.store.release_stale, now - _OUTBOX_CLAIM_TIMEOUT)
+                claimed = await run_io(self.store.claim, now, _OUTBOX_BATCH_MAX)
+                groups: Dict[int, List[dict]] = defaultdict(list)
+                for message in claimed:
+                    groups[message["clinic_id"]].append(message)
+                await asyncio.gather(*(self._send_group(group) for group in groups.values()))
+                if len(claimed) == _OUTBOX_BATCH_MAX:
+                    continue
+                next_due = await run_io(self.store.next_due)
+            except sqlite3.Error as e:
+                logger.error(f"Outbox unavailable: {e}")
+                next_due = None
+            if self._stopping:
+                return
+            wait = _OUTBOX_POLL if next_due is None else min(_OUTBOX_POLL, max(0.0, next_due - _time.time()))
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def status(self, ref_id: str) -> List[dict]:
+        """Delivery state of every notification for a booking or brief. Blocking."""
+        return self.store.for_ref(ref_id)
+
+    async def stop(self):
+        """Finish the batch in flight and close pooled sessions (lifespan shutdown).
+        Anything still queued stays in the outbox for the next start."""
+        if self._worker is not None and not self._worker.done():
+            self._stopping = True
+            self._wake.set()
+            await self._worker
+        self._worker = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self.pool is not None:
+            await run_io(self.pool.close)
+        logger.info(f"Clinic outbox stopped: {self.sent} sent this run")
+
+outbox = ClinicOutbox(OutboxStore(OUTBOX_FILE))
+
+
+# ============================================================
+# KEY ROTATION — background re-encryption of stored PII
+# Streams through each store in key order, _ROTATION_CHUNK records at a
+# time, re-encrypting any field that isn't under the primary key yet. The
+# cursor and counters are checkpointed after every chunk, so the job resumes
+# where it stopped after a restart; a pause between chunks keeps it from
+# competing with live requests. Memory use is bounded by the chunk size.
+# ============================================================
+
+# Bookings keep their PII in plaintext today; list booking fields here once
+# they are encrypted at rest and the job will rotate them too.
+BOOKING_ENCRYPTED_FIELDS: tuple = ()
+ENCRYPTED_FIELDS = {"briefs": BRIEF_PII_FIELDS, "bookings": BOOKING_ENCRYPTED_FIELDS,
+                    "outbox": OutboxStore.ENCRYPTED_COLUMNS}
+
+def rotation_store(kind: str):
+    """Where a store's records live: the repository, or the clinic outbox."""
+    return outbox.store if kind == "outbox" else repo
+
+KEY_ROTATION_CHECKPOINT = DATA_DIR / "key_rotation.json"
+_ROTATION_CHUNK = 200      # records per chunk
+_ROTATION_PAUSE = 0.25     # seconds between chunks
+
+def rotate_token(token: str) -> Optional[str]:
+    """Re-encrypt a Fernet token under the primary key. Returns None if it
+    already is; raises InvalidToken if no configured key can decrypt it."""
+    try:
+        primary_fernet.decrypt(token.encode())
+        return None
+    except InvalidToken:
+        return cipher_suite.rotate(token.encode()).decode()
+
+def rotate_chunk(kind: str, after: Optional[str]) -> dict:
+    """Rotate one chunk of a store (blocking). Returns cursor and counters."""
+    fields = ENCRYPTED_FIELDS[kind]
+    store = rotation_store(kind)
+    records = store.iter_records(kind, after, _ROTATION_CHUNK)
+    result = {"cursor": records[-1][0] if records else after,
+              "scanned": len(records), "rotated": 0, "failed": 0}
+    changes = []
+    for key, record in records:
+        expected, updates = {}, {}
+        for field in fields:
+            token = record.get(field)
+            if not token:
+                continue
+            try:
+                new_token = rotate_token(token)
+            except InvalidToken:
+                result["failed"] += 1
+                logger.warning(f"Key rotation: {kind}/{key} field {field} matches no configured key")
+                continue
+            if new_token:
+                expected[field], updates[field] = token, new_token
+        if updates:
+            changes.append((key, expected, updates))
+    # A record edited meanwhile was rewritten with the primary key anyway
+    if changes:
+        result["rotated"] = store.replace_fields(kind, changes)
+    return result
+
+class KeyRotationJob:
+    """Resumable, throttled re-encryption job with a JSON checkpoint file."""
+
+    def __init__(self, checkpoint: Path):
+        self.checkpoint = checkpoint
+        self._task: Optional[asyncio.Task] = None
+        self.state = self._load()
+
+    def _load(self) -> dict:
+        if self.checkpoint.exists():
+            try:
+                return json.loads(self.checkpoint.read_text())
+            except (json.JSONDecodeError, OSError) as e:
+                logger.warning(f"Ignoring unreadable key rotation checkpoint: {e}")
+        return {"status": "idle"}
+
+    def _save(self):
+        self.state["updated_at"] = datetime.now().isoformat()
+        tmp = self.checkpoint.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.state, indent=2))
+        os.replace(tmp, self.checkpoint)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, restart: bool = False) -> bool:
+        """Start (or resume an interrupted) run. False if already running."""
+        if self.running:
+            return False
+        if restart or self.state.get("status") != "running":
+            self.state = {
+                "status": "running",
+                "stores": list(ENCRYPTED_FIELDS),
+                "store_index": 0,
+                "cursor": None,
+                "totals": {}, "scanned": {}, "rotated": {}, "failed": {},
+                "started_at": datetime.now().isoformat(),
+                "finished_at": None,
+                "error": None,
+            }
+            self._save()
+        else:
+            logger.info(f"Resuming key rotation at {self.state['stores'][self.state['store_index']]} "
+                        f"after {self.state['cursor']!r}")
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def _run(self):
+        state = self.state
+        try:
+            while state["store_index"] < len(state["stores"]):
+                kind = state["stores"][state["store_index"]]
+                if ENCRYPTED_FIELDS.get(kind):
+                    state["totals"][kind] = await run_io(rotation_store(kind).count_records, kind)
+                    while True:
+                        chunk = await run_io(rotate_chunk, kind, state["cursor"])
+                        if not chunk["scanned"]:
+                            break
+                        state["cursor"] = chunk["cursor"]
+                        for counter in ("scanned", "rotated", "failed"):
+                            state[counter][kind] = state[counter].get(kind, 0) + chunk[counter]
+                        await run_io(self._save)
+                        await asyncio.sleep(_ROTATION_PAUSE)
+                state["store_index"] += 1
+                state["cursor"] = None
+                await run_io(self._save)
+            state["status"] = "completed"
+            state["finished_at"] = datetime.now().isoformat()
+            await run_io(self._save)
+            logger.info(f"Key rotation completed: rotated {state['rotated']}, failed {state['failed']}")
+        except asyncio.CancelledError:
+            # Checkpoint stays "running" so the next start() resumes from the cursor
+            raise
+        except Exception as e:
+            logger.error(f"Key rotation failed: {e}", exc_info=True)
+            state["status"] = "failed"
+            state["error"] = str(e)
+            self._save()
+
+    async def stop(self):
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self) -> dict:
+        return {**self.state, "running": self.running, "keys_configured": len(ENCRYPTION_KEYS)}
+
+key_rotation = KeyRotationJob(KEY_ROTATION_CHECKPOINT)
 
 # ============================================================
 # PDF GENERATION
+# The Med 2 pack is two pages: a cover with the relief summary and the
+# form itself. Everything that doesn't depend on the booking (header bars,
+# instructions, the A–J category grid, PPSN boxes, labels) is drawn once
+# per process into cached content-stream operators; each booking stamps
+# those in and then draws only its own fields on top.
 # ============================================================
 
-def generate_med2_pdf(booking: dict, clinic: dict) -> tuple:
-    if not REPORTLAB_AVAILABLE:
-        return None, None
-    
-    booking_id = booking.get('booking_id', 'unknown')
-    filename = f"Med2_SmileAgent_{booking_id}.pdf"
-    filepath = OUTPUTS_DIR / filename
-    
+# Fonts are registered in this order on every canvas so their internal
+# names (/F1, /F2, /F3) in the cached operators match. ZapfDingbats is
+# what ReportLab substitutes for the ☒ / ✓ glyphs.
+MED2_FONTS = ("Helvetica", "Helvetica-Bold", "ZapfDingbats")
+
+MED2_INSTRUCTIONS = [
+    "This Med 2 form has been pre-filled with your details by SmileAgent.",
+    "", "WHAT HAPPENS NEXT:", "",
+    "1. Attend your dental consultation", "",
+    "2. After treatment, your dentist will sign this form digitally", "",
+    "3. Once signed, you'll receive the completed form by email", "",
+    "4. Use the signed form to claim your tax relief via Revenue.ie", "", "",
+    "YOUR TAX RELIEF SUMMARY:"
+]
+MED2_CATEGORIES = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
+MED2_ROW_HEIGHT = 20
+MED2_PPSN_BOX_X, MED2_PPSN_BOX_SIZE = 65, 16
+
+def _med2_layout(height: float) -> dict:
+    """Baseline y of each block, shared by the static layer and the overlay."""
+    summary = height - 140 - 16 * len(MED2_INSTRUCTIONS) - 10
+    claimant = height - 75
+    ppsn = claimant - 70
+    grid = ppsn - 45
+    signature = grid - 25 - MED2_ROW_HEIGHT * len(MED2_CATEGORIES) - 25
+    practitioner = signature - 30
+    reg_no = practitioner - 50
+    words = reg_no - 25
+    return {"summary": summary, "claimant": claimant, "ppsn": ppsn, "grid": grid,
+            "signature": signature, "practitioner": practitioner, "reg_no": reg_no,
+            "words": words, "footer": words - 40}
+
+def _prime_med2_fonts(c):
+    c.saveState()
+    for name in MED2_FONTS:
+        c.setFont(name, 8)
+    c.restoreState()
+
+def _draw_med2_cover_static(c):
     width, height = A4
-    c = canvas.Canvas(str(filepath), pagesize=A4)
-    
-    if booking.get('who_is_paying') == 'other_paying_for_me' and booking.get('payer_name'):
-        claimant_name = booking.get('payer_name', '').upper()
-        claimant_ppsn = booking.get('payer_ppsn', '')
-        claimant_address = booking.get('payer_address', '')
-    else:
-        claimant_name = booking.get('name', '').upper()
-        claimant_ppsn = booking.get('ppsn', '')
-        claimant_address = booking.get('address', '')
-    
-    treatment_key = booking.get('treatment', 'invisalign')
-    treatment_info = TREATMENTS.get(treatment_key, TREATMENTS['invisalign'])
-    med2_category = treatment_info.get('med2_category', 'H')
-    cost = booking.get('estimated_cost', 0)
-    treatment_date = datetime.now().strftime("%d/%m/%Y")
-    
-    # PAGE 1: Cover
+    at = _med2_layout(height)
     c.setFillColor(HexColor('#059669'))
     c.rect(0, height - 70, width, 70, fill=True, stroke=False)
     c.setFillColor(HexColor('#FFFFFF'))
@@ -1630,91 +3218,56 @@ def generate_med2_pdf(booking: dict, clinic: dict) -> tuple:
     c.drawString(30, height - 62, "Your Pre-Filled Med 2 Tax Relief Form")
     
     c.setFillColor(black)
-    y = height - 110
     c.setFont("Helvetica-Bold", 16)
-    c.drawString(30, y, "Important Instructions")
-    y -= 30
-    
+    c.drawString(30, height - 110, "Important Instructions")
+    y = height - 140
     c.setFont("Helvetica", 11)
-    instructions = [
-        "This Med 2 form has been pre-filled with your details by SmileAgent.",
-        "", "WHAT HAPPENS NEXT:", "",
-        "1. Attend your dental consultation", "",
-        "2. After treatment, your dentist will sign this form digitally", "",
-        "3. Once signed, you'll receive the completed form by email", "",
-        "4. Use the signed form to claim your tax relief via Revenue.ie", "", "",
-        "YOUR TAX RELIEF SUMMARY:"
-    ]
-    for line in instructions:
+    for line in MED2_INSTRUCTIONS:
         c.drawString(30, y, line)
         y -= 16
     
-    y -= 10
+    y = at["summary"]
     c.setFillColor(HexColor('#ECFDF5'))
     c.rect(30, y - 80, 300, 90, fill=True, stroke=False)
     c.setStrokeColor(HexColor('#059669'))
     c.rect(30, y - 80, 300, 90, fill=False, stroke=True)
-    
-    relief = calculate_med2_relief(cost)
     c.setFillColor(black)
     c.setFont("Helvetica", 11)
-    c.drawString(45, y - 20, f"Treatment Cost:")
-    c.drawString(200, y - 20, f"€{cost:,.2f}")
+    c.drawString(45, y - 20, "Treatment Cost:")
     c.setFillColor(HexColor('#059669'))
-    c.drawString(45, y - 40, f"Tax Relief (20%):")
-    c.drawString(200, y - 40, f"-€{relief['relief_amount']:,.2f}")
+    c.drawString(45, y - 40, "Tax Relief (20%):")
     c.setFillColor(black)
     c.setFont("Helvetica-Bold", 12)
-    c.drawString(45, y - 65, f"Your Net Cost:")
-    c.drawString(200, y - 65, f"€{relief['net_cost']:,.2f}")
-    
-    c.setFont("Helvetica", 9)
-    c.setFillColor(HexColor('#666666'))
-    c.drawString(30, 80, f"Generated by SmileAgent on {datetime.now().strftime('%d %B %Y at %H:%M')}")
-    c.drawString(30, 65, f"Booking Reference: {booking_id}")
-    
-    c.showPage()
-    
-    # PAGE 2: Med 2 Form
+    c.drawString(45, y - 65, "Your Net Cost:")
+
+def _draw_med2_form_static(c):
+    width, height = A4
+    at = _med2_layout(height)
     c.setFillColor(HexColor('#1a472a'))
     c.rect(0, height - 50, width, 50, fill=True, stroke=False)
     c.setFillColor(HexColor('#FFFFFF'))
     c.setFont("Helvetica-Bold", 12)
     c.drawString(30, height - 32, "Form MED 2 - Dental Expenses Certified by Dental Practitioner")
     
-    y = height - 75
+    y = at["claimant"]
     c.setFillColor(black)
     c.setFont("Helvetica-Bold", 9)
     c.drawString(30, y, "Claimant's Name and Address")
     c.setStrokeColor(black)
     c.setLineWidth(0.5)
     c.rect(30, y - 55, 230, 50, stroke=True, fill=False)
-    c.setFont("Helvetica", 9)
-    c.drawString(35, y - 15, claimant_name)
-    
-    address_lines = claimant_address.split(',') if claimant_address else ['']
-    addr_y = y - 28
-    for line in address_lines[:3]:
-        c.drawString(35, addr_y, line.strip().upper()[:40])
-        addr_y -= 11
-    
     c.setFont("Helvetica", 7)
     c.drawString(280, y, "Note: This form is a receipt and should be")
     c.drawString(280, y - 9, "retained by you as evidence of expenses.")
     
-    y -= 70
+    y = at["ppsn"]
     c.setFont("Helvetica-Bold", 9)
     c.drawString(30, y, "PPSN")
-    ppsn = claimant_ppsn.upper().replace(' ', '')
-    box_x = 65
-    box_size = 16
     for i in range(9):
-        c.rect(box_x + (i * (box_size + 2)), y - 15, box_size, box_size, stroke=True, fill=False)
-        if i < len(ppsn):
-            c.setFont("Helvetica", 10)
-            c.drawString(box_x + (i * (box_size + 2)) + 4, y - 12, ppsn[i])
+        c.rect(MED2_PPSN_BOX_X + (i * (MED2_PPSN_BOX_SIZE + 2)), y - 15,
+               MED2_PPSN_BOX_SIZE, MED2_PPSN_BOX_SIZE, stroke=True, fill=False)
     
-    y -= 45
+    y = at["grid"]
     c.setFont("Helvetica-Bold", 7)
     headers = ["Nature of", "Insert ☒", "Date(s) treatment", "Date(s) payments", "Amount paid"]
     col_x = [30, 75, 120, 220, 320]
@@ -1723,80 +3276,1192 @@ def generate_med2_pdf(booking: dict, clinic: dict) -> tuple:
         c.drawString(col_x[i] + 3, y - 10, h)
     
     y -= 25
-    categories = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J']
-    row_height = 20
-    for cat in categories:
+    row_height = MED2_ROW_HEIGHT
+    for cat in MED2_CATEGORIES:
         c.rect(30, y - row_height, 45, row_height, stroke=True, fill=False)
         c.rect(75, y - row_height, 45, row_height, stroke=True, fill=False)
         c.rect(120, y - row_height, 100, row_height, stroke=True, fill=False)
         c.rect(220, y - row_height, 100, row_height, stroke=True, fill=False)
         c.rect(320, y - row_height, 220, row_height, stroke=True, fill=False)
-        
         c.setFont("Helvetica-Bold", 12)
         c.drawString(48, y - 14, cat)
         c.rect(90, y - 16, 12, 12, stroke=True, fill=False)
-        
-        if cat == med2_category:
-            c.setFont("Helvetica-Bold", 10)
-            c.drawString(92, y - 14, "✓")
-            c.setFont("Helvetica", 8)
-            c.drawString(125, y - 12, treatment_date)
-            c.drawString(225, y - 12, treatment_date)
-            c.drawString(325, y - 12, f"€{cost:,.2f}")
-        
         y -= row_height
     
-    y -= 25
-    practitioner = clinic.get('practitioner', {})
+    y = at["signature"]
     c.setFont("Helvetica-Bold", 8)
     c.drawString(30, y, "Signature of Dental Practitioner")
     c.rect(170, y - 3, 150, 20, stroke=True, fill=False)
     c.setFont("Helvetica", 7)
     c.drawString(175, y + 2, "[Digital signature pending]")
     
-    y -= 30
+    y = at["practitioner"]
     c.setFont("Helvetica-Bold", 7)
     c.drawString(30, y, "Name and Address of Dental Practitioner")
     c.rect(30, y - 40, 220, 38, stroke=True, fill=False)
-    c.setFont("Helvetica", 8)
-    c.drawString(35, y - 12, practitioner.get('name', ''))
-    c.drawString(35, y - 23, clinic.get('location', '')[:40])
-    c.drawString(35, y - 34, clinic.get('eircode', ''))
-    
-    c.setFont("Helvetica-Bold", 7)
     c.drawString(270, y, "Qualifications")
     c.rect(270, y - 18, 200, 16, stroke=True, fill=False)
-    c.setFont("Helvetica", 8)
-    c.drawString(275, y - 14, practitioner.get('qualifications', ''))
     
-    y -= 50
-    c.setFont("Helvetica-Bold", 7)
+    y = at["reg_no"]
     c.drawString(30, y, "Dental Council Reg No")
     c.rect(140, y - 3, 80, 16, stroke=True, fill=False)
     c.setFont("Helvetica", 9)
-    c.drawString(145, y, practitioner.get('registration_number', ''))
-    
     c.drawString(270, y, "Total Amount paid")
     c.rect(380, y - 3, 80, 16, stroke=True, fill=False)
-    c.drawString(385, y, f"€{cost:,.2f}")
     
-    y -= 25
+    y = at["words"]
     c.setFont("Helvetica-Bold", 7)
     c.drawString(30, y, "Amount in words")
     c.rect(30, y - 18, 510, 16, stroke=True, fill=False)
+    
+    c.setFillColor(HexColor('#059669'))
+    c.drawString(30, at["footer"], "PRE-FILLED BY SMILEAGENT — Dentist signature required after treatment")
+
+MED2_STATIC_PAGES = (_draw_med2_cover_static, _draw_med2_form_static)
+
+@functools.lru_cache(maxsize=1)
+def med2_template() -> tuple:
+    """Static layer of each page as PDF operators, rendered once per process."""
+    c = canvas.Canvas(os.devnull, pagesize=A4)
+    _prime_med2_fonts(c)
+    pages = []
+    for draw in MED2_STATIC_PAGES:
+        start = len(c.getCurrentPageContent())
+        draw(c)
+        pages.append(c.getCurrentPageContent()[start:])
+        c.showPage()
+    return tuple(pages)
+
+def _stamp_med2_static(c, page: int, template: bool):
+    c.saveState()
+    if template:
+        c.addLiteral(med2_template()[page])
+    else:
+        MED2_STATIC_PAGES[page](c)
+    c.restoreState()
+
+def generate_med2_pdf(booking: dict, clinic: dict, template: bool = True) -> tuple:
+    """Render the Med 2 pack for a booking. template=False redraws the static
+    layer from scratch (the pre-template behaviour, kept for benchmarks)."""
+    if not REPORTLAB_AVAILABLE:
+        return None, None
+    
+    booking_id = booking.get('booking_id', 'unknown')
+    filename = med2_filename(booking_id)
+    filepath = med2_path(booking_id)
+    filepath.parent.mkdir(exist_ok=True)
+    # Render beside the target and rename, so a download never sees half a file
+    tmp_path = filepath.with_name(f"{filename}.{os.getpid()}.tmp")
+    
+    width, height = A4
+    at = _med2_layout(height)
+    c = canvas.Canvas(str(tmp_path), pagesize=A4)
+    _prime_med2_fonts(c)
+    
+    if booking.get('who_is_paying') == 'other_paying_for_me' and booking.get('payer_name'):
+        claimant_name = booking.get('payer_name', '').upper()
+        claimant_ppsn = booking.get('payer_ppsn', '')
+        claimant_address = booking.get('payer_address', '')
+    else:
+        claimant_name = booking.get('name', '').upper()
+        claimant_ppsn = booking.get('ppsn', '')
+        claimant_address = booking.get('address', '')
+    
+    treatment_key = booking.get('treatment', 'invisalign')
+    treatment_info = TREATMENTS.get(treatment_key, TREATMENTS['invisalign'])
+    med2_category = treatment_info.get('med2_category', 'H')
+    cost = booking.get('estimated_cost', 0)
+    treatment_date = datetime.now().strftime("%d/%m/%Y")
+    
+    # PAGE 1: Cover
+    _stamp_med2_static(c, 0, template)
+    y = at["summary"]
+    relief = calculate_med2_relief(cost)
+    c.setFillColor(black)
+    c.setFont("Helvetica", 11)
+    c.drawString(200, y - 20, f"€{cost:,.2f}")
+    c.setFillColor(HexColor('#059669'))
+    c.drawString(200, y - 40, f"-€{relief['relief_amount']:,.2f}")
+    c.setFillColor(black)
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(200, y - 65, f"€{relief['net_cost']:,.2f}")
+    
+    c.setFont("Helvetica", 9)
+    c.setFillColor(HexColor('#666666'))
+    c.drawString(30, 80, f"Generated by SmileAgent on {datetime.now().strftime('%d %B %Y at %H:%M')}")
+    c.drawString(30, 65, f"Booking Reference: {booking_id}")
+    
+    c.showPage()
+    
+    # PAGE 2: Med 2 Form
+    _stamp_med2_static(c, 1, template)
+    c.setFillColor(black)
+    y = at["claimant"]
+    c.setFont("Helvetica", 9)
+    c.drawString(35, y - 15, claimant_name)
+    address_lines = claimant_address.split(',') if claimant_address else ['']
+    addr_y = y - 28
+    for line in address_lines[:3]:
+        c.drawString(35, addr_y, line.strip().upper()[:40])
+        addr_y -= 11
+    
+    y = at["ppsn"]
+    ppsn = claimant_ppsn.upper().replace(' ', '')
+    c.setFont("Helvetica", 10)
+    for i, char in enumerate(ppsn[:9]):
+        c.drawString(MED2_PPSN_BOX_X + (i * (MED2_PPSN_BOX_SIZE + 2)) + 4, y - 12, char)
+    
+    if med2_category in MED2_CATEGORIES:
+        y = at["grid"] - 25 - MED2_ROW_HEIGHT * MED2_CATEGORIES.index(med2_category)
+        c.setFont("Helvetica-Bold", 10)
+        c.drawString(92, y - 14, "✓")
+        c.setFont("Helvetica", 8)
+        c.drawString(125, y - 12, treatment_date)
+        c.drawString(225, y - 12, treatment_date)
+        c.drawString(325, y - 12, f"€{cost:,.2f}")
+    
+    practitioner = clinic.get('practitioner', {})
+    y = at["practitioner"]
+    c.setFont("Helvetica", 8)
+    c.drawString(35, y - 12, practitioner.get('name', ''))
+    c.drawString(35, y - 23, clinic.get('location', '')[:40])
+    c.drawString(35, y - 34, clinic.get('eircode', ''))
+    c.drawString(275, y - 14, practitioner.get('qualifications', ''))
+    
+    y = at["reg_no"]
+    c.setFont("Helvetica", 9)
+    c.drawString(145, y, practitioner.get('registration_number', ''))
+    c.drawString(385, y, f"€{cost:,.2f}")
+    
+    y = at["words"]
     c.setFont("Helvetica", 8)
     amount_words = number_to_words(int(cost)) + " euro"
     c.drawString(35, y - 14, amount_words.upper())
     
-    y -= 40
-    c.setFillColor(HexColor('#059669'))
-    c.setFont("Helvetica-Bold", 7)
-    c.drawString(30, y, "PRE-FILLED BY SMILEAGENT — Dentist signature required after treatment")
-    
     c.save()
+    os.replace(tmp_path, filepath)
     logger.info(f"Med 2 PDF generated: {filename}")
     return str(filepath), filename
 
+# ============================================================
+# SIGNATURE STAMPING
+# The dentist's signature is added to the already-rendered Med 2 as a PDF
+# incremental update: the original bytes stay as they are and a small
+# tail is appended with the signature image, one extra content stream
+# for page 2 and a new xref section pointing back at the old one. The
+# result is written to a separate _signed file, so the unsigned PDF
+# stays regenerable and every re-sign starts from a clean copy.
+# The parser only has to understand the PDFs generate_med2_pdf writes
+# (a single classic xref table, inline page Resources).
+# ============================================================
+
+SIGNATURE_MAX_BYTES = 2 * 1024 * 1024      # decoded PNG
+SIGNATURE_MAX_PIXELS = 4000 * 4000
+_SIGNATURE_DATA_URL_PREFIX = "data:image/png;base64,"
+
+class Med2StampError(Exception):
+    """The Med 2 PDF or the signature image could not be stamped."""
+
+def decode_signature_data_url(data_url: str) -> bytes:
+    """PNG bytes from the signature pad's canvas.toDataURL(); ValueError if invalid."""
+    if not data_url.startswith(_SIGNATURE_DATA_URL_PREFIX):
+        raise ValueError("Signature must be a PNG data URL")
+    encoded = data_url[len(_SIGNATURE_DATA_URL_PREFIX):]
+    if len(encoded) > SIGNATURE_MAX_BYTES * 4 // 3 + 4:
+        raise ValueError("Signature image is too large")
+    try:
+        png = base64.b64decode(encoded, validate=True)
+    except ValueError:   # binascii.Error is a ValueError
+        raise ValueError("Signature data is not valid base64")
+    if not png.startswith(b"\x89PNG\r\n\x1a\n"):
+        raise ValueError("Signature data is not a PNG image")
+    return png
+
+def _signature_image(png: bytes) -> tuple:
+    """(width, height, zlib-compressed 8-bit grey pixels) cropped to the ink."""
+    img = Image.open(io.BytesIO(png))
+    if img.width * img.height > SIGNATURE_MAX_PIXELS:
+        raise Med2StampError(f"signature image is {img.width}x{img.height}, too large")
+    img = img.convert("RGBA")
+    flat = Image.new("RGBA", img.size, (255, 255, 255, 255))
+    flat.alpha_composite(img)            # the pad's background is transparent
+    grey = flat.convert("L")
+    bbox = ImageOps.invert(grey).getbbox()
+    if bbox is None:
+        raise Med2StampError("signature image is blank")
+    grey = grey.crop(bbox)
+    grey.thumbnail((600, 72))            # ~4x the 148x18pt box: sharp in print, still tiny
+    return grey.width, grey.height, zlib.compress(grey.tobytes(), 9)
+
+def _pdf_object_body(pdf: bytes, offsets: Dict[int, int], num: int) -> bytes:
+    start = offsets[num]
+    body = pdf[start:pdf.index(b"endobj", start)]
+    return body[body.index(b"obj") + 3:].strip()
+
+def _pdf_stream_object(num: int, data: bytes, extra: bytes = b"") -> bytes:
+    return (b"%d 0 obj\n<< %s/Filter /FlateDecode /Length %d >>\nstream\n"
+            % (num, extra, len(data)) + data + b"\nendstream\nendobj\n")
+
+def _med2_signature_update(pdf: bytes, signature_png: Optional[bytes], signed_on: str) -> bytes:
+    """The bytes to append to `pdf` so that page 2 shows the signature."""
+    tail = re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", pdf)
+    if not tail:
+        raise Med2StampError("no startxref")
+    prev_xref = int(tail.group(1))
+    table = re.match(rb"xref\s+(\d+) (\d+)\s+", pdf[prev_xref:])
+    if not table:
+        raise Med2StampError("no classic xref table")
+    first, count = int(table.group(1)), int(table.group(2))
+    pos = prev_xref + table.end()
+    offsets = {}
+    for i in range(count):
+        entry = pdf[pos + 20 * i: pos + 20 * i + 20]
+        if entry[17:18] == b"n":
+            offsets[first + i] = int(entry[:10])
+    trailer = pdf[pdf.index(b"trailer", pos):tail.start()]
+    try:
+        root = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+        size = int(re.search(rb"/Size (\d+)", trailer).group(1))
+        pages = int(re.search(rb"/Pages (\d+) 0 R", _pdf_object_body(pdf, offsets, root)).group(1))
+        kids = re.search(rb"/Kids \[([^\]]*)\]", _pdf_object_body(pdf, offsets, pages)).group(1)
+        page_num = int(re.findall(rb"(\d+) 0 R", kids)[1])    # page 2: the form itself
+    except (AttributeError, IndexError, KeyError, ValueError) as e:
+        raise Med2StampError(f"unexpected document structure: {e}")
+    info = re.search(rb"/Info (\d+) 0 R", trailer)
+    doc_id = re.search(rb"/ID\s*\[\s*<([0-9a-fA-F]+)>", trailer)
+
+    image_num, open_num, stamp_num = size, size + 1, size + 2
+    page = _pdf_object_body(pdf, offsets, page_num)
+    # Wrap the original page content in q ... Q so our stream starts from a clean graphics state
+    page, n_contents = re.subn(rb"/Contents (\d+) 0 R",
+                               b"/Contents [ %d 0 R \\1 0 R %d 0 R ]" % (open_num, stamp_num), page)
+    page, n_resources = re.subn(rb"/Resources <<", b"/Resources << /XObject << /SmileSig %d 0 R >>" % image_num,
+                                page, count=1)
+    if n_contents != 1 or n_resources != 1:
+        raise Med2StampError("unexpected page dictionary")
+
+    y = _med2_layout(A4[1])["signature"]
+    ops = [b"Q", b"q 1 g 170.5 %.2f 149 19 re f Q" % (y - 2.5)]   # white out "[Digital signature pending]"
+    if signature_png is not None and PIL_AVAILABLE:
+        width, height, pixels = _signature_image(signature_png)
+        scale = min(148 / width, 18 / height)
+        draw_w, draw_h = width * scale, height * scale
+        ops.append(b"q %.2f 0 0 %.2f 171 %.2f cm /SmileSig Do Q" % (draw_w, draw_h, y - 2 + (18 - draw_h) / 2))
+    else:
+        width, height, pixels = 1, 1, zlib.compress(b"\xff")
+        ops.append(b"BT /F1 7 Tf 0 g 175 %.2f Td (Digitally signed) Tj ET" % (y + 2))
+    ops.append(b"BT /F1 7 Tf 0 g 325 %.2f Td (Signed %s) Tj ET" % (y + 2, signed_on.encode("ascii", "replace")))
+
+    objects = [
+        (image_num, _pdf_stream_object(image_num, pixels, b"/Type /XObject /Subtype /Image /Width %d /Height %d "
+                                       b"/ColorSpace /DeviceGray /BitsPerComponent 8 " % (width, height))),
+        (open_num, _pdf_stream_object(open_num, zlib.compress(b"q\n"))),
+        (stamp_num, _pdf_stream_object(stamp_num, zlib.compress(b"\n".join(ops) + b"\n"))),
+        (page_num, b"%d 0 obj\n%s\nendobj\n" % (page_num, page)),
+    ]
+    out = bytearray(b"" if pdf.endswith(b"\n") else b"\n")
+    new_offsets = {}
+    for num, data in objects:
+        new_offsets[num] = len(pdf) + len(out)
+        out += data
+    xref_offset = len(pdf) + len(out)
+    out += b"xref\n0 1\n0000000000 65535 f \n%d 1\n%010d 00000 n \n%d 3\n" % (
+        page_num, new_offsets[page_num], image_num)
+    for num in (image_num, open_num, stamp_num):
+        out += b"%010d 00000 n \n" % new_offsets[num]
+    out += b"trailer\n<< /Size %d /Root %d 0 R /Prev %d " % (size + 3, root, prev_xref)
+    if info:
+        out += b"/Info %s 0 R " % info.group(1)
+    if doc_id:
+        out += b"/ID [<%s><%s>] " % (doc_id.group(1), uuid.uuid4().hex.encode())
+    out += b">>\nstartxref\n%d\n%%%%EOF\n" % xref_offset
+    return bytes(out)
+
+def stamp_med2_signature(booking_id: str, signature_png: Optional[bytes], signed_on: str) -> str:
+    """Write the signed copy of a booking's Med 2; returns its filename.
+    Runs on the PDF pool (module-level, picklable arguments)."""
+    source = med2_path(booking_id)
+    target = med2_path(booking_id, signed=True)
+    original = source.read_bytes()
+    update = _med2_signature_update(original, signature_png, signed_on)
+    tmp_path = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(original)
+        f.write(update)
+    os.replace(tmp_path, target)
+    logger.info(f"Med 2 PDF signed: {target.name} (+{len(update)} bytes)")
+    return target.name
+
+# ============================================================
+# MED 2 PDF JOBS
+# Bookings don't wait for ReportLab: book_appointment queues the render on
+# the PDF process pool and answers straight away. The file in OUTPUTS_DIR
+# is the source of truth; job records are per-process bookkeeping, so
+# after a restart (or on another worker) a missing PDF is simply rendered
+# on demand by /api/download-pdf.
+# ============================================================
+
+MED2_FILENAME_RE = re.compile(r"^Med2_SmileAgent_([\w-]+)\.pdf$")
+_PDF_JOBS_KEEP = 1000   # finished job records kept for /api/pdf-status
+
+def med2_filename(booking_id: str) -> str:
+    return f"Med2_SmileAgent_{booking_id}.pdf"
+
+def med2_signed_filename(booking_id: str) -> str:
+    return f"Med2_SmileAgent_{booking_id}_signed.pdf"
+
+def med2_path(booking_id: str, signed: bool = False) -> Path:
+    name = med2_signed_filename(booking_id) if signed else med2_filename(booking_id)
+    return shard_dir(OUTPUTS_DIR, booking_id) / name
+
+
+class PdfJobs:
+    """Med 2 render jobs keyed by booking_id, at most one in flight each."""
+
+    def __init__(self):
+        self._jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._sign_tasks: Dict[str, asyncio.Task] = {}
+
+    def submit(self, booking: dict, clinic: dict) -> dict:
+        """Queue a render unless one is already running; returns the job record."""
+        booking_id = booking["booking_id"]
+        if booking_id in self._tasks:
+            return self._jobs[booking_id]
+        job = {
+            "job_id": uuid.uuid4().hex[:12],
+            "booking_id": booking_id,
+            "status": "queued",
+            "filename": med2_filename(booking_id),
+            "queued_at": datetime.now().isoformat(),
+            "finished_at": None,
+            "error": None,
+        }
+        self._jobs[booking_id] = job
+        self._jobs.move_to_end(booking_id)
+        while len(self._jobs) > _PDF_JOBS_KEEP:
+            oldest = next(iter(self._jobs))
+            if oldest in self._tasks:
+                break
+            del self._jobs[oldest]
+        self._tasks[booking_id] = asyncio.create_task(self._render(job, booking, clinic))
+        return job
+
+    async def _render(self, job: dict, booking: dict, clinic: dict):
+        try:
+            await run_pdf(generate_med2_pdf, booking, clinic)
+            job["status"] = "ready"
+        except Exception as e:
+            logger.error(f"Med 2 PDF for booking {job['booking_id']} failed: {e}")
+            job["status"] = "failed"
+            job["error"] = "PDF generation failed"
+        finally:
+            job["finished_at"] = datetime.now().isoformat()
+            self._tasks.pop(job["booking_id"], None)
+
+    async def ensure(self, booking: dict, clinic: dict) -> bool:
+        """Wait for the booking's PDF, starting a render if none is queued."""
+        job = self.submit(booking, clinic)
+        task = self._tasks.get(booking["booking_id"])
+        if task is not None:
+            await asyncio.shield(task)
+        return job["status"] == "ready"
+
+    def sign(self, booking: dict, clinic: dict, signature_png: Optional[bytes], signed_on: str):
+        """Queue stamping the signature into the booking's Med 2 (rendering it
+        first if needed). A newer signature for the same booking waits for
+        the previous stamp, so the last one submitted wins."""
+        booking_id = booking["booking_id"]
+        previous = self._sign_tasks.get(booking_id)
+        self._sign_tasks[booking_id] = asyncio.create_task(
+            self._sign(booking, clinic, signature_png, signed_on, previous))
+
+    async def _sign(self, booking: dict, clinic: dict, signature_png: Optional[bytes], signed_on: str,
+                    previous: Optional[asyncio.Task]):
+        booking_id = booking["booking_id"]
+        try:
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            # Stamp the copy the clinic already has; render only if there is none,
+            # or wait for a render already in flight rather than stamp a partial file
+            if booking_id in self._tasks or not med2_path(booking_id).exists():
+                if not await self.ensure(booking, clinic):
+                    raise Med2StampError("unsigned PDF could not be generated")
+            await run_pdf(stamp_med2_signature, booking_id, signature_png, signed_on)
+        except Exception as e:
+            logger.error(f"Signing Med 2 for booking {booking_id} failed: {e}")
+        finally:
+            if self._sign_tasks.get(booking_id) is asyncio.current_task():
+                del self._sign_tasks[booking_id]
+
+    async def wait_signed(self, booking_id: str):
+        """Wait for any signature stamp queued for the booking to finish."""
+        task = self._sign_tasks.get(booking_id)
+        if task is not None:
+            await asyncio.gather(asyncio.shield(task), return_exceptions=True)
+
+    def status(self, booking_id: str) -> Optional[dict]:
+        return self._jobs.get(booking_id)
+
+    async def stop(self):
+        """Let queued renders and stamps finish before the process pool shuts down."""
+        while self._tasks or self._sign_tasks:
+            await asyncio.gather(*self._tasks.values(), *self._sign_tasks.values(), return_exceptions=True)
+
+pdf_jobs = PdfJobs()
+
+# ============================================================
+# MED 2 BULK EXPORT
+# Year-end export of every Med 2 for one clinic, streamed as a ZIP.
+# Bookings are paged from the repository, missing PDFs are rendered on
+# the PDF pool with a bounded number in flight, and each file goes into
+# the ZIP as soon as it is ready. Memory stays flat however many forms
+# there are; only zipfile's per-entry directory record grows.
+# ============================================================
+
+_EXPORT_PAGE = 200        # bookings fetched per repository call
+_EXPORT_IN_FLIGHT = 32    # PDFs being rendered / waited on at once
+
+class _ZipSink:
+    """Write-only, unseekable file object for zipfile; drained after each entry."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+async def stream_med2_export(clinic: dict, since: str, until: str):
+    """Yield a ZIP of the clinic's Med 2 PDFs for bookings created in [since, until)."""
+    sink = _ZipSink()
+    zf = zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED)
+    backlog: List[dict] = []
+    pending = set()
+    after, exhausted = None, False
+    failed: List[str] = []
+
+    async def ready(booking: dict) -> tuple:
+        """The signed Med 2 if there is one (after any signing in progress),
+        else the unsigned copy, rendered if missing."""
+        booking_id = booking["booking_id"]
+        await pdf_jobs.wait_signed(booking_id)
+        signed = med2_path(booking_id, signed=True)
+        if signed.exists():
+            return booking_id, signed
+        path = med2_path(booking_id)
+        ok = path.exists() or await pdf_jobs.ensure(booking, clinic)
+        return booking_id, path if ok else None
+
+    try:
+        while True:
+            while len(pending) < _EXPORT_IN_FLIGHT:
+                if not backlog and not exhausted:
+                    page = await run_io(repo.find_bookings, clinic["id"], since, until, after, _EXPORT_PAGE)
+                    exhausted = len(page) < _EXPORT_PAGE
+                    if page:
+                        after = page[-1]["booking_id"]
+                    backlog = page[::-1]
+                if not backlog:
+                    break
+                pending.add(asyncio.create_task(ready(backlog.pop())))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                booking_id, path = task.result()
+                if path is None:
+                    failed.append(booking_id)
+                    continue
+                await run_io(zf.write, path, path.name)
+                yield sink.drain()
+        if failed:
+            logger.error(f"Med 2 export for clinic {clinic['id']}: {len(failed)} PDFs could not be generated")
+            zf.writestr("FAILED.txt", "Med 2 could not be generated for these bookings:\n" + "\n".join(failed) + "\n")
+        await run_io(zf.close)   # writes the central directory
+        yield sink.drain()
+    finally:
+        for task in pending:
+            task.cancel()   # client went away; renders already queued still finish
+
+# ============================================================
+# PHOTO UPLOADS
+# /api/analyze-smile parses its own multipart body rather than taking an
+# UploadFile, so a photo never sits whole in memory or a spooled temp
+# file: each chunk the server hands us is hashed and written straight to
+# a temp file on the I/O pool. Uploads past UPLOAD_MAX_BYTES are cut off
+# mid-stream, and the first bytes must be a real image signature (the
+# browser-supplied content type is ignored). The finished file is named
+# by its SHA-256, so a retried upload of the same photo reuses the copy
+# already on disk and gets the same photo_id back.
+# ============================================================
+
+_UPLOAD_FIELD_MAX = 1024       # bytes allowed in a plain (non-file) form field
+_UPLOAD_SNIFF_BYTES = 12       # enough for every signature below
+_UPLOAD_OVERHEAD = 16 * 1024   # multipart boundaries and headers on top of the photo
+PHOTO_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+PHOTO_EXTENSIONS = ("jpg", "png", "webp", "heic")
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """File extension for a photo from its magic bytes, or None if not a supported image."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"heic", b"heix", b"hevc", b"mif1", b"msf1"):
+        return "heic"
+    return None
+
+def _upload_parser(boundary: bytes, events: list) -> MultipartParser:
+    """Multipart parser whose callbacks only queue events; the caller drains them after each write."""
+    header = {"field": bytearray(), "value": bytearray(), "headers": {}}
+
+    def on_part_begin():
+        header["headers"] = {}
+
+    def on_header_field(data, start, end):
+        header["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        header["headers"][bytes(header["field"]).lower()] = bytes(header["value"])
+        header["field"].clear()
+        header["value"].clear()
+
+    def on_headers_finished():
+        events.append(("part", header["headers"]))
+
+    def on_part_data(data, start, end):
+        events.append(("data", data[start:end]))
+
+    def on_part_end():
+        events.append(("end", None))
+
+    return MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+async def receive_photo_upload(request: Request, field: str = "file") -> dict:
+    """Stream a multipart photo upload to UPLOAD_DIR.
+
+    Returns {"photo_id", "path", "size", "duplicate", "fields"} where fields
+    holds the small form fields sent alongside the photo. Raises HTTPException
+    400 (malformed / no photo), 413 (too large) or 415 (not an image).
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(400, detail="Expected a multipart/form-data upload")
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > UPLOAD_MAX_BYTES + _UPLOAD_OVERHEAD:
+        raise HTTPException(413, detail="Photo is too large")
+
+    events: list = []
+    parser = _upload_parser(boundary, events)
+    tmp_path = UPLOAD_DIR / f".upload-{uuid.uuid4().hex}.part"
+    out = None
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    ext = None
+    fields: Dict[str, str] = {}
+    current = None          # field name of the part being read
+    value = bytearray()
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, payload in events:
+                if kind == "part":
+                    _, options = parse_options_header(payload.get(b"content-disposition", b""))
+                    current = options.get(b"name", b"").decode("latin-1")
+                    if current == field:
+                        if out is not None:
+                            raise HTTPException(400, detail="Only one photo per upload")
+                        out = await run_io(open, tmp_path, "xb")
+                elif kind == "data" and current == field:
+                    size += len(payload)
+                    if size > UPLOAD_MAX_BYTES:
+                        raise HTTPException(413, detail="Photo is too large")
+                    if ext is None:
+                        head += payload[:_UPLOAD_SNIFF_BYTES - len(head)]
+                        if len(head) >= _UPLOAD_SNIFF_BYTES:
+                            ext = sniff_image_type(head)
+                            if ext is None:
+                                raise HTTPException(415, detail="File must be a JPEG, PNG, WebP or HEIC image")
+                    digest.update(payload)
+                    await run_io(out.write, payload)
+                elif kind == "data":
+                    value += payload
+                    if len(value) > _UPLOAD_FIELD_MAX:
+                        raise HTTPException(400, detail=f"Form field '{current}' is too long")
+                elif kind == "end":
+                    if current == field and ext is None:
+                        ext = sniff_image_type(head)
+                        if ext is None:
+                            raise HTTPException(415, detail="File must be a JPEG, PNG, WebP or HEIC image")
+                    elif current != field and current:
+                        fields[current] = value.decode("utf-8", "replace")
+                    value.clear()
+                    current = None
+            events.clear()
+        parser.finalize()
+        if out is None or size == 0:
+            raise HTTPException(400, detail="No photo uploaded")
+        await run_io(out.close)
+
+        photo_id = digest.hexdigest()[:32]
+        path = shard_dir(UPLOAD_DIR, photo_id) / f"{photo_id}.{ext}"
+        duplicate = await run_io(refresh_stored_photo, photo_id)
+        if duplicate:
+            await run_io(tmp_path.unlink)
+        else:
+            await run_io(path.parent.mkdir, exist_ok=True)
+            await run_io(os.replace, tmp_path, path)
+        return {"photo_id": photo_id, "path": path, "size": size,
+                "duplicate": duplicate, "fields": fields}
+    finally:
+        if out is not None and not out.closed:
+            await run_io(out.close)
+        if tmp_path.exists():
+            await run_io(tmp_path.unlink, True)
+
+# ============================================================
+# PHOTO NORMALIZATION
+# Phone photos arrive at 4-12 MB with GPS and device EXIF. Each upload is
+# decoded once on the process pool (JPEGs at a reduced DCT scale), turned
+# upright, and written as a bounded analysis copy plus a thumbnail with
+# no metadata; the original is then deleted. A photo_id resolves to the
+# processed copies, or to the original while it is still queued or if
+# it could not be decoded (e.g. HEIC without pillow-heif).
+# ============================================================
+
+if PIL_AVAILABLE and pil_features.check("webp"):
+    PHOTO_FORMAT, PHOTO_EXT = "WEBP", "webp"
+else:
+    PHOTO_FORMAT, PHOTO_EXT = "JPEG", "jpg"
+
+def photo_paths(photo_id: str) -> dict:
+    """Where a photo's upload and processed copies live (whether or not they exist)."""
+    shard = shard_dir(UPLOAD_DIR, photo_id)
+    return {
+        "analysis": shard / f"{photo_id}_analysis.{PHOTO_EXT}",
+        "thumbnail": shard / f"{photo_id}_thumb.{PHOTO_EXT}",
+        "originals": [shard / f"{photo_id}.{ext}" for ext in PHOTO_EXTENSIONS],
+    }
+
+def resolve_photo(photo_id: str) -> Optional[dict]:
+    """photo_id -> {"analysis", "thumbnail", "normalized"} paths, or None if unknown.
+    Until the photo is normalized, "analysis" is the original upload."""
+    if not PHOTO_ID_RE.match(photo_id or ""):
+        return None
+    paths = photo_paths(photo_id)
+    if paths["analysis"].exists():
+        thumbnail = paths["thumbnail"] if paths["thumbnail"].exists() else None
+        return {"analysis": paths["analysis"], "thumbnail": thumbnail, "normalized": True}
+    for original in paths["originals"]:
+        if original.exists():
+            return {"analysis": original, "thumbnail": None, "normalized": False}
+    return None
+
+def refresh_stored_photo(photo_id: str) -> bool:
+    """True if the photo is already stored. Its files' mtimes are reset, so a
+    re-upload restarts the retention clock. Blocking."""
+    existing = resolve_photo(photo_id)
+    if existing is None:
+        return False
+    try:
+        os.utime(existing["analysis"])
+        if existing["thumbnail"] is not None:
+            os.utime(existing["thumbnail"])
+    except FileNotFoundError:   # normalized (look again) or swept (store it anew) meanwhile
+        return refresh_stored_photo(photo_id)
+    return True
+
+def _save_photo(image, path: Path, quality: int) -> int:
+    tmp = path.with_name(path.name + ".tmp")
+    # No exif=/icc_profile= → metadata dropped. WebP method 2 encodes ~2.5x
+    # faster than the default 4 for about the same size on photos.
+    options = {"method": 2} if PHOTO_FORMAT == "WEBP" else {"optimize": True}
+    image.save(tmp, PHOTO_FORMAT, quality=quality, **options)
+    os.replace(tmp, path)
+    return path.stat().st_size
+
+def normalize_photo(photo_id: str, original: str) -> dict:
+    """Write the analysis copy and thumbnail for an upload, then delete it.
+    Runs on the process pool."""
+    paths = photo_paths(photo_id)
+    paths["analysis"].parent.mkdir(exist_ok=True)
+    bound = (PHOTO_MAX_DIMENSION, PHOTO_MAX_DIMENSION)
+    with Image.open(original) as im:
+        scale = PHOTO_MAX_DIMENSION / max(im.size)
+        if scale < 1:   # JPEG: decode at 1/2..1/8 scale when that still covers the bound
+            im.draft("RGB", (int(im.width * scale) + 1, int(im.height * scale) + 1))
+        photo = ImageOps.exif_transpose(im)  # apply the phone's rotation before EXIF is dropped
+    if photo.mode != "RGB":
+        photo = photo.convert("RGB")
+    photo.thumbnail(bound, Image.Resampling.LANCZOS)
+    width, height = photo.size
+    analysis_bytes = _save_photo(photo, paths["analysis"], 82)
+    photo.thumbnail((PHOTO_THUMB_DIMENSION, PHOTO_THUMB_DIMENSION), Image.Resampling.LANCZOS)
+    thumbnail_bytes = _save_photo(photo, paths["thumbnail"], 70)
+    original_bytes = os.path.getsize(original)
+    os.remove(original)
+    return {"width": width, "height": height, "original_bytes": original_bytes,
+            "stored_bytes": analysis_bytes + thumbnail_bytes}
+
+class PhotoJobs:
+    """Normalization jobs keyed by photo_id, at most one in flight each."""
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def submit(self, photo_id: str, original: Path):
+        """Queue normalizing an upload unless it's done, running or can't be decoded here."""
+        if not PIL_AVAILABLE or photo_id in self._tasks:
+            return
+        if original.suffix == ".heic" and not HEIF_AVAILABLE:
+            return
+        resolved = resolve_photo(photo_id)
+        if resolved is None or resolved["normalized"]:
+            return
+        self._tasks[photo_id] = asyncio.create_task(self._normalize(photo_id, original))
+
+    async def _normalize(self, photo_id: str, original: Path):
+        try:
+            info = await run_image(normalize_photo, photo_id, str(original))
+            logger.info(f"Photo {photo_id} normalized to {info['width']}x{info['height']}: "
+                        f"{info['original_bytes']} -> {info['stored_bytes']} bytes")
+        except Exception as e:
+            logger.warning(f"Photo {photo_id} could not be normalized, keeping the upload: {e}")
+        finally:
+            self._tasks.pop(photo_id, None)
+
+    async def ensure(self, photo_id: str) -> Optional[dict]:
+        """Wait for any running normalization, then resolve the photo."""
+        task = self._tasks.get(photo_id)
+        if task is not None:
+            await asyncio.shield(task)
+        return resolve_photo(photo_id)
+
+    async def stop(self):
+        """Let running normalizations finish before the process pool shuts down."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+photo_jobs = PhotoJobs()
+
+# ============================================================
+# SMILE ANALYSIS
+# /api/analyze-smile hands each photo to a SmileAnalyzer through a
+# micro-batching queue: requests arriving together are grouped (up to
+# ANALYZER_BATCH_SIZE, or whatever has arrived ANALYZER_BATCH_WAIT_MS
+# after the first) and each batch runs as one call on the process pool,
+# so per-call overhead (pickling, pool hand-off, model setup) is paid
+# once per batch. Each caller awaits only its own result. The queue is
+# bounded (503 when full) and callers give up after
+# _ANALYSIS_TIMEOUT.
+#
+# Analyzers are picked with SMILE_ANALYZER: a registered name or a
+# "module:ClassName" plug-in. They must be picklable, since batches are
+# sent to worker processes.
+# ============================================================
+
+_ANALYSIS_QUEUE_MAX = 256     # backpressure: reject beyond this many waiting photos
+_ANALYSIS_TIMEOUT = 30.0      # seconds a caller waits for its diagnosis
+
+class AnalysisQueueFull(Exception):
+    """Raised when the smile analysis queue is at capacity."""
+
+class PhotoUnreadable(Exception):
+    """Raised by an analyzer for a photo it cannot decode."""
+
+class AnalyzerUnavailable(Exception):
+    """Raised when the configured analyzer can't run here (e.g. Pillow missing)."""
+
+class SmileAnalyzer(ABC):
+    """Turns photos into diagnosis dicts. Subclasses implement analyze_batch()."""
+    name = "base"
+    uses_thumbnail = False   # True: analyze the small thumbnail instead of the analysis copy
+
+    @abstractmethod
+    def analyze_batch(self, paths: List[str]) -> list:
+        """One entry per path: a diagnosis dict, or a PhotoUnreadable instance."""
+
+class ReferenceSmileAnalyzer(SmileAnalyzer):
+    """Deterministic CPU analyzer built on simple image statistics.
+
+    Not a clinical model: it exists so the batching queue, timeouts and
+    backpressure can be exercised offline. Tooth-like pixels (bright, low
+    saturation) in the centre of the photo are measured for how yellow they
+    are and how evenly they're spread left to right.
+    """
+    name = "reference"
+    uses_thumbnail = True
+    SIZE = 256   # pixels on the long side the statistics are computed at
+
+    def __init__(self):
+        if not PIL_AVAILABLE:
+            raise AnalyzerUnavailable("the reference analyzer needs Pillow")
+
+    def analyze_batch(self, paths: List[str]) -> list:
+        results = []
+        for path in paths:
+            try:
+                results.append(self._analyze(path))
+            except (OSError, ValueError) as e:   # incl. PIL.UnidentifiedImageError
+                results.append(PhotoUnreadable(str(e)))
+        return results
+
+    def _diagnosis(self, issue: str, treatment: str, confidence: int, notes: str) -> dict:
+        return {"confidence_score": confidence, "primary_issue": issue,
+                "recommended_treatment": treatment, "notes": notes}
+
+    def _analyze(self, path: str) -> dict:
+        from PIL import ImageChops, ImageStat
+        with Image.open(path) as im:
+            im.thumbnail((self.SIZE, self.SIZE))   # JPEG draft + box reduce before resampling
+            photo = im.convert("RGB")
+        w, h = photo.size
+        mouth = photo.crop((w // 6, h // 4, w - w // 6, h - h // 4))
+        _, saturation, value = mouth.convert("HSV").split()
+        teeth = ImageChops.multiply(saturation.point(lambda s: 255 if s < 70 else 0),
+                                    value.point(lambda v: 255 if v > 150 else 0))
+        coverage = ImageStat.Stat(teeth).mean[0] / 255
+        if coverage < 0.02:
+            return self._diagnosis("Photo unclear", "composite_bonding", 40,
+                                   "We couldn't see your teeth clearly. A closer, well-lit photo of your smile "
+                                   "will give a better result — or the clinic can assess you in person.")
+        r, g, b = ImageStat.Stat(mouth, teeth).mean
+        yellowness = (r + g) / 2 - b
+        mw = mouth.width
+        left = ImageStat.Stat(teeth.crop((0, 0, mw // 2, mouth.height))).mean[0]
+        right = ImageStat.Stat(teeth.crop((mw - mw // 2, 0, mw, mouth.height))).mean[0]
+        asymmetry = abs(left - right) / max(left + right, 1)
+        confidence = int(min(95, 60 + coverage * 100))
+        if yellowness > 25:
+            return self._diagnosis("Tooth Discolouration", "whitening", confidence,
+                                   "Your teeth show some yellowing that professional whitening usually lifts.")
+        if asymmetry > 0.15:
+            return self._diagnosis("Mild Crowding", "invisalign", confidence,
+                                   "Based on the scan, we detected mild crowding that could be corrected with Invisalign.")
+        return self._diagnosis("Uneven Edges", "composite_bonding", confidence,
+                               "Your teeth look well aligned; composite bonding can even out small chips and edges.")
+
+SMILE_ANALYZERS = {"reference": ReferenceSmileAnalyzer}
+
+def create_smile_analyzer(name: str) -> SmileAnalyzer:
+    """Registered analyzer name, or "package.module:ClassName" for a plug-in."""
+    if name in SMILE_ANALYZERS:
+        return SMILE_ANALYZERS[name]()
+    if ":" in name:
+        import importlib
+        module, _, attr = name.partition(":")
+        return getattr(importlib.import_module(module), attr)()
+    raise ValueError(f"Unknown SMILE_ANALYZER {name!r} (use one of {sorted(SMILE_ANALYZERS)} or module:Class)")
+
+def load_smile_analyzer(name: str) -> Optional[SmileAnalyzer]:
+    """create_smile_analyzer(), or None (analysis answers 503) if it can't run here."""
+    try:
+        return create_smile_analyzer(name)
+    except AnalyzerUnavailable as e:
+        logger.error(f"Smile analysis disabled: {e}")
+        return None
+
+def run_smile_analyzer(analyzer: SmileAnalyzer, paths: List[str]) -> list:
+    """Process-pool entry point for one batch."""
+    return analyzer.analyze_batch(paths)
+
+class AnalysisBatcher:
+    """Micro-batching queue in front of a SmileAnalyzer."""
+
+    def __init__(self, analyzer: Optional[SmileAnalyzer], batch_size: int = ANALYZER_BATCH_SIZE,
+                 batch_wait: float = ANALYZER_BATCH_WAIT_MS / 1000, concurrency: int = max(1, PDF_WORKERS)):
+        self.analyzer = analyzer
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.concurrency = concurrency   # batches on the pool at once
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._running: set = set()
+        self.batches_run = 0
+        self.photos_analyzed = 0
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue(maxsize=_ANALYSIS_QUEUE_MAX)
+            self._worker = asyncio.create_task(self._run())
+
+    async def analyze(self, path: Path, timeout: float = _ANALYSIS_TIMEOUT) -> dict:
+        """Queue one photo and wait for its diagnosis. Raises AnalyzerUnavailable,
+        AnalysisQueueFull, asyncio.TimeoutError or PhotoUnreadable."""
+        if self.analyzer is None:
+            raise AnalyzerUnavailable()
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((str(path), future))
+        except asyncio.QueueFull:
+            raise AnalysisQueueFull()
+        return await asyncio.wait_for(future, timeout)   # cancels the future on timeout
+
+    async def _next_batch(self) -> list:
+        """Collect up to batch_size items, waiting at most batch_wait after
+        the first. A None item is the shutdown sentinel and is kept."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _analyze_batch(self, batch: list, slots: asyncio.Semaphore):
+        try:
+            batch = [(path, future) for path, future in batch if not future.done()]   # drop timed-out callers
+            if not batch:
+                return
+            results = await run_image(run_smile_analyzer, self.analyzer, [path for path, _ in batch])
+            self.batches_run += 1
+            self.photos_analyzed += len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            logger.error(f"Smile analysis batch of {len(batch)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            slots.release()
+
+    async def _run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            batch = await self._next_batch()
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                await slots.acquire()
+                task = asyncio.create_task(self._analyze_batch(batch, slots))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            if stopping:
+                return
+
+    async def stop(self):
+        """Analyze everything still queued, then stop the worker (lifespan shutdown)."""
+        if self._worker is None or self._worker.done():
+            return
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+        await asyncio.gather(*self._running, return_exceptions=True)
+        logger.info(f"Smile analyzer stopped: {self.photos_analyzed} photos in {self.batches_run} batches")
+
+smile_batcher = AnalysisBatcher(load_smile_analyzer(SMILE_ANALYZER))
+
+# ============================================================
+# STORAGE RETENTION
+# UPLOAD_DIR and OUTPUTS_DIR are sharded into 256 hashed subdirectories
+# (shard_dir) and swept every STORAGE_SWEEP_INTERVAL seconds:
+#   - smile photos are deleted PHOTO_RETENTION_DAYS after upload;
+#   - unsigned Med 2 PDFs are deleted PDF_RETENTION_DAYS after their last
+#     download, and evicted least-recently-used first while the two
+#     directories are over STORAGE_QUOTA_MB. They are re-rendered on
+#     demand, so losing one only costs a render;
+#   - signed Med 2s can't be regenerated and are never deleted here;
+#   - abandoned .tmp / .part files are removed after an hour.
+# ============================================================
+
+_SWEEP_MIN_AGE = 600       # seconds: never evict a PDF this fresh (it may be mid-download)
+_STALE_TEMP_AGE = 3600     # seconds before an abandoned temp file is removed
+_UPLOAD_NAME_RE = re.compile(r"^([\w-]+?)(?:_analysis|_thumb)?\.\w+$")
+
+def touch_artifact(path: Path):
+    """Mark a regenerable file as just used, so LRU eviction takes it last."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+class StorageSweeper:
+    """Retention, quota and stats for UPLOAD_DIR and OUTPUTS_DIR."""
+
+    def __init__(self):
+        self._lock = threading.Lock()   # the background loop and an admin sweep may overlap
+        self.sweeps = 0
+        self.last_sweep: Optional[dict] = None
+        self.deleted = {"expired_photos": 0, "expired_pdfs": 0, "evicted_pdfs": 0, "stale_temp": 0}
+
+    @staticmethod
+    def _category(root: Path, name: str) -> str:
+        if name.endswith((".tmp", ".part")):
+            return "temp"
+        if root == UPLOAD_DIR:
+            return "photo"
+        if name.endswith("_signed.pdf"):
+            return "signed_pdf"
+        return "pdf" if MED2_FILENAME_RE.match(name) else "other"
+
+    @staticmethod
+    def _shard_key(root: Path, name: str) -> Optional[str]:
+        if root == OUTPUTS_DIR:
+            match = MED2_FILENAME_RE.match(name)
+            return match.group(1).removesuffix("_signed") if match else None
+        match = _UPLOAD_NAME_RE.match(name)
+        return match.group(1) if match else None
+
+    def migrate(self) -> int:
+        """Move files left flat in UPLOAD_DIR / OUTPUTS_DIR by earlier versions
+        into their shards. Runs at every worker's startup, before requests are
+        served; workers starting together may race for the same file."""
+        moved = 0
+        for root in (UPLOAD_DIR, OUTPUTS_DIR):
+            with os.scandir(root) as entries:
+                flat = [entry.name for entry in entries if entry.is_file()]
+            for name in flat:
+                key = self._shard_key(root, name)
+                if key is None or self._category(root, name) == "temp":
+                    continue
+                shard = shard_dir(root, key)
+                shard.mkdir(exist_ok=True)
+                try:
+                    os.replace(root / name, shard / name)
+                except FileNotFoundError:   # another worker moved it first
+                    continue
+                moved += 1
+        return moved
+
+    def _scan(self):
+        """(category, path, size, mtime) for every file under both directories."""
+        for root in (UPLOAD_DIR, OUTPUTS_DIR):
+            with os.scandir(root) as entries:
+                dirs = [root] + [Path(entry.path) for entry in entries if entry.is_dir()]
+            for directory in dirs:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if not entry.is_file():
+                                continue
+                            st = entry.stat()
+                        except FileNotFoundError:   # deleted while we were looking
+                            continue
+                        yield self._category(root, entry.name), entry.path, st.st_size, st.st_mtime
+
+    def sweep(self) -> dict:
+        """One retention + quota pass; returns the resulting stats. Blocking."""
+        with self._lock:
+            started = _time.time()
+            files: Dict[str, int] = defaultdict(int)
+            sizes: Dict[str, int] = defaultdict(int)
+            evictable = []
+            for category, path, size, mtime in self._scan():
+                age = started - mtime
+                expired = None
+                if category == "temp" and age > _STALE_TEMP_AGE:
+                    expired = "stale_temp"
+                elif category == "photo" and PHOTO_RETENTION_DAYS and age > PHOTO_RETENTION_DAYS * 86400:
+                    expired = "expired_photos"
+                elif category == "pdf" and PDF_RETENTION_DAYS and age > PDF_RETENTION_DAYS * 86400:
+                    expired = "expired_pdfs"
+                if expired and self._delete(path):
+                    self.deleted[expired] += 1
+                    continue
+                files[category] += 1
+                sizes[category] += size
+                if category == "pdf" and age > _SWEEP_MIN_AGE:
+                    evictable.append((mtime, size, path))
+
+            total = sum(sizes.values())
+            if STORAGE_QUOTA_BYTES and total > STORAGE_QUOTA_BYTES:
+                for _, size, path in sorted(evictable):   # least recently used first
+                    if total <= STORAGE_QUOTA_BYTES:
+                        break
+                    if self._delete(path):
+                        self.deleted["evicted_pdfs"] += 1
+                        files["pdf"] -= 1
+                        sizes["pdf"] -= size
+                        total -= size
+            over_quota = bool(STORAGE_QUOTA_BYTES) and total > STORAGE_QUOTA_BYTES
+            if over_quota:
+                logger.warning(f"Storage over quota ({total} > {STORAGE_QUOTA_BYTES} bytes) with nothing "
+                               "left to evict — photos and signed Med 2s are only removed by retention")
+
+            self.sweeps += 1
+            self.last_sweep = {
+                "finished_at": datetime.now().isoformat(),
+                "seconds": round(_time.time() - started, 3),
+                "files": dict(files),
+                "bytes": dict(sizes),
+                "total_bytes": total,
+                "over_quota": over_quota,
+            }
+            return self.status()
+
+    @staticmethod
+    def _delete(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def status(self) -> dict:
+        return {
+            "quota_bytes": STORAGE_QUOTA_BYTES,
+            "photo_retention_days": PHOTO_RETENTION_DAYS,
+            "pdf_retention_days": PDF_RETENTION_DAYS,
+            "sweep_interval": STORAGE_SWEEP_INTERVAL,
+            "sweeps": self.sweeps,
+            "deleted": dict(self.deleted),
+            "last_sweep": self.last_sweep,
+        }
+
+storage_sweeper = StorageSweeper()
+
+async def storage_sweeper_loop():
+    """Background task (started from lifespan) that sweeps uploads and outputs."""
+    while True:
+        try:
+            stats = await run_io(storage_sweeper.sweep)
+            logger.debug(f"Storage sweep: {stats['last_sweep']}")
+        except OSError as e:
+            logger.warning(f"Storage sweep failed: {e}")
+        await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
+
 # ============================================================
 # API ENDPOINTS
 # ============================================================
@@ -1832,29 +4497,45 @@ def health_check():
         "version": "7.0.0",
         "timestamp": datetime.now().isoformat(),
         "pdf_enabled": REPORTLAB_AVAILABLE,
-        "clinics_loaded": len(CLINICS),
+        "clinics_loaded": len(get_registry()),
+        "clinic_registry_version": get_registry().version,
         "treatments_loaded": len(TREATMENTS),
         "features": ["cosmetic_booking", "emergency_triage", "medical_card_filter", "dentist_brief"]
     }
 
+# ---- Cached JSON bodies with strong ETags ----
+# /api/clinics and /api/treatments only change when the clinic registry
+# reloads, so their serialised bodies are cached on the registry snapshot
+# (a reload starts with an empty cache) and revalidated via If-None-Match.
+
+def _serialize_json(payload) -> tuple:
+    """Serialise like FastAPI's JSONResponse; return (body, strong ETag)."""
+    body = json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+    return body, f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison: ignore any W/ prefix
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates)
+
+def cached_json_response(request: Request, body: bytes, etag: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}   # always revalidate, 304 is cheap
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/api/treatments")
-def get_treatments():
-    return {"treatments": TREATMENTS}
+async def get_treatments(request: Request):
+    body, etag = get_registry().cached_body(("treatments",), lambda: {"treatments": TREATMENTS})
+    return cached_json_response(request, body, etag)
 
-@app.get("/api/clinics")
-def get_clinics(treatment: Optional[str] = None):
-    """Return clinics available for cosmetic booking.
-    
-    Only clinics flagged as cosmetic_partner=True are returned here.
-    Emergency-only clinics (IDs 4+) are excluded — they appear via
-    /api/clinics/emergency instead.
-    """
+def build_cosmetic_clinics(registry: "ClinicRegistry", treatment: Optional[str]) -> dict:
     result = []
-    for clinic in CLINICS:
-        # Skip emergency-only clinics in the cosmetic flow
-        if not clinic.get("cosmetic_partner", False):
-            continue
-        
+    for clinic in registry.cosmetic_partners:
         clinic_data = {
             "id": clinic["id"],
             "clinic_name": clinic["clinic_name"],
@@ -1883,6 +4564,92 @@ def get_clinics(treatment: Optional[str] = None):
     
     return {"clinics": result}
 
+@app.get("/api/clinics")
+async def get_clinics(request: Request, treatment: Optional[str] = None):
+    """Return clinics available for cosmetic booking.
+    
+    Only clinics flagged as cosmetic_partner=True are returned here.
+    Emergency-only clinics (IDs 4+) are excluded — they appear via
+    /api/clinics/emergency instead.
+    """
+    registry = get_registry()
+    # Any treatment no partner prices renders exactly like no filter, so
+    # the cache holds at most one body per priced treatment plus one.
+    if treatment not in registry.cosmetic_pricing_keys:
+        treatment = None
+    body, etag = registry.cached_body(("clinics", treatment),
+                                      lambda: build_cosmetic_clinics(registry, treatment))
+    return cached_json_response(request, body, etag)
+
+# ============================================================
+# ADMIN ENDPOINTS
+# Require the X-Admin-Token header to match ADMIN_TOKEN. With no token
+# configured the endpoints answer 404, as if they didn't exist.
+# ============================================================
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, detail="Not Found")
+    supplied = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(403, detail="Forbidden")
+
+@app.post("/api/admin/clinics/reload")
+async def admin_reload_clinics(request: Request):
+    """Force a reload of the clinic data file (e.g. right after editing it)."""
+    require_admin(request)
+    try:
+        await run_io(reload_clinic_registry, True)
+    except ClinicRegistryError as e:
+        raise HTTPException(422, detail=f"Clinic file rejected, previous version kept: {e}")
+    registry = get_registry()
+    return {"status": "success", "version": registry.version,
+            "clinics_loaded": len(registry), "loaded_at": registry.loaded_at}
+
+@app.post("/api/admin/keys/rotate")
+async def admin_start_key_rotation(request: Request, restart: bool = False):
+    """Start (or resume) re-encrypting stored PII under the first ENCRYPTION_KEYS entry."""
+    require_admin(request)
+    started = key_rotation.start(restart=restart)
+    return {"status": "started" if started else "already_running", "job": key_rotation.status()}
+
+@app.get("/api/admin/keys/rotate")
+async def admin_key_rotation_status(request: Request):
+    """Progress of the key rotation job."""
+    require_admin(request)
+    return key_rotation.status()
+
+@app.get("/api/admin/storage")
+async def admin_storage_status(request: Request):
+    """Upload / output disk usage, retention settings and what the sweeper has deleted."""
+    require_admin(request)
+    return storage_sweeper.status()
+
+@app.post("/api/admin/storage/sweep")
+async def admin_storage_sweep(request: Request):
+    """Run a retention + quota sweep now instead of waiting for the next one."""
+    require_admin(request)
+    return await run_io(storage_sweeper.sweep)
+
+@app.get("/api/admin/clinics/{clinic_id}/med2-export")
+async def admin_export_med2(request: Request, clinic_id: int, start: date, end: date):
+    """Every Med 2 PDF for a clinic's bookings created from start to end
+    (inclusive, YYYY-MM-DD), as a streamed ZIP. Missing PDFs are rendered."""
+    require_admin(request)
+    clinic = get_clinic_by_id(clinic_id)
+    if not clinic:
+        raise HTTPException(404, detail="Clinic not found")
+    if end < start:
+        raise HTTPException(400, detail="end must not be before start")
+    if not REPORTLAB_AVAILABLE:
+        raise HTTPException(503, detail="PDF generation is not available")
+    filename = f"Med2_clinic{clinic_id}_{start:%Y%m%d}-{end:%Y%m%d}.zip"
+    return StreamingResponse(
+        stream_med2_export(clinic, start.isoformat(), (end + timedelta(days=1)).isoformat()),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 # ============================================================
 # NEW: TRIAGE ENDPOINTS
 # ============================================================
@@ -1900,21 +4667,25 @@ async def run_triage(triage_input: TriageInput):
 async def search_emergency_clinics(search: EmergencyClinicSearch):
     """Search clinics with emergency/MC filters."""
     try:
-        results = match_clinics_for_emergency(search)
+        try:
+            slots = await shared_call(shared_state.slots)
+        except (SharedStateError, sqlite3.Error) as e:
+            logger.error(f"Live slot status unavailable, searching without it: {e}")
+            slots = {}
+        results = match_clinics_for_emergency(search, slots)
         return {"clinics": results, "count": len(results)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Clinic search failed: {str(e)}")
 
 @app.post("/api/briefs/generate")
-async def create_brief(brief_input: BriefInput, background_tasks: BackgroundTasks):
+async def create_brief(brief_input: BriefInput):
     """Generate patient brief and queue email to clinic."""
     try:
-        brief = generate_brief(brief_input)
+        brief = await run_io(generate_brief, brief_input)
         clinic = get_clinic_by_id(brief_input.clinic_id)
         
         if clinic:
-            background_tasks.add_task(
-                send_clinic_email,
+            await send_clinic_email(
                 booking={},
                 clinic=clinic,
                 signature_link=f"/sign/emergency-{brief['brief_id']}",
@@ -1927,8 +4698,140 @@ async def create_brief(brief_input: BriefInput, background_tasks: BackgroundTask
 
 # ============================================================
 # EMERGENCY SLOT AVAILABILITY
+# Patients watching emergency results subscribe to /api/slots/stream
+# (Server-Sent Events) instead of polling /api/slots/status: a snapshot on
+# connect, then one "slot" event per clinic whose status changes. Updates
+# made in this worker are pushed at once; with a shared backend, changes
+# made by other workers are picked up by one poll per worker every
+# _SLOT_STREAM_POLL seconds, however many clients are connected.
+# A client too slow to keep up doesn't get an ever-growing backlog: once
+# its queue is full the backlog is dropped and it gets a fresh snapshot.
 # ============================================================
 
+_SLOT_STREAM_QUEUE = 32          # events buffered per client before it is resynced
+_SLOT_STREAM_HEARTBEAT = 15.0    # seconds of silence before a keep-alive comment
+_SLOT_STREAM_POLL = 1.0          # seconds between shared-state reads (sqlite / redis)
+_SLOT_STREAM_MAX_CLIENTS = 1000  # per worker
+_SLOT_STREAM_RETRY_MS = 3000     # client reconnect delay
+
+class SlotStreamFull(Exception):
+    """Raised when a worker already has _SLOT_STREAM_MAX_CLIENTS streams open."""
+
+class SlotSubscriber:
+    """One /api/slots/stream client: a bounded event queue plus a resync flag."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=_SLOT_STREAM_QUEUE)
+        self.stale = False
+
+class SlotBroadcaster:
+    """Fans slot status changes out to every open stream in this worker."""
+
+    def __init__(self):
+        self._subscribers: set = set()
+        self._known: Dict[int, dict] = {}
+        self._watcher: Optional[asyncio.Task] = None
+        self.version = 0     # bumps on every change; sent as the SSE event id
+        self.resyncs = 0
+
+    @property
+    def full(self) -> bool:
+        return len(self._subscribers) >= _SLOT_STREAM_MAX_CLIENTS
+
+    def subscribe(self) -> SlotSubscriber:
+        if self.full:
+            raise SlotStreamFull()
+        subscriber = SlotSubscriber()
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: SlotSubscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, clinic_id: int, status: dict):
+        """Queue a change for every client (no-op unless availability or notes changed)."""
+        previous = self._known.get(clinic_id)
+        if previous is not None and all(previous.get(k) == status.get(k) for k in ("available", "notes")):
+            return
+        self._known[clinic_id] = status
+        self.version += 1
+        event = (self.version, clinic_id, status)
+        for subscriber in self._subscribers:
+            if subscriber.stale:
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too slow: drop its backlog and have it resync from a snapshot
+                subscriber.stale = True
+                self.resyncs += 1
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+
+    def start(self):
+        """Watch the shared store for other workers' updates (not needed for memory)."""
+        if shared_state.name != "memory" and (self._watcher is None or self._watcher.done()):
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            try:
+                slots = await shared_call(shared_state.slots)
+                for clinic_id, status in slots.items():
+                    self.publish(clinic_id, status)
+            except (SharedStateError, sqlite3.Error) as e:
+                logger.warning(f"Slot stream poll failed: {e}")
+            await asyncio.sleep(_SLOT_STREAM_POLL)
+
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+slot_broadcaster = SlotBroadcaster()
+
+def _sse(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+async def _current_slots() -> Dict[int, dict]:
+    """Slot status from the store, or the last state this worker saw if it's down."""
+    try:
+        return await shared_call(shared_state.slots)
+    except (SharedStateError, sqlite3.Error):
+        return dict(slot_broadcaster._known)
+
+async def slot_event_stream(snapshot: Dict[int, dict], snapshot_version: int):
+    """SSE body: the snapshot, then deltas, heartbeats and resync snapshots.
+    Subscribes only once the response is being sent, so the finally below
+    always unsubscribes, whenever the client goes away."""
+    retry = f"retry: {_SLOT_STREAM_RETRY_MS}\n"
+    try:
+        subscriber = slot_broadcaster.subscribe()
+    except SlotStreamFull:   # filled up since the handler checked: close, the client retries
+        yield retry + "\n"
+        return
+    try:
+        if slot_broadcaster.version != snapshot_version:   # changed before we subscribed
+            snapshot = await _current_slots()
+        yield retry + _sse("snapshot", {"slots": snapshot}, slot_broadcaster.version)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), _SLOT_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if event is None:   # fell behind — start over from current state
+                subscriber.stale = False
+                snapshot = await _current_slots()
+                yield _sse("snapshot", {"slots": snapshot}, slot_broadcaster.version)
+                continue
+            version, clinic_id, status = event
+            yield _sse("slot", {"clinic_id": clinic_id, **status}, version)
+    finally:
+        slot_broadcaster.unsubscribe(subscriber)
+
 class SlotUpdate(BaseModel):
     clinic_id: int
     available: bool
@@ -1938,20 +4841,45 @@ class SlotUpdate(BaseModel):
 async def update_emergency_slot(update: SlotUpdate):
     """Update a clinic's emergency slot availability (manual for now, Twilio later)."""
     try:
-        SLOT_STATUS[update.clinic_id] = {
+        status = {
             "available": update.available,
             "last_updated": datetime.now().isoformat(),
             "notes": update.notes
         }
+        await shared_call(shared_state.set_slot, update.clinic_id, status)
+        slot_broadcaster.publish(update.clinic_id, status)
         print(f"🏥 Slot update: Clinic {update.clinic_id} → {'AVAILABLE' if update.available else 'UNAVAILABLE'}")
-        return {"status": "success", "clinic_id": update.clinic_id, "available": update.available, "last_updated": SLOT_STATUS[update.clinic_id]["last_updated"]}
+        return {"status": "success", "clinic_id": update.clinic_id, "available": update.available, "last_updated": status["last_updated"]}
+    except (SharedStateError, sqlite3.Error) as e:
+        logger.error(f"Slot update for clinic {update.clinic_id} not stored: {e}")
+        raise HTTPException(status_code=503, detail="Slot status store unavailable, please retry")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/slots/status")
 async def get_slot_status():
     """Get current emergency slot availability for all clinics."""
-    return {"slots": SLOT_STATUS}
+    try:
+        return {"slots": await shared_call(shared_state.slots)}
+    except (SharedStateError, sqlite3.Error) as e:
+        logger.error(f"Slot status read failed: {e}")
+        raise HTTPException(status_code=503, detail="Slot status store unavailable, please retry")
+
+@app.get("/api/slots/stream")
+async def stream_slot_status():
+    """Server-Sent Events: a "snapshot" event with every clinic's slot status,
+    then a "slot" event whenever one changes. Comments every
+    _SLOT_STREAM_HEARTBEAT seconds keep proxies from closing the connection."""
+    if slot_broadcaster.full:
+        raise HTTPException(503, detail="Too many live connections, please retry")
+    version = slot_broadcaster.version
+    try:
+        snapshot = await shared_call(shared_state.slots)
+    except (SharedStateError, sqlite3.Error) as e:
+        logger.error(f"Slot status read failed: {e}")
+        raise HTTPException(status_code=503, detail="Slot status store unavailable, please retry")
+    return StreamingResponse(slot_event_stream(snapshot, version), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ============================================================
 # CONSENT LOGGING (GDPR)
@@ -1965,19 +4893,134 @@ class ConsentLog(BaseModel):
     ip_address: Optional[str] = None
     user_agent: Optional[str] = None
 
-def log_consent(consent: ConsentLog) -> dict:
-    """Log GDPR consent with timestamp"""
-    consents = []
-    if CONSENTS_FILE.exists():
+# ---- Write-behind queue ----
+# Cookie-banner clicks are the highest-volume write on the site. Records
+# arriving within a short window are group-committed in one append, off the
+# event loop. Callers wait at most _CONSENT_ACK_TIMEOUT for durability; past
+# that they get a "queued" ack and the record is still flushed later
+# (and on shutdown, unless the store is still failing after
+# _CONSENT_DRAIN_TIMEOUT).
+_CONSENT_BATCH_WINDOW = 0.02   # seconds to wait for more records after the first
+_CONSENT_BATCH_MAX = 500       # records per group commit
+_CONSENT_QUEUE_MAX = 10000     # backpressure: reject beyond this many pending records
+_CONSENT_ACK_TIMEOUT = 0.5     # seconds a caller waits for the durable ack
+_CONSENT_DRAIN_TIMEOUT = 15.0  # seconds shutdown waits for the queue to flush
+
+class ConsentQueueFull(Exception):
+    """Raised when the consent write-behind queue is at capacity."""
+
+class ConsentWriter:
+    """Group-commit write-behind queue in front of repo.append_consents()."""
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.pending = 0   # submitted, not yet written or dropped
+        self.batches_written = 0
+        self.records_written = 0
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            if self._queue is None:   # a restarted worker keeps what is already queued
+                self._queue = asyncio.Queue(maxsize=_CONSENT_QUEUE_MAX)
+            self._worker = asyncio.create_task(self._run())
+
+    async def submit(self, record: dict) -> bool:
+        """Queue a record; return True once it is durable, False if the ack
+        timed out (the record stays queued and will still be written)."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
         try:
-            consents = json.loads(CONSENTS_FILE.read_text())
-        except (json.JSONDecodeError, OSError) as e:
-            logger.warning(f'Could not read consents file: {e}')
-            consents = []
-    
+            self._queue.put_nowait((record, future))
+        except asyncio.QueueFull:
+            raise ConsentQueueFull()
+        self.pending += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), _CONSENT_ACK_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _next_batch(self) -> list:
+        """Collect up to _CONSENT_BATCH_MAX items, waiting at most one window
+        after the first. A None item is the shutdown sentinel and is kept."""
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + _CONSENT_BATCH_WINDOW
+        while len(batch) < _CONSENT_BATCH_MAX and batch[-1] is not None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch: list):
+        """Append one batch, retrying with backoff until it is durable.
+        Futures are only resolved on success."""
+        delay = _CONSENT_BATCH_WINDOW
+        while True:
+            try:
+                await run_io(repo.append_consents, [record for record, _ in batch])
+                break
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Consent batch of {len(batch)} failed, retrying in {delay:.2f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+        self.pending -= len(batch)
+        self.batches_written += 1
+        self.records_written += len(batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(True)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                try:
+                    await self._write(batch)
+                except Exception as e:   # not a storage outage, so retrying won't help
+                    self.pending -= len(batch)
+                    logger.error(f"Consent batch of {len(batch)} dropped: {e}", exc_info=True)
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+            if stopping:
+                return
+
+    async def stop(self):
+        """Flush everything still queued, then stop the worker (lifespan shutdown).
+        Gives up after _CONSENT_DRAIN_TIMEOUT if the store keeps failing."""
+        if self._queue is None:
+            return
+        self.start()   # a worker that died leaves its queue to be flushed
+
+        async def drain():
+            await self._queue.put(None)   # sentinel goes behind every pending record
+            await self._worker
+
+        try:
+            await asyncio.wait_for(drain(), _CONSENT_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Consent writer stopped with the store still failing: "
+                         f"{self.pending} records not written")
+        self._worker = None
+        self._queue = None
+        self.pending = 0
+        logger.info(f"Consent writer stopped: {self.records_written} records in {self.batches_written} batches")
+
+consent_writer = ConsentWriter()
+
+def build_consent_record(consent: ConsentLog) -> dict:
+    """Build the stored consent record (the user identifier is only kept hashed)."""
     hashed_id = hashlib.sha256(consent.user_identifier.encode()).hexdigest()[:16]
-    
-    consent_record = {
+    return {
         "consent_id": str(uuid.uuid4())[:8],
         "user_hash": hashed_id,
         "consent_type": consent.consent_type,
@@ -1987,12 +5030,13 @@ def log_consent(consent: ConsentLog) -> dict:
         "ip_address": consent.ip_address,
         "user_agent": consent.user_agent
     }
-    
-    consents.append(consent_record)
-    CONSENTS_FILE.write_text(json.dumps(consents, indent=2))
-    
-    logger.info(f"Consent logged: {consent.consent_type} - {hashed_id}")
-    return consent_record
+
+async def log_consent(consent: ConsentLog) -> tuple:
+    """Log GDPR consent with timestamp. Returns (record, durable)."""
+    consent_record = build_consent_record(consent)
+    durable = await consent_writer.submit(consent_record)
+    logger.info(f"Consent logged: {consent.consent_type} - {consent_record['user_hash']}")
+    return consent_record, durable
 
 @app.post("/api/consent/log")
 async def log_user_consent(consent: ConsentLog, request: Request):
@@ -2000,8 +5044,11 @@ async def log_user_consent(consent: ConsentLog, request: Request):
     try:
         consent.ip_address = request.client.host
         consent.user_agent = request.headers.get("user-agent", "")[:100]
-        record = log_consent(consent)
-        return {"status": "success", "consent_id": record["consent_id"]}
+        record, durable = await log_consent(consent)
+        return {"status": "success", "consent_id": record["consent_id"],
+                "durability": "committed" if durable else "queued"}
+    except ConsentQueueFull:
+        raise HTTPException(status_code=503, detail="Consent service busy. Please try again.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -2009,26 +5056,33 @@ async def log_user_consent(consent: ConsentLog, request: Request):
 # EXISTING ENDPOINTS (preserved)
 # ============================================================
 
-@app.post("/api/analyze-smile")
-async def analyze_smile(file: UploadFile = File(...), save_for_med2: bool = Form(default=False)):
-    if not file.content_type or not file.content_type.startswith('image/'):
-        raise HTTPException(400, detail="File must be an image")
-    
-    photo_id = str(uuid.uuid4())
-    ext = file.filename.split('.')[-1] if file.filename else 'jpg'
-    filepath = UPLOAD_DIR / f"{photo_id}.{ext}"
+@app.post("/api/analyze-smile", openapi_extra={"requestBody": {"required": True, "content": {
+    "multipart/form-data": {"schema": {
+        "type": "object", "required": ["file"],
+        "properties": {"file": {"type": "string", "format": "binary"},
+                       "save_for_med2": {"type": "boolean", "default": False}}}}}}})
+async def analyze_smile(request: Request):
+    upload = await receive_photo_upload(request)
+    save_for_med2 = upload["fields"].get("save_for_med2", "").strip().lower() in ("true", "1", "on", "yes")
+    photo_id = upload["photo_id"]
+    photo_jobs.submit(photo_id, upload["path"])
     
-    content = await file.read()
-    filepath.write_bytes(content)
+    logger.info(f"Photo uploaded: {photo_id} ({upload['size']} bytes"
+                f"{', already stored' if upload['duplicate'] else ''})")
     
-    logger.info(f"Photo uploaded: {photo_id}")
-    
-    diagnosis = {
-        "confidence_score": 92,
-        "primary_issue": "Mild Crowding",
-        "recommended_treatment": "invisalign",
-        "notes": "Based on the scan, we detected mild crowding that could be corrected with Invisalign."
-    }
+    photo = await photo_jobs.ensure(photo_id)
+    try:
+        analyzer = smile_batcher.analyzer
+        use_thumbnail = analyzer is not None and analyzer.uses_thumbnail and photo["thumbnail"]
+        diagnosis = await smile_batcher.analyze(photo["thumbnail"] if use_thumbnail else photo["analysis"])
+    except AnalyzerUnavailable:
+        raise HTTPException(503, detail="Smile analysis is unavailable right now. Please try again later.")
+    except PhotoUnreadable:
+        raise HTTPException(422, detail="We couldn't read that photo. Please try a JPEG or PNG.")
+    except AnalysisQueueFull:
+        raise HTTPException(503, detail="Smile analysis busy. Please try again.")
+    except asyncio.TimeoutError:
+        raise HTTPException(503, detail="Smile analysis is taking too long. Please try again.")
     
     return {
         "status": "success",
@@ -2119,15 +5173,14 @@ async def book_appointment(booking: BookingRequest):
         "triage_brief_id": booking.triage_brief_id
     }
     
-    saved = save_booking(booking_data)
+    saved = await run_io(save_booking, booking_data)
     booking_id = saved['booking_id']
     
-    pdf_path, pdf_filename = None, None
-    if REPORTLAB_AVAILABLE:
-        pdf_path, pdf_filename = generate_med2_pdf(saved, clinic)
+    pdf_job = pdf_jobs.submit(saved, clinic) if REPORTLAB_AVAILABLE else None
+    pdf_filename = pdf_job["filename"] if pdf_job else None
     
     signature_link = f"/sign/{booking_id}"
-    send_clinic_email(saved, clinic, signature_link)
+    await send_clinic_email(saved, clinic, signature_link)
     
     return {
         "status": "success",
@@ -2141,15 +5194,70 @@ async def book_appointment(booking: BookingRequest):
         "net_cost": relief["net_cost"],
         "pdf_url": f"/api/download-pdf/{pdf_filename}" if pdf_filename else None,
         "pdf_filename": pdf_filename,
+        "pdf_job_id": pdf_job["job_id"] if pdf_job else None,
+        "pdf_status_url": f"/api/pdf-status/{booking_id}" if pdf_job else None,
+        "notification_status_url": f"/api/notification-status/{booking_id}",
         "signature_link": signature_link
     }
 
+@app.get("/api/pdf-status/{booking_id}")
+async def pdf_status(booking_id: str):
+    """Med 2 render state for a booking: queued, ready, failed or not_started
+    (no job in this process — the download renders it on demand)."""
+    if not re.match(r'^[\w-]+$', booking_id):
+        raise HTTPException(400, detail="Invalid booking ID")
+    filename = med2_filename(booking_id)
+    job = pdf_jobs.status(booking_id)
+    if med2_path(booking_id).exists():
+        status = "ready"
+    elif job is not None:
+        status = job["status"]
+    else:
+        if not await run_io(get_booking_by_id, booking_id):
+            raise HTTPException(404, detail="Booking not found")
+        status = "not_started"
+    return {
+        "booking_id": booking_id,
+        "job_id": job["job_id"] if job else None,
+        "status": status,
+        "pdf_url": f"/api/download-pdf/{filename}",
+        "signed": med2_path(booking_id, signed=True).exists(),
+        "error": job["error"] if job and status == "failed" else None,
+    }
+
+@app.get("/api/notification-status/{ref_id}")
+async def notification_status(ref_id: str):
+    """Delivery state of the clinic notifications for a booking_id or brief_id:
+    queued, sending, sent or failed, with attempts and the last error."""
+    if not re.match(r'^[\w-]+$', ref_id):
+        raise HTTPException(400, detail="Invalid reference")
+    notifications = await run_io(outbox.status, ref_id)
+    if not notifications:
+        raise HTTPException(404, detail="No notifications for this reference")
+    return {"ref_id": ref_id, "notifications": notifications}
+
 @app.get("/api/download-pdf/{filename}")
-def download_pdf(filename: str):
+async def download_pdf(filename: str):
     safe_filename = Path(filename).name
-    filepath = OUTPUTS_DIR / safe_filename
+    match = MED2_FILENAME_RE.match(safe_filename)
+    filepath = med2_path(match.group(1)) if match else OUTPUTS_DIR / safe_filename
+    if match:
+        # Once the dentist has signed, the signed copy is what gets served
+        signed_path = med2_path(match.group(1), signed=True)
+        if signed_path.exists():
+            return FileResponse(str(signed_path), media_type='application/pdf', filename=safe_filename)
     if not filepath.exists():
-        raise HTTPException(404, detail="PDF not found")
+        # Not rendered yet (or rendered by a process that has since restarted)
+        if not match or not REPORTLAB_AVAILABLE:
+            raise HTTPException(404, detail="PDF not found")
+        booking = await run_io(get_booking_by_id, match.group(1))
+        clinic = get_clinic_by_id(booking["clinic_id"]) if booking else None
+        if not clinic:
+            raise HTTPException(404, detail="PDF not found")
+        if not await pdf_jobs.ensure(booking, clinic):
+            raise HTTPException(503, detail="PDF could not be generated, please retry")
+    elif match:
+        touch_artifact(filepath)   # recently used → last to be evicted
     return FileResponse(str(filepath), media_type='application/pdf', filename=safe_filename)
 
 @app.get("/sign/{booking_id}", response_class=HTMLResponse)
@@ -2270,26 +5378,31 @@ def signature_page(booking_id: str):
 
 @app.post("/api/submit-signature")
 async def submit_signature(submission: SignatureSubmission):
-    booking = get_booking_by_id(submission.booking_id)
+    booking = await run_io(get_booking_by_id, submission.booking_id)
     if not booking:
         raise HTTPException(404, detail="Booking not found")
+    try:
+        signature_png = decode_signature_data_url(submission.signature_data)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
     
-    signatures = []
-    if SIGNATURES_FILE.exists():
-        try:
-            signatures = json.loads(SIGNATURES_FILE.read_text())
-        except (json.JSONDecodeError, OSError) as e:
-            logger.warning(f'Could not read signatures file: {e}')
-            signatures = []
-    
-    signatures.append({
+    await run_io(repo.save_signature, {
         "booking_id": submission.booking_id,
         "signature_data": submission.signature_data[:100] + "...",
+        "signature_sha256": hashlib.sha256(signature_png).hexdigest(),
         "signed_date": submission.signed_date,
         "created_at": datetime.now().isoformat()
     })
-    SIGNATURES_FILE.write_text(json.dumps(signatures, indent=2))
-    update_booking(submission.booking_id, {"signature_status": "signed"})
+    await run_io(update_booking, submission.booking_id, {"signature_status": "signed"})
+    
+    # Stamp the signature into the Med 2 in the background
+    clinic = get_clinic_by_id(booking.get("clinic_id"))
+    if clinic and REPORTLAB_AVAILABLE:
+        try:
+            signed_on = datetime.fromisoformat(submission.signed_date.replace("Z", "+00:00")).strftime("%d/%m/%Y")
+        except ValueError:
+            signed_on = datetime.now().strftime("%d/%m/%Y")
+        pdf_jobs.sign(booking, clinic, signature_png, signed_on)
     
     logger.info(f"Signature received for booking: {submission.booking_id}")
     return {"status": "success", "message": "Signature submitted successfully"}